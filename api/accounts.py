@@ -1,14 +1,23 @@
 import os
 import json
+import hashlib
 import logging
-from fastapi import APIRouter, Depends, HTTPException, status
+import constants
+from fastapi import APIRouter, Depends, HTTPException, status, Header, Response
 from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from utils.schemas import AccountCreate, Account, UserOut, AccountUpdate
-from utils import get_db, get_cache, RedisCache, create_account_task
+from utils.schemas import AccountCreate, Account, UserOut, AccountUpdate, AccountBatch, BatchOperation, BatchResult
+from utils import get_db, get_cache, RedisCache, create_account_task, spending_backfill_task
 from .auth import has_access
-from typing import List
+from .conditional import conditional_get, set_etag
+from typing import List, Optional
 from models import Account as AccountModel
+from utils.projections import AccountRow, RowsResponse, fetch_rows, rows_to_json, select_accounts
+from utils.outbox import record_event, row_data
+from utils.spending import SpendingModel, SPENDING_RETRY_AFTER
+from utils import queries
 
 
 Logger = logging.getLogger(__name__)
@@ -16,43 +25,264 @@ Logger = logging.getLogger(__name__)
 router = APIRouter()
 
 ACCOUNT_PREFIX = os.getenv("ACCOUNT_PREFIX", "account:")
+IDEMPOTENCY_PREFIX = os.getenv("IDEMPOTENCY_PREFIX", "idempotency:")
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 60 * 60 * 24))
 
 
-@router.post("/{user_id}/accounts/")
-async def create_account(
+@router.post("/{user_id}/accounts/", status_code=status.HTTP_201_CREATED)
+def create_account(
     user_id: int,
     account: AccountCreate,
+    response: Response,
+    background: bool = False,
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+    cache: RedisCache = Depends(get_cache),
     db: Session = Depends(get_db),
     current_user: UserOut = Depends(has_access)
 ):
+    """
+    Create an account for the current user and return it.
+
+    With ?background=true the insert is handed to Celery instead. Retries
+    carrying the same Idempotency-Key header get the first response back.
+    """
 
     # Check if the logged in user is adding the account for their own user ID
     if current_user.id != user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
 
-    # Check if the account already exists
-    db_account = db.query(AccountModel).filter(
-        AccountModel.user_id == user_id,
-        AccountModel.account_name == account.account_name
-    ).first()
-
-    if db_account:
+    if idempotency_key is None:
+        status_code, body = _create_account(
+            user_id, account, background, cache, db)
+        response.status_code = status_code
+        return body
+
+    cache_key = f"{IDEMPOTENCY_PREFIX}account:{user_id}:{idempotency_key}"
+    fingerprint = hashlib.sha256(json.dumps(
+        [account.dict(), background], sort_keys=True).encode()).hexdigest()
+
+    # Reserve the key so concurrent retries don't both create the account
+    if not cache.add(cache_key, json.dumps({"fingerprint": fingerprint}), IDEMPOTENCY_TTL):
+        stored = json.loads(cache.get(cache_key) or "{}")
+        if stored.get("fingerprint") != fingerprint:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="Idempotency-Key was used with a different request")
+        if "body" not in stored:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="A request with this Idempotency-Key is in progress")
+
+        response.status_code = stored["status_code"]
+        response.headers["Idempotent-Replayed"] = "true"
+        return stored["body"]
+
+    try:
+        status_code, body = _create_account(
+            user_id, account, background, cache, db)
+    except Exception:
+        cache.delete_key(cache_key)
+        raise
+
+    cache.set_(cache_key, json.dumps({
+        "fingerprint": fingerprint,
+        "status_code": status_code,
+        "body": body,
+    }), expiration_time=IDEMPOTENCY_TTL)
+
+    response.status_code = status_code
+    return body
+
+
+def _create_account(user_id: int, account: AccountCreate, background: bool, cache: RedisCache, db: Session):
+    if background:
+        # Check if the account already exists
+        db_account = queries.account_by_name(
+            db, user_id, account.account_name)
+
+        if db_account:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="Account already exists")
+
+        account_data = account.dict()
+        create_account_task.delay(account_data, user_id)
+
+        return status.HTTP_202_ACCEPTED, {
+            "status": "success",
+            "message": "Account creation started in the background",
+        }
+
+    # The unique (user_id, account_name) index rejects duplicates, even racing ones
+    db_account = AccountModel(**account.dict(), user_id=user_id)
+    db.add(db_account)
+    try:
+        db.flush()
+        record_event(db, user_id, "account", "created",
+                     db_account.account_id, row_data(db_account))
+        db.commit()
+    except IntegrityError:
+        db.rollback()
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Account already exists")
+    db.refresh(db_account)
 
-    account_data = account.dict()
-    create_account_task.delay(account_data, user_id)
+    cache.delete_key(f"{ACCOUNT_PREFIX}{user_id}")
+    cache.bump_versions(user_id, "accounts")
 
-    return {
-        "status": "success",
-        "message": "Account creation started in the background",
-    }
+    return status.HTTP_201_CREATED, jsonable_encoder(Account.from_orm(db_account))
+
+
+@router.post("/{user_id}/accounts/batch", response_model=BatchResult)
+def batch_accounts(
+    user_id: int,
+    batch: AccountBatch,
+    current_user: UserOut = Depends(has_access),
+    cache: RedisCache = Depends(get_cache),
+    db: Session = Depends(get_db)
+):
+    """
+    Create, update and delete accounts of the current user in one transaction.
+
+    Invalid operations are reported per item and skipped, the rest are
+    committed together.
+    """
+
+    # Check if the current user is the same as the user requested
+    if current_user.id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+    results = [None] * len(batch.operations)
+
+    def fail(index, detail):
+        results[index] = {"index": index, "status": "error", "detail": detail}
+
+    operations = []
+    for index, item in enumerate(batch.operations):
+        if item.op == BatchOperation.create and (item.account_name is None or item.balance is None):
+            fail(index, "account_name and balance are required")
+        elif item.op != BatchOperation.create and item.account_id is None:
+            fail(index, "account_id is required")
+        elif item.op == BatchOperation.update and item.account_name is None and item.balance is None:
+            fail(index, "Nothing to update")
+        else:
+            operations.append((index, item))
+
+    # Load every targeted account and every requested name in one query each
+    account_ids = {item.account_id for _, item in operations
+                   if item.op != BatchOperation.create}
+    accounts = {}
+    if account_ids:
+        accounts = {account.account_id: account for account in db.query(AccountModel).filter(
+            AccountModel.user_id == user_id, AccountModel.account_id.in_(account_ids))}
+
+    names = {item.account_name for _, item in operations
+             if item.op != BatchOperation.delete and item.account_name is not None}
+    taken_names = {}
+    if names:
+        taken_names = dict(db.query(AccountModel.account_name, AccountModel.account_id).filter(
+            AccountModel.user_id == user_id, AccountModel.account_name.in_(names)))
+
+    created = []
+    changed = []
+    batch_names = set()
+    deleted_ids = set()
+    for index, item in operations:
+        db_account = None
+        if item.op != BatchOperation.create:
+            db_account = accounts.get(item.account_id)
+            if db_account is None or item.account_id in deleted_ids:
+                fail(index, "Account not found")
+                continue
+
+        if item.op != BatchOperation.delete and item.account_name is not None:
+            owner = taken_names.get(item.account_name)
+            if item.account_name in batch_names or owner not in (None, item.account_id):
+                fail(index, "Account already exists")
+                continue
+            batch_names.add(item.account_name)
+
+        if item.op == BatchOperation.create:
+            db_account = AccountModel(
+                account_name=item.account_name, balance=item.balance, user_id=user_id)
+            db.add(db_account)
+            created.append((index, db_account))
+            changed.append(("created", db_account))
+        elif item.op == BatchOperation.update:
+            for key, value in item.dict(include={"account_name", "balance"}, exclude_none=True).items():
+                setattr(db_account, key, value)
+            results[index] = {"index": index,
+                              "status": "updated", "id": item.account_id}
+            changed.append(("updated", db_account))
+        else:
+            db.delete(db_account)
+            deleted_ids.add(item.account_id)
+            results[index] = {"index": index,
+                              "status": "deleted", "id": item.account_id}
+            changed.append(("deleted", db_account))
+
+    try:
+        db.flush()
+        for action, db_account in changed:
+            record_event(db, user_id, "account", action, db_account.account_id,
+                         row_data(db_account) if action != "deleted" else None)
+        db.commit()
+    except IntegrityError as error:
+        db.rollback()
+        # deleted accounts that rows without ON DELETE CASCADE still point at
+        in_use = _referenced_accounts(db, deleted_ids) if _is_foreign_key_violation(error) else []
+        if in_use:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Accounts still in use: {', '.join(str(account_id) for account_id in in_use)}")
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail="Batch conflicts with concurrent changes")
+
+    for index, db_account in created:
+        results[index] = {"index": index,
+                          "status": "created", "id": db_account.account_id}
+
+    stale_keys = [f"{ACCOUNT_PREFIX}{user_id}"]
+    stale_keys.extend(f"{ACCOUNT_PREFIX}{user_id}_{account_id}" for account_id in accounts)
+    if deleted_ids:
+        # deleted accounts take their budgets out of the cached budget list
+        stale_keys.append(f"{constants.BUDGET_PREFIX}{user_id}")
+    cache.delete_keys(*stale_keys)
+    for account_id in deleted_ids:
+        SpendingModel(cache).forget(user_id, account_id)
+    # deleted accounts take their budgets and expenses with them
+    if deleted_ids:
+        cache.bump_versions(user_id, "accounts", "budgets", "expenses")
+    else:
+        cache.bump_versions(user_id, "accounts")
+
+    return {"results": results}
+
+
+def _is_foreign_key_violation(error: IntegrityError) -> bool:
+    # 23503 is foreign_key_violation on PostgreSQL, SQLite only says so in the message
+    return getattr(error.orig, "pgcode", None) == "23503" or "FOREIGN KEY" in str(error.orig)
+
+
+def _referenced_accounts(db: Session, account_ids) -> List[int]:
+    """The given account ids that rows of any table still reference"""
+    if not account_ids:
+        return []
+    account_id = AccountModel.__table__.c.account_id
+    referenced = set()
+    for table in AccountModel.metadata.sorted_tables:
+        for foreign_key in table.foreign_keys:
+            if foreign_key.column is account_id:
+                referenced.update(db.execute(select(foreign_key.parent).where(
+                    foreign_key.parent.in_(account_ids)).distinct()).scalars())
+    return sorted(referenced)
 
 
 @router.get("/{user_id}/accounts", response_model=List[Account])
 def get_accounts(
     user_id: int,
+    etag: Optional[str] = Depends(conditional_get("accounts")),
     current_user: UserOut = Depends(has_access),
     cache_client: RedisCache = Depends(get_cache),
     db: Session = Depends(get_db)
@@ -61,35 +291,32 @@ def get_accounts(
     Get a list of all accounts for the current user.
     """
 
-    cache_key = f"{ACCOUNT_PREFIX}{user_id}"
-    cached_data = cache_client.get(cache_key)
-
-    if cached_data:
-        Logger.info("Returning cached data")
-        return json.loads(cached_data)
-
     # Check if the current user is the same as the user requested
     if current_user.id != user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
 
-    accounts = db.query(AccountModel).filter(
-        AccountModel.user_id == user_id).order_by(AccountModel.account_id.desc()).all()
+    def load_accounts():
+        accounts = fetch_rows(db, select_accounts(
+            AccountModel.user_id == user_id).order_by(AccountModel.account_id.desc()), AccountRow)
 
-    if not accounts:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="Accounts not found")
+        if not accounts:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Accounts not found")
 
-    accounts = jsonable_encoder(accounts)
-    cache_client.set_(cache_key, json.dumps(accounts))
+        return rows_to_json(accounts)
 
-    return accounts
+    # The cached JSON is already in response shape, send it as is
+    cache_key = f"{ACCOUNT_PREFIX}{user_id}"
+    return set_etag(RowsResponse(cache_client.get_or_compute(cache_key, load_accounts)), etag)
 
 
 @router.get("/{user_id}/accounts/{account_id}", response_model=Account)
 def get_account(
     user_id: int,
     account_id: int,
+    response: Response,
+    etag: Optional[str] = Depends(conditional_get("accounts")),
     current_user: UserOut = Depends(has_access),
     cache_client: RedisCache = Depends(get_cache),
     db: Session = Depends(get_db)
@@ -103,14 +330,15 @@ def get_account(
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
 
+    set_etag(response, etag)
+
     cache_key = f"{ACCOUNT_PREFIX}{user_id}_{account_id}"
     cached_data = cache_client.get(cache_key)
 
     if cached_data:
         return json.loads(cached_data)
 
-    account = db.query(AccountModel).filter(
-        AccountModel.account_id == account_id, AccountModel.user_id == user_id).first()
+    account = queries.owned_account(db, user_id, account_id)
 
     if not account:
         raise HTTPException(
@@ -139,8 +367,7 @@ def update_account(
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
 
-    db_account = db.query(AccountModel).filter(
-        AccountModel.account_id == account_id, AccountModel.user_id == user_id).first()
+    db_account = queries.owned_account(db, user_id, account_id)
 
     if not db_account:
         raise HTTPException(
@@ -150,7 +377,15 @@ def update_account(
     for key, value in account_data.items():
         setattr(db_account, key, value)
 
-    db.commit()
+    # the unique (user_id, account_name) index rejects renames onto another account
+    try:
+        record_event(db, user_id, "account", "updated",
+                     account_id, row_data(db_account))
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Account already exists")
     db.refresh(db_account)
 
     cache_key = f"{ACCOUNT_PREFIX}{user_id}_{account_id}"
@@ -159,6 +394,8 @@ def update_account(
     cache_key_accounts = f"{ACCOUNT_PREFIX}{user_id}"
     cache.delete_key(cache_key_accounts)
 
+    cache.bump_versions(user_id, "accounts")
+
     return db_account
 
 
@@ -179,14 +416,14 @@ def delete_account(
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
 
-    db_account = db.query(AccountModel).filter(
-        AccountModel.account_id == account_id, AccountModel.user_id == user_id).first()
+    db_account = queries.owned_account(db, user_id, account_id)
 
     if not db_account:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Account not found")
 
     db.delete(db_account)
+    record_event(db, user_id, "account", "deleted", account_id)
     db.commit()
 
     cache_key = f"{ACCOUNT_PREFIX}{user_id}_{account_id}"
@@ -194,5 +431,52 @@ def delete_account(
 
     cache_key_accounts = f"{ACCOUNT_PREFIX}{user_id}"
     cache.delete_key(cache_key_accounts)
+    cache.delete_key(f"{constants.BUDGET_PREFIX}{user_id}")
+    SpendingModel(cache).forget(user_id, account_id)
+
+    # the account's budgets and expenses are deleted with it
+    cache.bump_versions(user_id, "accounts", "budgets", "expenses")
 
     return {"message": "Account deleted successfully"}
+
+
+@router.get("/{user_id}/accounts/{account_id}/forecast")
+def get_forecast(
+    user_id: int,
+    account_id: int,
+    response: Response,
+    current_user: UserOut = Depends(has_access),
+    cache: RedisCache = Depends(get_cache),
+    db: Session = Depends(get_db)
+):
+    """
+    Projected month-end spend of an account, its per-category spending
+    statistics and recent unusual expenses.
+
+    Until the statistics are built in the background the answer is 202
+    with a Retry-After header.
+    """
+
+    # Check if the current user is the same as the user requested
+    if current_user.id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+    account = queries.owned_account(db, user_id, account_id)
+    if not account:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Account not found")
+
+    model = SpendingModel(cache)
+    forecast = model.forecast(user_id, account_id)
+    if forecast is None:
+        if model.claim_backfill(user_id, account_id):
+            spending_backfill_task.delay(user_id, account_id)
+        response.status_code = status.HTTP_202_ACCEPTED
+        response.headers["Retry-After"] = str(SPENDING_RETRY_AFTER)
+        return {
+            "status": "pending",
+            "message": "Spending statistics are being built in the background",
+        }
+
+    return forecast
@@ -7,6 +7,7 @@ from sqlalchemy.orm import Session
 from sqlalchemy import or_
 from utils.db import get_db
 from utils.schemas import UserInDB, Token, TokenData, UserOut
+from utils import queries
 from models.users import User
 from typing import Optional
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
@@ -48,27 +49,26 @@ def authenticate_user(db: Session, username: str, password: str) -> Optional[Use
 def login_for_access_token(
     email: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)
 ):
-    user = db.query(User).filter(User.email == email).first()
+    user = queries.user_by_email(db, email)
 
-    if not user or not verify_password(password, user.hashed_password):
+    if not user or user.deleted_at is not None or not verify_password(password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    access_token = create_access_token(data={"sub": user.email})
+    access_token = create_access_token(data={"sub": user.email, "uid": user.id})
     return Token(access_token=access_token, token_type="bearer")
 
 
 security = HTTPBearer()
 
 
-def has_access(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
+def get_user_from_token(token: str, db: Session) -> UserOut:
     """
-        Function that is used to validate the token in the case that it requires it
+        Resolve a bearer token to the user it was issued for
     """
-    token = credentials.credentials
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
@@ -84,8 +84,10 @@ def has_access(credentials: HTTPAuthorizationCredentials = Depends(security), db
             detail="Could not validate credentials",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    current_user = db.query(User).filter(User.email == email).first()
-    if current_user is None:
+    current_user = queries.user_by_email(db, email)
+    # deleted users lose their tokens, and a token never outlives its user id
+    if current_user is None or current_user.deleted_at is not None or \
+            payload.get("uid", current_user.id) != current_user.id:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials",
@@ -93,4 +95,10 @@ def has_access(credentials: HTTPAuthorizationCredentials = Depends(security), db
         )
     current_user = UserOut(**current_user.__dict__)
     return current_user
-    # user = db.query(User).filter(User.email == email).first()
+
+
+def has_access(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
+    """
+        Function that is used to validate the token in the case that it requires it
+    """
+    return get_user_from_token(credentials.credentials, db)
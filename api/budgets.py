@@ -1,14 +1,20 @@
 import os
 import json
-from fastapi import APIRouter, Depends, HTTPException, status
-from fastapi.encoders import jsonable_encoder
+from fastapi import APIRouter, Depends, HTTPException, status, Response
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from sqlalchemy.sql import func
-from typing import List
+from typing import List, Optional
 from .auth import has_access
+from .conditional import conditional_get, set_etag
 from utils import get_db, get_cache, RedisCache
-from models import Budget as BudgetModel, Expense as ExpenseModel
-from utils.schemas import BudgetCreate, BudgetInDB, UserOut
+from models import Budget as BudgetModel, Account as AccountModel
+from utils.archive import needs_archive
+from utils.budget_index import forget_spent
+from utils.tasks import BUDGET_ALERTS_PREFIX
+from utils.outbox import record_event, row_data
+from utils import queries
+from utils.projections import BudgetRow, RowsResponse, fetch_rows, rows_to_json, select_budgets
+from utils.schemas import BudgetCreate, BudgetInDB, UserOut, BudgetBatch, BatchOperation, BatchResult
 
 router = APIRouter()
 
@@ -35,12 +41,16 @@ def create_budget(
     # Create the budget in the database
     db_budget = BudgetModel(**budget.dict(), user_id=user_id)
     db.add(db_budget)
+    db.flush()
+    record_event(db, user_id, "budget", "created",
+                 db_budget.budget_id, row_data(db_budget))
     db.commit()
     db.refresh(db_budget)
 
     # Delete the budget from cache
     cache_key = f"{BUDGET_PREIFX}{user_id}"
     cache_client.delete_key(cache_key)
+    cache_client.bump_versions(user_id, "budgets")
 
     return db_budget
 
@@ -60,8 +70,7 @@ def update_budget(
             status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
 
     # Update the budget in the database
-    db_budget = db.query(BudgetModel).filter(
-        BudgetModel.budget_id == budget_id, BudgetModel.user_id == user_id).first()
+    db_budget = queries.owned_budget(db, user_id, budget_id)
 
     if not db_budget:
         raise HTTPException(
@@ -75,45 +84,162 @@ def update_budget(
     for key, value in budget.dict(exclude_unset=True).items():
         setattr(db_budget, key, value)
 
+    record_event(db, user_id, "budget", "updated",
+                 budget_id, row_data(db_budget))
     db.commit()
     db.refresh(db_budget)
 
     # Delete the budget from cache
     cache_key = f"{BUDGET_PREIFX}{user_id}"
     cache_client.delete_key(cache_key)
+    forget_spent(cache_client, user_id, [budget_id])
+    cache_client.bump_versions(user_id, "budgets")
 
     return db_budget
 
 
-@router.get("/{user_id}/budgets/", response_model=List[BudgetInDB])
-def get_budgets(
+@router.post("/{user_id}/budgets/batch", response_model=BatchResult)
+def batch_budgets(
     user_id: int,
+    batch: BudgetBatch,
     current_user: UserOut = Depends(has_access),
     cache_client: RedisCache = Depends(get_cache),
     db: Session = Depends(get_db)
 ):
+    """
+    Create, update and delete budgets of the current user in one transaction.
+
+    Invalid operations are reported per item and skipped, the rest are
+    committed together.
+    """
     # Check if the current user is the same as the user requested
     if current_user.id != user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
 
+    results = [None] * len(batch.operations)
+
+    def fail(index, detail):
+        results[index] = {"index": index, "status": "error", "detail": detail}
+
+    operations = []
+    for index, item in enumerate(batch.operations):
+        if item.op == BatchOperation.create and None in (item.account_id, item.amount, item.start_date, item.end_date):
+            fail(index, "account_id, amount, start_date and end_date are required")
+        elif item.op != BatchOperation.create and item.budget_id is None:
+            fail(index, "budget_id is required")
+        else:
+            operations.append((index, item))
+
+    # Load every targeted budget and referenced account in one query each
+    budget_ids = {item.budget_id for _, item in operations
+                  if item.op != BatchOperation.create}
+    budgets = {}
+    if budget_ids:
+        budgets = {budget.budget_id: budget for budget in db.query(BudgetModel).filter(
+            BudgetModel.user_id == user_id, BudgetModel.budget_id.in_(budget_ids))}
+
+    account_ids = {item.account_id for _, item in operations
+                   if item.op != BatchOperation.delete and item.account_id is not None}
+    owned_accounts = set()
+    if account_ids:
+        owned_accounts = {account_id for account_id, in db.query(AccountModel.account_id).filter(
+            AccountModel.user_id == user_id, AccountModel.account_id.in_(account_ids))}
+
+    created = []
+    changed = []
+    deleted_ids = set()
+    for index, item in operations:
+        db_budget = None
+        if item.op != BatchOperation.create:
+            db_budget = budgets.get(item.budget_id)
+            if db_budget is None or item.budget_id in deleted_ids:
+                fail(index, "Budget not found")
+                continue
+
+        if item.op == BatchOperation.delete:
+            db.delete(db_budget)
+            deleted_ids.add(item.budget_id)
+            results[index] = {"index": index,
+                              "status": "deleted", "id": item.budget_id}
+            changed.append(("deleted", db_budget))
+            continue
+
+        if item.account_id is not None and item.account_id not in owned_accounts:
+            fail(index, "Invalid account ID")
+            continue
+
+        changes = item.dict(include={"account_id", "amount", "start_date", "end_date"},
+                            exclude_none=True)
+        start_date = changes.get("start_date", getattr(db_budget, "start_date", None))
+        end_date = changes.get("end_date", getattr(db_budget, "end_date", None))
+        if start_date > end_date:
+            fail(index, "Start date should be less than end date")
+            continue
+
+        if item.op == BatchOperation.create:
+            db_budget = BudgetModel(**changes, user_id=user_id)
+            db.add(db_budget)
+            created.append((index, db_budget))
+            changed.append(("created", db_budget))
+        else:
+            for key, value in changes.items():
+                setattr(db_budget, key, value)
+            results[index] = {"index": index,
+                              "status": "updated", "id": item.budget_id}
+            changed.append(("updated", db_budget))
+
+    try:
+        db.flush()
+        for action, db_budget in changed:
+            record_event(db, user_id, "budget", action, db_budget.budget_id,
+                         row_data(db_budget) if action != "deleted" else None)
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail="Batch conflicts with concurrent changes")
+
+    for index, db_budget in created:
+        results[index] = {"index": index,
+                          "status": "created", "id": db_budget.budget_id}
+
+    # Delete the budget from cache
     cache_key = f"{BUDGET_PREIFX}{user_id}"
-    cached_data = cache_client.get(cache_key)
+    cache_client.delete_key(cache_key)
+    forget_spent(cache_client, user_id, [db_budget.budget_id for action, db_budget in changed
+                                         if action != "created"])
+    cache_client.bump_versions(user_id, "budgets")
 
-    if cached_data:
-        return json.loads(cached_data)
+    return {"results": results}
 
-    budgets = db.query(BudgetModel).filter(
-        BudgetModel.user_id == user_id).all()
 
-    if not budgets:
+@router.get("/{user_id}/budgets/", response_model=List[BudgetInDB])
+def get_budgets(
+    user_id: int,
+    etag: Optional[str] = Depends(conditional_get("budgets")),
+    current_user: UserOut = Depends(has_access),
+    cache_client: RedisCache = Depends(get_cache),
+    db: Session = Depends(get_db)
+):
+    # Check if the current user is the same as the user requested
+    if current_user.id != user_id:
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="Budgets not found")
+            status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+    def load_budgets():
+        budgets = fetch_rows(db, select_budgets(
+            BudgetModel.user_id == user_id), BudgetRow)
 
-    budget_ = jsonable_encoder(budgets)
-    cache_client.set_(cache_key, json.dumps(budget_))
+        if not budgets:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Budgets not found")
 
-    return budgets
+        return rows_to_json(budgets)
+
+    # The cached JSON is already in response shape, send it as is
+    cache_key = f"{BUDGET_PREIFX}{user_id}"
+    return set_etag(RowsResponse(cache_client.get_or_compute(cache_key, load_budgets)), etag)
 
 
 @router.get("/{user_id}/accounts/{account_id}/budgets/{budget_id}/progress")
@@ -121,6 +247,9 @@ def get_budget_progress(
     user_id: int,
     account_id: int,
     budget_id: int,
+    response: Response,
+    etag: Optional[str] = Depends(conditional_get("budgets", "expenses")),
+    cache_client: RedisCache = Depends(get_cache),
     db: Session = Depends(get_db),
     current_user: UserOut = Depends(has_access)
 ):
@@ -129,22 +258,20 @@ def get_budget_progress(
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
 
-    budget = db.query(BudgetModel).filter(
-        BudgetModel.user_id == user_id,
-        BudgetModel.account_id == account_id,
-        BudgetModel.budget_id == budget_id
-    ).first()
+    set_etag(response, etag)
+
+    budget = queries.account_budget(db, user_id, account_id, budget_id)
 
     if not budget:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Budget not found")
 
-    expenses_sum = db.query(func.sum(ExpenseModel.amount)).filter(
-        ExpenseModel.user_id == user_id,
-        ExpenseModel.account_id == account_id,
-        ExpenseModel.date >= budget.start_date,
-        ExpenseModel.date <= budget.end_date,
-    ).scalar() or 0.00
+    expenses_sum = queries.budget_spent(
+        db, user_id, account_id, budget.start_date, budget.end_date)
+
+    if needs_archive(db, cache_client, budget.start_date):
+        expenses_sum += queries.archived_budget_spent(
+            db, user_id, account_id, budget.start_date, budget.end_date)
 
     progress_percent = round((expenses_sum / budget.amount) * 100, 2)
 
@@ -157,3 +284,21 @@ def get_budget_progress(
         "expenses_sum": expenses_sum,
         "progress_percent": progress_percent,
     }
+
+
+@router.get("/{user_id}/budgets/alerts")
+def get_budget_alerts(
+    user_id: int,
+    current_user: UserOut = Depends(has_access),
+    cache_client: RedisCache = Depends(get_cache)
+):
+    """
+    Recent budget threshold alerts, newest first.
+    """
+    if current_user.id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+    alerts = cache_client.call(lambda: cache_client.redis_client.lrange(
+        f"{BUDGET_ALERTS_PREFIX}{user_id}", 0, -1), lambda: [])
+    return [json.loads(alert) for alert in alerts]
@@ -0,0 +1,163 @@
+from typing import List
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from .auth import has_access
+from utils import get_db, get_cache, RedisCache
+from utils.categories import category_interner
+from utils.outbox import record_event, row_data
+from models import Category as CategoryModel, Expense as ExpenseModel, ExpenseArchive, RecurringExpense
+from utils.schemas import CategoryCreate, CategoryOutDB, UserOut
+
+router = APIRouter()
+
+
+@router.post("/{user_id}/categories/", response_model=CategoryOutDB)
+def create_category(
+    user_id: int,
+    category: CategoryCreate,
+    current_user: UserOut = Depends(has_access),
+    db: Session = Depends(get_db)
+):
+    # Check if the current user is the same as the user requested
+    if current_user.id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+    db_category = CategoryModel(**category.dict(), user_id=user_id)
+    db.add(db_category)
+    try:
+        db.flush()
+        record_event(db, user_id, "category", "created",
+                     db_category.category_id, row_data(db_category))
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Category already exists")
+    db.refresh(db_category)
+
+    return db_category
+
+
+@router.get("/{user_id}/categories/", response_model=List[CategoryOutDB])
+def get_categories(
+    user_id: int,
+    current_user: UserOut = Depends(has_access),
+    db: Session = Depends(get_db)
+):
+    # Check if the current user is the same as the user requested
+    if current_user.id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+    categories = db.query(CategoryModel).filter(
+        CategoryModel.user_id == user_id).order_by(CategoryModel.category_name).all()
+
+    if not categories:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Categories not found")
+
+    return categories
+
+
+@router.get("/{user_id}/categories/{category_id}", response_model=CategoryOutDB)
+def get_category(
+    user_id: int,
+    category_id: int,
+    current_user: UserOut = Depends(has_access),
+    db: Session = Depends(get_db)
+):
+    # Check if the current user is the same as the user requested
+    if current_user.id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+    category = db.query(CategoryModel).filter(
+        CategoryModel.category_id == category_id, CategoryModel.user_id == user_id).first()
+
+    if not category:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Category not found")
+
+    return category
+
+
+@router.put("/{user_id}/categories/{category_id}", response_model=CategoryOutDB)
+def update_category(
+    user_id: int,
+    category_id: int,
+    category: CategoryCreate,
+    current_user: UserOut = Depends(has_access),
+    cache: RedisCache = Depends(get_cache),
+    db: Session = Depends(get_db)
+):
+    # Check if the current user is the same as the user requested
+    if current_user.id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+    db_category = db.query(CategoryModel).filter(
+        CategoryModel.category_id == category_id, CategoryModel.user_id == user_id).first()
+
+    if not db_category:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Category not found")
+
+    old_name = db_category.category_name
+    db_category.category_name = category.category_name
+    record_event(db, user_id, "category", "updated",
+                 category_id, row_data(db_category))
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Category already exists")
+    db.refresh(db_category)
+
+    category_interner.forget(user_id, old_name)
+    # expenses are returned with their category name
+    cache.bump_versions(user_id, "expenses")
+
+    return db_category
+
+
+@router.delete("/{user_id}/categories/{category_id}")
+def delete_category(
+    user_id: int,
+    category_id: int,
+    current_user: UserOut = Depends(has_access),
+    db: Session = Depends(get_db)
+):
+    # Check if the current user is the same as the user requested
+    if current_user.id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+    db_category = db.query(CategoryModel).filter(
+        CategoryModel.category_id == category_id, CategoryModel.user_id == user_id).first()
+
+    if not db_category:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Category not found")
+
+    in_use = db.query(ExpenseModel.expense_id).filter(
+        ExpenseModel.category_id == category_id).first()
+    if not in_use:
+        in_use = db.query(ExpenseArchive.expense_id).filter(
+            ExpenseArchive.category_id == category_id).first()
+    if not in_use:
+        in_use = db.query(RecurringExpense.recurring_id).filter(
+            RecurringExpense.category_id == category_id).first()
+    if in_use:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Category is used by expenses")
+
+    db.delete(db_category)
+    record_event(db, user_id, "category", "deleted", category_id)
+    db.commit()
+
+    category_interner.forget(user_id, db_category.category_name)
+
+    return {"message": "Category deleted successfully"}
@@ -0,0 +1,55 @@
+import zlib
+from typing import Optional
+from fastapi import Depends, Request
+from utils import get_cache, RedisCache
+from utils.schemas import UserOut
+from .auth import has_access
+
+
+class NotModified(Exception):
+    def __init__(self, etag: str):
+        self.etag = etag
+
+
+def conditional_get(*resources: str):
+    """
+    Dependency answering If-None-Match from per-user data versions.
+
+    It runs after has_access (resolved once per request) and before the
+    handler: on a match it raises NotModified before the handler's queries
+    run. Otherwise it returns the ETag for the response. The versions are
+    read before the response is computed, so a change made meanwhile gives
+    the next request a new ETag rather than a stale match.
+    """
+
+    def dependency(
+        user_id: int,
+        request: Request,
+        current_user: UserOut = Depends(has_access),
+        cache: RedisCache = Depends(get_cache)
+    ) -> Optional[str]:
+        # requests for someone else take the normal path and get their 403
+        if current_user.id != user_id:
+            return None
+
+        versions = cache.get_versions(user_id, *resources)
+        url = f"{request.url.path}?{request.url.query}".encode()
+        etag = 'W/"%s.%08x"' % (
+            ".".join(str(version) for version in versions), zlib.crc32(url))
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            tags = {tag.strip() for tag in if_none_match.split(",")}
+            if etag in tags:
+                raise NotModified(etag)
+
+        return etag
+
+    return dependency
+
+
+def set_etag(response, etag: Optional[str]):
+    if etag is not None:
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
@@ -1,11 +1,21 @@
 from datetime import date
 from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Response
+from sqlalchemy import union_all
 from sqlalchemy.orm import Session
 from .auth import has_access
-from utils import get_db
-from models import Expense as ExpenseModel, Account as AccountModel
-from utils.schemas import ExpenseCreate, ExpenseInDB, UserOut
+from .conditional import conditional_get, set_etag
+from utils import get_db, get_cache, RedisCache, budget_alert_task, spending_backfill_task
+from models import Expense as ExpenseModel, ExpenseArchive, Account as AccountModel
+from utils.schemas import ExpenseCreate, ExpenseInDB, ExpenseSearchResult, UserOut
+from utils.search import search_expenses
+from utils.categories import category_interner
+from utils.archive import needs_archive
+from utils.budget_index import budget_index
+from utils.spending import SpendingModel
+from utils import queries
+from utils.outbox import record_event, row_data
+from utils.projections import ExpenseRow, RowsResponse, fetch_rows, select_expenses
 
 router = APIRouter()
 
@@ -14,6 +24,7 @@ router = APIRouter()
 def create_expense(
     user_id: int,
     expense: ExpenseCreate,
+    cache: RedisCache = Depends(get_cache),
     db: Session = Depends(get_db),
     current_user: UserOut = Depends(has_access)
 ):
@@ -28,20 +39,40 @@ def create_expense(
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid account ID")
 
-    total_expense = db.query(ExpenseModel).filter(
-        ExpenseModel.account_id == expense.account_id).all()
-    total_expense = sum([expense.amount for expense in total_expense])
+    total_expense = queries.account_spent(db, expense.account_id)
+    total_expense += queries.archived_account_spent(db, expense.account_id)
     if total_expense + expense.amount > account.balance:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Expense amount exceeds account balance")
 
-    expense_data = expense.dict()
+    expense_data = expense.dict(exclude={"category"})
     expense_data['user_id'] = user_id
+    expense_data['category_id'] = category_interner.intern(
+        db, user_id, expense.category)
     db_expense = ExpenseModel(**expense_data)
 
     db.add(db_expense)
+    db.flush()
+    record_event(db, user_id, "expense", "created",
+                 db_expense.expense_id, row_data(db_expense))
     db.commit()
     db.refresh(db_expense)
+
+    cache.bump_versions(user_id, "expenses")
+
+    # running budget totals, alerting on the thresholds this expense crossed
+    for alert in budget_index.record_expense(
+            db, cache, user_id, db_expense.account_id, db_expense.expense_id,
+            db_expense.date, db_expense.amount):
+        budget_alert_task.delay(alert)
+
+    if not SpendingModel(cache).record_expense(
+            user_id, db_expense.account_id, db_expense.expense_id,
+            db_expense.category_id, db_expense.date, db_expense.amount):
+        # no statistics yet: build them off the request path
+        spending_backfill_task.delay(
+            user_id, db_expense.account_id, db_expense.expense_id)
+
     return db_expense
 
 
@@ -52,7 +83,9 @@ def get_expenses(
     end_date: Optional[date] = None,
     account_id: Optional[int] = None,
     category: Optional[str] = None,
+    etag: Optional[str] = Depends(conditional_get("expenses")),
     current_user: UserOut = Depends(has_access),
+    cache: RedisCache = Depends(get_cache),
     db: Session = Depends(get_db)
 ):
     # Check if the current user is the same as the user requested
@@ -60,19 +93,67 @@ def get_expenses(
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
 
-    filter_args = [ExpenseModel.user_id == user_id]
-    if start_date:
-        filter_args.append(ExpenseModel.date >= start_date)
-    if end_date:
-        filter_args.append(ExpenseModel.date <= end_date)
-    if account_id:
-        filter_args.append(ExpenseModel.account_id == account_id)
+    category_id = None
     if category:
-        filter_args.append(ExpenseModel.category == category)
+        category_id = category_interner.lookup(db, user_id, category)
+        if category_id is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Expenses not found")
+
+    def filter_args(model):
+        args = [model.user_id == user_id]
+        if start_date:
+            args.append(model.date >= start_date)
+        if end_date:
+            args.append(model.date <= end_date)
+        if account_id:
+            args.append(model.account_id == account_id)
+        if category_id is not None:
+            args.append(model.category_id == category_id)
+        return args
 
-    expenses = db.query(ExpenseModel).filter(*filter_args).all()
+    statement = select_expenses(*filter_args(ExpenseModel))
+    # older rows live in the archive, only read it when the range reaches back that far
+    if needs_archive(db, cache, start_date):
+        statement = union_all(statement, select_expenses(
+            *filter_args(ExpenseArchive), model=ExpenseArchive))
+
+    expenses = fetch_rows(db, statement, ExpenseRow)
     if not expenses:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Expenses not found")
 
-    return expenses
+    return set_etag(RowsResponse(expenses), etag)
+
+
+@router.get("/{user_id}/expenses/search", response_model=ExpenseSearchResult)
+def search(
+    user_id: int,
+    response: Response,
+    q: Optional[str] = Query(None, max_length=200),
+    min_amount: Optional[float] = Query(None, ge=0.00),
+    max_amount: Optional[float] = Query(None, ge=0.00),
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    etag: Optional[str] = Depends(conditional_get("expenses")),
+    current_user: UserOut = Depends(has_access),
+    db: Session = Depends(get_db)
+):
+    """
+    Full-text search over expense notes within an amount range, best match first.
+    """
+    # Check if the current user is the same as the user requested
+    if current_user.id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+    try:
+        results, next_cursor = search_expenses(
+            db, user_id, q, min_amount, max_amount, limit, cursor)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+    set_etag(response, etag)
+
+    return {"results": results, "next_cursor": next_cursor}
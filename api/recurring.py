@@ -0,0 +1,115 @@
+from typing import List
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.orm import Session
+from .auth import has_access
+from utils import get_db
+from utils.categories import category_interner
+from utils.outbox import record_event, row_data
+from utils.recurring import next_occurrence
+from models import RecurringExpense as RecurringExpenseModel, Account as AccountModel
+from utils.schemas import RecurringExpenseCreate, RecurringExpenseInDB, UserOut
+
+router = APIRouter()
+
+
+@router.post("/{user_id}/recurring/", response_model=RecurringExpenseInDB)
+def create_recurring_expense(
+    user_id: int,
+    recurring: RecurringExpenseCreate,
+    current_user: UserOut = Depends(has_access),
+    db: Session = Depends(get_db)
+):
+    """
+    Create an expense repeated on an RRULE schedule. Occurrences are added
+    by the recurring expenses job from start_date on.
+    """
+
+    # Check if the current user is the same as the user requested
+    if current_user.id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+    account = db.query(AccountModel.account_id).filter(
+        AccountModel.account_id == recurring.account_id, AccountModel.user_id == user_id).first()
+    if not account:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid account ID")
+
+    if recurring.end_date is not None and recurring.start_date > recurring.end_date:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Start date should be less than end date")
+
+    try:
+        next_date = next_occurrence(
+            recurring.rrule, recurring.start_date, recurring.end_date, recurring.start_date)
+    except (ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid recurrence rule")
+    if next_date is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Recurrence rule has no occurrences")
+
+    recurring_data = recurring.dict(exclude={"category"})
+    recurring_data["user_id"] = user_id
+    recurring_data["category_id"] = category_interner.intern(
+        db, user_id, recurring.category)
+    db_recurring = RecurringExpenseModel(
+        **recurring_data, next_date=next_date, active=True)
+
+    db.add(db_recurring)
+    db.flush()
+    record_event(db, user_id, "recurring_expense", "created",
+                 db_recurring.recurring_id, row_data(db_recurring))
+    db.commit()
+    db.refresh(db_recurring)
+    return db_recurring
+
+
+@router.get("/{user_id}/recurring", response_model=List[RecurringExpenseInDB])
+def get_recurring_expenses(
+    user_id: int,
+    current_user: UserOut = Depends(has_access),
+    db: Session = Depends(get_db)
+):
+    # Check if the current user is the same as the user requested
+    if current_user.id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+    recurring = db.query(RecurringExpenseModel).filter(
+        RecurringExpenseModel.user_id == user_id).order_by(RecurringExpenseModel.recurring_id).all()
+
+    if not recurring:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Recurring expenses not found")
+
+    return recurring
+
+
+@router.delete("/{user_id}/recurring/{recurring_id}")
+def delete_recurring_expense(
+    user_id: int,
+    recurring_id: int,
+    current_user: UserOut = Depends(has_access),
+    db: Session = Depends(get_db)
+):
+    """
+    Stop a recurring expense. Occurrences already added are kept.
+    """
+
+    # Check if the current user is the same as the user requested
+    if current_user.id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+    db_recurring = db.query(RecurringExpenseModel).filter(
+        RecurringExpenseModel.recurring_id == recurring_id, RecurringExpenseModel.user_id == user_id).first()
+    if not db_recurring:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Recurring expense not found")
+
+    db.delete(db_recurring)
+    record_event(db, user_id, "recurring_expense", "deleted", recurring_id)
+    db.commit()
+
+    return {"message": "Recurring expense deleted successfully"}
@@ -1,12 +1,18 @@
+import os
 import uuid
 import json
+import asyncio
 import constants
 from datetime import datetime, date
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, FileResponse, Response
 from sqlalchemy.orm import Session
-from .auth import has_access
+from .auth import has_access, get_user_from_token
 from utils.schemas import UserOut
-from utils import get_db, get_cache, RedisCache, generate_report_task
+from utils import get_db, get_cache, RedisCache, dispatch_reports
+from utils.pubsub import report_status_hub
+from utils.report_store import ReportStore, REPORT_TTL, TIER_FILE
+from utils.scheduler import ReportScheduler, USER_LIMITED, QUEUE_FULL, UNAVAILABLE, REPORT_RETRY_AFTER
 from typing import Optional
 import pandas as pd
 from io import StringIO
@@ -18,9 +24,14 @@ router = APIRouter()
 
 REDIS_KEY_PREFIX = constants.REDIS_KEY_PREFIX
 
+# seconds between keep-alive comments on idle report status streams
+REPORT_STREAM_KEEPALIVE = int(os.getenv("REPORT_STREAM_KEEPALIVE", 15))
+
+FINAL_REPORT_STATUSES = ("success", "error")
+
 
 @router.get("/{user_id}/reports/")
-async def generate_report(user_id: int, current_user: UserOut = Depends(has_access), cache_client: RedisCache = Depends(get_cache), db: Session = Depends(get_db)):
+def generate_report(user_id: int, current_user: UserOut = Depends(has_access), cache_client: RedisCache = Depends(get_cache), db: Session = Depends(get_db)):
     # get user's accounts
 
     if current_user.id != user_id:
@@ -29,25 +40,53 @@ async def generate_report(user_id: int, current_user: UserOut = Depends(has_acce
 
     report_id = str(uuid.uuid4())
     REDIS_KEY = f"{REDIS_KEY_PREFIX}{report_id}"
-    redis_value = json.dumps({"status": "started"})
-    cache_client.set_(REDIS_KEY, redis_value, expiration_time=60 * 60 * 24)
+    # written before admission, a dispatcher elsewhere may run the report at once
+    redis_value = json.dumps({"status": "started", "user_id": user_id})
+    cache_client.set_(REDIS_KEY, redis_value, expiration_time=REPORT_TTL)
+
+    scheduler = ReportScheduler(cache_client)
+    admission = scheduler.admit(user_id, report_id)
+    if admission in (USER_LIMITED, QUEUE_FULL, UNAVAILABLE):
+        cache_client.delete_key(REDIS_KEY)
+
+    if admission == USER_LIMITED:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many reports in progress",
+            headers={"Retry-After": str(REPORT_RETRY_AFTER)})
+    if admission == QUEUE_FULL:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Report queue is full",
+            headers={"Retry-After": str(scheduler.retry_after())})
+    if admission == UNAVAILABLE:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Report queue is unavailable",
+            headers={"Retry-After": str(REPORT_RETRY_AFTER)})
 
-    generate_report_task.delay(user_id, report_id)
+    dispatch_reports(cache_client)
 
     return {
         "report_id": report_id,
     }
 
 
-@router.get("/{user_id}/reports/{report_id}")
-async def get_report(user_id: int, report_id: str, current_user: UserOut = Depends(has_access), cache_client: RedisCache = Depends(get_cache)):
+def _report_status(report_id: str, user_id: int, cached_report) -> dict:
+    if cached_report is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Report not found")
 
-    if current_user.id != user_id:
+    report_data_redis = json.loads(cached_report)
+
+    # every status, from the queued one on, records the report's owner
+    if report_data_redis.get("user_id") != user_id:
         raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+            status_code=status.HTTP_404_NOT_FOUND, detail="Report not found")
+
+    return report_data_redis
 
-    REDIS_KEY = f"{REDIS_KEY_PREFIX}{report_id}"
-    report_data_redis = json.loads(cache_client.get(REDIS_KEY))
+
+def _report_response(report_id: str, user_id: int, cache_client: RedisCache) -> dict:
+    report_data_redis = _report_status(
+        report_id, user_id, cache_client.get(f"{REDIS_KEY_PREFIX}{report_id}"))
 
     report_status = report_data_redis.get("status", "error")
     report_data = report_data_redis.get("report_data", None)
@@ -57,9 +96,133 @@ async def get_report(user_id: int, report_id: str, current_user: UserOut = Depen
             "status": "running",
             "report_id": report_id,
         }
-    else:
-        return {
-            "status": report_status,
-            "report_id": report_id,
-            "report_data": report_data,
-        }
+
+    if "tier" in report_data_redis:
+        report = ReportStore(cache_client).load(report_id, report_data_redis)
+        if report is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Report not found")
+        return report
+
+    return {
+        "status": report_status,
+        "report_id": report_id,
+        "report_data": report_data,
+    }
+
+
+async def _report_events(report_id: str, user_id: int, cache_client: RedisCache):
+    """
+    Yield report status events until the report reaches a final status.
+
+    The listener is registered before the stored status is read, so a
+    completion published in between is never missed.
+    """
+    async with report_status_hub.listen(report_id) as queue:
+        report = _report_response(report_id, user_id, cache_client)
+        yield report
+        if report["status"] in FINAL_REPORT_STATUSES:
+            return
+
+        while True:
+            try:
+                message = await asyncio.wait_for(queue.get(), REPORT_STREAM_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+
+            event = json.loads(message)
+            if event["status"] in FINAL_REPORT_STATUSES:
+                yield _report_response(report_id, user_id, cache_client)
+                return
+            yield event
+
+
+@router.get("/{user_id}/reports/{report_id}")
+async def get_report(user_id: int, report_id: str, request: Request, current_user: UserOut = Depends(has_access), cache_client: RedisCache = Depends(get_cache)):
+
+    if current_user.id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+    REDIS_KEY = f"{REDIS_KEY_PREFIX}{report_id}"
+    report_data_redis = _report_status(
+        report_id, user_id, cache_client.get(REDIS_KEY))
+
+    # Stored reports are already deflate encoded, hand them over as they are
+    if "tier" in report_data_redis and "deflate" in request.headers.get("accept-encoding", ""):
+        store = ReportStore(cache_client)
+        headers = {"Content-Encoding": "deflate", "Vary": "Accept-Encoding"}
+
+        if report_data_redis["tier"] == TIER_FILE:
+            path = store.file_path(report_id)
+            if path is not None:
+                return FileResponse(path, media_type="application/json", headers=headers)
+        else:
+            blob = store.read_compressed(report_id)
+            if blob is not None:
+                return Response(content=blob, media_type="application/json", headers=headers)
+
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Report not found")
+
+    return _report_response(report_id, user_id, cache_client)
+
+
+@router.get("/{user_id}/reports/{report_id}/events")
+async def stream_report_status(user_id: int, report_id: str, current_user: UserOut = Depends(has_access), cache_client: RedisCache = Depends(get_cache)):
+    """
+    Stream report status as Server-Sent Events until the report is done.
+    """
+
+    if current_user.id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+    # fail fast with a plain 404 instead of an empty stream
+    _report_status(report_id, user_id, cache_client.get(
+        f"{REDIS_KEY_PREFIX}{report_id}"))
+
+    async def event_stream():
+        async for event in _report_events(report_id, user_id, cache_client):
+            if event is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: {event['status']}\ndata: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.websocket("/{user_id}/reports/{report_id}/ws")
+async def report_status_websocket(websocket: WebSocket, user_id: int, report_id: str, token: str = Query(...), cache_client: RedisCache = Depends(get_cache), db: Session = Depends(get_db)):
+    """
+    Push report status over a WebSocket; browsers cannot set an
+    Authorization header here, so the bearer token comes as a query param.
+    """
+
+    try:
+        current_user = get_user_from_token(token, db)
+    except HTTPException:
+        current_user = None
+    finally:
+        db.close()
+
+    if current_user is None or current_user.id != user_id:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    try:
+        async for event in _report_events(report_id, user_id, cache_client):
+            if event is not None:
+                await websocket.send_json(event)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    except WebSocketDisconnect:
+        return
+    await websocket.close()
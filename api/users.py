@@ -1,7 +1,14 @@
+import json
+import uuid
+from datetime import datetime
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
 from sqlalchemy import or_
 from utils.db import get_db
+from utils import get_cache, RedisCache, purge_user_task
+from utils.tasks import PURGE_PREFIX, set_purge_status
+from utils.categories import category_interner
+from utils.outbox import record_event
 from models.users import User
 from utils.schemas import UserIn, UserInDB, UserOut, UserUpdate
 from .auth import get_hashed_password, has_access
@@ -22,6 +29,9 @@ def create_user(user: UserIn, db: Session = Depends(get_db)):
                    hashed_password=hashed_password)
 
     db.add(db_user)
+    db.flush()
+    record_event(db, db_user.id, "user", "created", db_user.id,
+                 {"username": db_user.username, "email": db_user.email})
     db.commit()
     db.refresh(db_user)
     return UserOut.from_orm(db_user)
@@ -91,20 +101,26 @@ def update_user(
     db_user.username = user.username
     db_user.email = user.email
 
+    record_event(db, user_id, "user", "updated", user_id,
+                 {"username": db_user.username, "email": db_user.email})
     db.commit()
     db.refresh(db_user)
 
     return db_user
 
 
-@router.delete("/users/{user_id}")
+@router.delete("/users/{user_id}", status_code=status.HTTP_202_ACCEPTED)
 def delete_user(
     user_id: int,
     current_user: UserOut = Depends(has_access),
+    cache: RedisCache = Depends(get_cache),
     db: Session = Depends(get_db)
 ):
     """
     Delete the current user.
+
+    The user is marked deleted, which revokes their tokens, and their data
+    is purged in the background. Progress is at /users/purges/{purge_id}.
     """
     # Check if the current user is the same as the user requested
     if current_user.id != user_id:
@@ -118,8 +134,31 @@ def delete_user(
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
-    # Delete the user
-    db.delete(db_user)
+    db_user.deleted_at = datetime.utcnow()
+    record_event(db, user_id, "user", "deleted", user_id)
     db.commit()
 
-    return {"message": "User deleted successfully"}
+    category_interner.forget_user(user_id)
+
+    # change every ETag so cached responses stop validating
+    cache.bump_versions(user_id, "accounts", "budgets", "expenses")
+
+    purge_id = str(uuid.uuid4())
+    set_purge_status(cache, purge_id, user_id, "pending", {})
+    purge_user_task.delay(user_id, purge_id)
+
+    return {"message": "User deletion started", "purge_id": purge_id}
+
+
+@router.get("/users/purges/{purge_id}")
+def get_purge(purge_id: str, cache: RedisCache = Depends(get_cache)):
+    """
+    Progress of a user purge. The purge id is only given to the deleted
+    user, whose token no longer works, so it is not behind has_access.
+    """
+    purge = cache.get(f"{PURGE_PREFIX}{purge_id}")
+    if purge is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Purge not found")
+
+    return json.loads(purge)
@@ -0,0 +1,91 @@
+"""
+Per-call cost of the hot-path lookups in utils/queries.py against the
+Query API they replaced.
+
+    python -m benchmarks.lambda_statements
+
+Runs on a throwaway SQLite database and needs no Redis or Celery.
+"""
+import os
+import tempfile
+import time
+from datetime import date
+
+os.environ["SQLALCHEMY_DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+
+from sqlalchemy import func  # noqa: E402
+from utils import queries  # noqa: E402
+from utils.db import SessionLocal, create_database  # noqa: E402
+from models import User, Account, Budget, Expense, ExpenseArchive  # noqa: E402
+
+# calls per timed run
+CALLS = int(os.getenv("BENCH_CALLS", 5000))
+# timed runs per case, the fastest is reported
+REPEAT = 3
+WARMUP = 300
+
+START, END = date(2026, 1, 1), date(2026, 12, 31)
+
+
+def seed(db) -> None:
+    db.add(User(username="bench", email="bench@example.com", hashed_password="x"))
+    db.commit()
+    db.add(Account(user_id=1, account_name="main", balance=100))
+    db.commit()
+    db.add(Budget(user_id=1, account_id=1, amount=10, start_date=START, end_date=END))
+    db.add_all([Expense(user_id=1, account_id=1, amount=1, date=START) for _ in range(20)])
+    db.commit()
+
+
+def cases(db) -> dict:
+    """name -> (Query API version, cached lambda statement version)"""
+    return {
+        "has_access user lookup": (
+            lambda: db.query(User).filter(User.email == "bench@example.com").first(),
+            lambda: queries.user_by_email(db, "bench@example.com")),
+        "account ownership": (
+            lambda: db.query(Account).filter(Account.account_id == 1, Account.user_id == 1).first(),
+            lambda: queries.owned_account(db, 1, 1)),
+        "budget progress": (
+            lambda: (db.query(Budget).filter(Budget.user_id == 1, Budget.account_id == 1,
+                                             Budget.budget_id == 1).first(),
+                     db.query(func.sum(Expense.amount)).filter(
+                         Expense.user_id == 1, Expense.account_id == 1,
+                         Expense.date >= START, Expense.date <= END).scalar()),
+            lambda: (queries.account_budget(db, 1, 1, 1),
+                     queries.budget_spent(db, 1, 1, START, END))),
+        "create_expense balance check": (
+            lambda: (sum(expense.amount for expense in db.query(Expense).filter(
+                Expense.account_id == 1).all()),
+                db.query(func.sum(ExpenseArchive.amount)).filter(
+                    ExpenseArchive.account_id == 1).scalar()),
+            lambda: (queries.account_spent(db, 1), queries.archived_account_spent(db, 1))),
+    }
+
+
+def per_call(fn) -> float:
+    """Best CPU time of one call in microseconds"""
+    for _ in range(WARMUP):
+        fn()
+    best = None
+    for _ in range(REPEAT):
+        started = time.process_time()
+        for _ in range(CALLS):
+            fn()
+        elapsed = (time.process_time() - started) / CALLS * 1e6
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main() -> None:
+    create_database()
+    with SessionLocal() as db:
+        seed(db)
+        for name, (legacy, cached) in cases(db).items():
+            before, after = per_call(legacy), per_call(cached)
+            print(f"{name:30s} query {before:7.1f} us  lambda {after:7.1f} us  "
+                  f"saved {before - after:6.1f} us ({(1 - after / before) * 100:4.1f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Time and peak memory per row of listing expenses: ORM entities through
+FastAPI's response_model against the column projections of
+utils/projections.py.
+
+    python -m benchmarks.row_projections
+
+Runs on a throwaway SQLite database and needs no Redis or Celery.
+"""
+import os
+import json
+import asyncio
+import tempfile
+import time
+import tracemalloc
+from datetime import date
+from typing import List
+
+os.environ["SQLALCHEMY_DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+
+from fastapi.routing import serialize_response  # noqa: E402
+from fastapi.utils import create_response_field  # noqa: E402
+from utils.db import SessionLocal, create_database  # noqa: E402
+from utils.projections import ExpenseRow, fetch_rows, rows_to_json, select_expenses  # noqa: E402
+from utils.schemas import ExpenseInDB  # noqa: E402
+from models import User, Account, Category, Expense  # noqa: E402
+
+# expenses listed per call
+ROWS = int(os.getenv("BENCH_ROWS", 20000))
+
+response_field = create_response_field(name="response", type_=List[ExpenseInDB])
+
+
+def seed() -> int:
+    with SessionLocal() as db:
+        user = User(username="bench", email="bench@example.com", hashed_password="x")
+        db.add(user)
+        db.flush()
+        account = Account(user_id=user.id, account_name="main", balance=1e9)
+        category = Category(user_id=user.id, category_name="travel")
+        db.add_all([account, category])
+        db.flush()
+        db.execute(Expense.__table__.insert(), [{
+            "user_id": user.id, "account_id": account.account_id, "category_id": category.category_id,
+            "amount": i + 1, "date": date(2023, 1, 1), "notes": "note"} for i in range(ROWS)])
+        db.commit()
+        return user.id
+
+
+def orm(user_id: int) -> str:
+    with SessionLocal() as db:
+        expenses = db.query(Expense).filter(Expense.user_id == user_id).all()
+        body = asyncio.run(serialize_response(
+            field=response_field, response_content=expenses, is_coroutine=False))
+        return json.dumps(body)
+
+
+def projection(user_id: int) -> str:
+    with SessionLocal() as db:
+        return rows_to_json(fetch_rows(db, select_expenses(Expense.user_id == user_id), ExpenseRow))
+
+
+def main() -> None:
+    create_database()
+    user_id = seed()
+    for listing in (orm, projection):
+        listing(user_id)
+        started = time.process_time()
+        listing(user_id)
+        elapsed = time.process_time() - started
+
+        tracemalloc.start()
+        listing(user_id)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{listing.__name__:10s} {elapsed / ROWS * 1e6:6.1f} us/row  {peak / ROWS:6.0f} B/row peak")
+
+
+if __name__ == "__main__":
+    main()
@@ -19,3 +19,6 @@ BUDGET_PREFIX = os.getenv('BUDGET_PREFIX', 'budget:')
 
 # account prefix redis key
 ACCOUNT_PREFIX = os.getenv('ACCOUNT_PREFIX', 'account:')
+
+# max operations accepted by the batch endpoints
+BATCH_MAX_OPERATIONS = int(os.getenv('BATCH_MAX_OPERATIONS', 100))
@@ -1,14 +1,28 @@
 import os
 import logging
-from fastapi import FastAPI
+from fastapi import FastAPI, Depends, Request, Response
+from fastapi.responses import JSONResponse
 from utils import db, get_cache
-from api import users, auth, accounts, expenses, budgets, reports
+from utils.pubsub import report_status_hub
+from utils.health import loop_lag_monitor, readiness_check
+from utils.tracing import setup_tracing
+from utils.tasks import scheduled_report_stats
+from utils.report_store import ReportStore
+from utils.scheduler import ReportScheduler
+from utils.search import create_search_index
+from utils.migrations import run_migrations
+from api import users, auth, accounts, expenses, budgets, reports, categories, recurring
+from api.conditional import NotModified
 from celery import Celery
+from celery.schedules import crontab
 
 
 app = FastAPI()
+setup_tracing(app, db.engine)
 
 db.create_database()
+run_migrations()
+create_search_index()
 
 # lazy load redis cache
 get_cache()
@@ -21,7 +35,52 @@ celery_app.autodiscover_tasks()
 # differnet queue for each task
 celery_app.conf.task_routes = {
     'utils.tasks.create_account_task': {'queue': 'short_queue'},
-    'utils.tasks.generate_report_task': {'queue': 'long_queue'}
+    'utils.tasks.generate_report_task': {'queue': 'long_queue'},
+    'utils.tasks.purge_expired_reports_task': {'queue': 'short_queue'},
+    'utils.tasks.dispatch_reports_task': {'queue': 'short_queue'},
+    'utils.tasks.purge_user_task': {'queue': 'long_queue'},
+    'utils.tasks.archive_expenses_task': {'queue': 'long_queue'},
+    'utils.tasks.scheduled_reports_task': {'queue': 'long_queue'},
+    'utils.tasks.budget_alert_task': {'queue': 'short_queue'},
+    'utils.tasks.spending_backfill_task': {'queue': 'short_queue'},
+    'utils.tasks.relay_outbox_task': {'queue': 'short_queue'},
+    'utils.tasks.consume_changes_task': {'queue': 'short_queue'},
+    'utils.tasks.recurring_expenses_task': {'queue': 'long_queue'},
+}
+
+# periodic jobs run by the worker's embedded beat (-B)
+celery_app.conf.beat_schedule = {
+    'purge-expired-reports': {
+        'task': 'utils.tasks.purge_expired_reports_task',
+        'schedule': float(os.environ.get('REPORT_PURGE_INTERVAL', 60 * 60)),
+    },
+    # picks up reports whose dispatch was missed or whose worker died
+    'dispatch-reports': {
+        'task': 'utils.tasks.dispatch_reports_task',
+        'schedule': float(os.environ.get('REPORT_DISPATCH_INTERVAL', 15)),
+    },
+    'archive-expenses': {
+        'task': 'utils.tasks.archive_expenses_task',
+        'schedule': float(os.environ.get('ARCHIVE_INTERVAL', 60 * 60 * 24)),
+    },
+    'recurring-expenses': {
+        'task': 'utils.tasks.recurring_expenses_task',
+        'schedule': float(os.environ.get('RECURRING_INTERVAL', 60 * 60)),
+    },
+    'relay-outbox': {
+        'task': 'utils.tasks.relay_outbox_task',
+        'schedule': float(os.environ.get('OUTBOX_RELAY_INTERVAL', 1)),
+    },
+    # cache and scheduled report consumers of the change stream
+    'consume-changes': {
+        'task': 'utils.tasks.consume_changes_task',
+        'schedule': float(os.environ.get('OUTBOX_CONSUME_INTERVAL', 1)),
+    },
+    # nightly reports, rebuilt only for users with writes since the last run
+    'scheduled-reports': {
+        'task': 'utils.tasks.scheduled_reports_task',
+        'schedule': crontab(hour=os.environ.get('SCHEDULED_REPORT_HOUR', 2), minute=0),
+    },
 }
 
 log_level = os.environ.get('LOG_LEVEL', 'INFO')
@@ -33,9 +92,57 @@ app.include_router(auth.router, prefix="/api", tags=["auth"])
 app.include_router(accounts.router, prefix="/api/users", tags=["accounts"])
 app.include_router(expenses.router, prefix="/api/users", tags=["expenses"])
 app.include_router(budgets.router, prefix="/api/users", tags=["budgets"])
+app.include_router(categories.router, prefix="/api/users", tags=["categories"])
 app.include_router(reports.router, prefix="/api/users", tags=["reports"])
+app.include_router(recurring.router, prefix="/api/users", tags=["recurring"])
+
+
+@app.exception_handler(NotModified)
+async def not_modified(request: Request, exc: NotModified):
+    return Response(status_code=304, headers={"ETag": exc.etag})
+
 
+@app.on_event("startup")
+async def start_report_status_hub():
+    report_status_hub.start()
+    loop_lag_monitor.start()
 
+
+@app.on_event("shutdown")
+async def stop_report_status_hub():
+    await report_status_hub.stop()
+    await loop_lag_monitor.stop()
+
+
+# async so liveness never waits for a request thread
 @app.get("/health")
-def health():
+@app.get("/health/live")
+async def health():
     return {"status": "ok"}
+
+
+@app.get("/health/ready")
+async def readiness():
+    result = await readiness_check.check()
+    status_code = 200 if result["status"] == "ready" else 503
+    return JSONResponse(result, status_code=status_code)
+
+
+@app.get("/stats/reports", dependencies=[Depends(auth.has_access)])
+def report_storage_stats():
+    return ReportStore(get_cache()).stats()
+
+
+@app.get("/stats/report-queue", dependencies=[Depends(auth.has_access)])
+def report_queue_stats():
+    return ReportScheduler(get_cache()).metrics()
+
+
+@app.get("/stats/redis", dependencies=[Depends(auth.has_access)])
+def redis_stats():
+    return get_cache().metrics()
+
+
+@app.get("/stats/scheduled-reports", dependencies=[Depends(auth.has_access)])
+def scheduled_reports_stats():
+    return scheduled_report_stats(get_cache())
@@ -1,4 +1,7 @@
 from .accounts import Account
 from .budgets import Budget
-from .expense import Expense
+from .categories import Category
+from .expense import Expense, ExpenseArchive
 from .users import User
+from .outbox import OutboxEvent
+from .recurring import RecurringExpense
@@ -1,10 +1,14 @@
-from sqlalchemy import DateTime, Column, Integer, String, Float, ForeignKey
+from sqlalchemy import DateTime, Column, Integer, String, Float, ForeignKey, Index
 from sqlalchemy.sql import func
 from utils.db import Base
 
 
 class Account(Base):
     __tablename__ = 'accounts'
+    __table_args__ = (
+        Index('uq_accounts_user_id_account_name',
+              'user_id', 'account_name', unique=True),
+    )
     account_id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey(
         'users.id', ondelete='CASCADE'), nullable=True)
@@ -0,0 +1,17 @@
+from sqlalchemy import Column, Integer, String, ForeignKey, Index
+from utils import Base
+
+
+class Category(Base):
+    __tablename__ = 'categories'
+    __table_args__ = (
+        Index('uq_categories_user_id_category_name',
+              'user_id', 'category_name', unique=True),
+    )
+    category_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'),
+                     nullable=True, index=True)
+    category_name = Column(String(50), nullable=False)
+
+    def __repr__(self):
+        return f'Category: {self.category_name}'
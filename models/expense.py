@@ -1,15 +1,48 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, Date
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Date, Index
+from sqlalchemy.orm import relationship
 from utils import Base
 
 
 class Expense(Base):
     __tablename__ = 'expenses'
+    __table_args__ = (
+        Index('ix_expenses_user_id_amount', 'user_id', 'amount'),
+        # one expense per recurring rule and date
+        Index('uq_expenses_occurrence_key', 'occurrence_key', unique=True),
+    )
     expense_id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey(
         'users.id', ondelete='CASCADE'), nullable=True)
     account_id = Column(Integer, ForeignKey(
         'accounts.account_id', ondelete='CASCADE'), nullable=True)
     amount = Column(Float, nullable=False)
-    category = Column(String(50), nullable=True, index=True)
+    category_id = Column(Integer, ForeignKey(
+        'categories.category_id'), nullable=True, index=True)
     date = Column(Date, nullable=False, index=True)
     notes = Column(String(256), nullable=True)
+    occurrence_key = Column(String(64), nullable=True)
+
+    category_ref = relationship('Category', lazy='joined')
+
+    @property
+    def category(self):
+        return self.category_ref.category_name if self.category_ref else None
+
+
+class ExpenseArchive(Base):
+    """Expenses older than the archive horizon, moved out of the hot table"""
+    __tablename__ = 'expenses_archive'
+    __table_args__ = (
+        Index('ix_expenses_archive_user_id_date', 'user_id', 'date'),
+    )
+    expense_id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, ForeignKey(
+        'users.id', ondelete='CASCADE'), nullable=True)
+    account_id = Column(Integer, ForeignKey(
+        'accounts.account_id', ondelete='CASCADE'), nullable=True, index=True)
+    amount = Column(Float, nullable=False)
+    category_id = Column(Integer, ForeignKey(
+        'categories.category_id'), nullable=True, index=True)
+    date = Column(Date, nullable=False)
+    notes = Column(String(256), nullable=True)
+    occurrence_key = Column(String(64), nullable=True)
@@ -0,0 +1,22 @@
+from sqlalchemy import Column, Integer, String, Text, DateTime, Index
+from sqlalchemy.sql import func
+from utils.db import Base
+
+
+class OutboxEvent(Base):
+    """A change written in the same transaction as the change itself, relayed later"""
+    __tablename__ = 'outbox_events'
+    __table_args__ = (
+        Index('ix_outbox_events_unpublished', 'published_at', 'event_id'),
+    )
+    event_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=True, index=True)
+    entity = Column(String(50), nullable=False)
+    entity_id = Column(Integer, nullable=True)
+    action = Column(String(20), nullable=False)
+    payload = Column(Text, nullable=True)
+    created_at = Column(DateTime, server_default=func.now())
+    published_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'OutboxEvent: {self.entity} {self.action} {self.entity_id}'
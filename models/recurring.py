@@ -0,0 +1,34 @@
+from sqlalchemy import Boolean, Column, Date, DateTime, Float, ForeignKey, Index, Integer, String
+from sqlalchemy.orm import relationship
+from sqlalchemy.sql import func
+from utils import Base
+
+
+class RecurringExpense(Base):
+    """An expense repeated on an RFC 5545 RRULE schedule"""
+    __tablename__ = 'recurring_expenses'
+    __table_args__ = (
+        Index('ix_recurring_expenses_active_next_date', 'active', 'next_date'),
+    )
+    recurring_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey(
+        'users.id', ondelete='CASCADE'), nullable=False, index=True)
+    account_id = Column(Integer, ForeignKey(
+        'accounts.account_id', ondelete='CASCADE'), nullable=False, index=True)
+    category_id = Column(Integer, ForeignKey(
+        'categories.category_id'), nullable=True)
+    amount = Column(Float, nullable=False)
+    notes = Column(String(256), nullable=True)
+    rrule = Column(String(256), nullable=False)
+    start_date = Column(Date, nullable=False)
+    end_date = Column(Date, nullable=True)
+    # first occurrence not materialized yet, None once the schedule ran out
+    next_date = Column(Date, nullable=True)
+    active = Column(Boolean, nullable=False, default=True)
+    created_at = Column(DateTime, server_default=func.now())
+
+    category_ref = relationship('Category', lazy='joined')
+
+    @property
+    def category(self):
+        return self.category_ref.category_name if self.category_ref else None
@@ -10,6 +10,8 @@ class User(Base):
     username = Column(String, unique=True, index=True, nullable=False)
     email = Column(String, unique=True, index=True, nullable=False)
     hashed_password = Column(String, nullable=False)
+    # set when deletion is requested; the purge job removes the row later
+    deleted_at = Column(DateTime, nullable=True)
 
     accounts = relationship('Account', backref='owner',
                             lazy=True, cascade="all, delete-orphan")
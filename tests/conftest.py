@@ -0,0 +1,124 @@
+import os
+import socket
+import tempfile
+import threading
+import uuid
+import pytest
+import redis
+
+# the app reads its configuration at import time
+_workdir = tempfile.mkdtemp(prefix="expenses-tests-")
+os.environ.setdefault("SQLALCHEMY_DATABASE_URL", f"sqlite:///{_workdir}/test.db")
+os.environ.setdefault("CELERY_BROKER_URL", "memory://")
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("REPORT_STORAGE_DIR", os.path.join(_workdir, "reports"))
+# fail fast, so simulated outages and latency stay cheap
+os.environ.setdefault("REDIS_SOCKET_TIMEOUT", "0.2")
+os.environ.setdefault("REDIS_CONNECT_TIMEOUT", "0.2")
+
+from utils.redis import RedisCache, get_cache, REDIS_SOCKET_TIMEOUT, REDIS_CONNECT_TIMEOUT  # noqa: E402
+from utils.breaker import CircuitBreaker, LocalCache  # noqa: E402
+
+
+def redis_at(host: str, port: int) -> redis.Redis:
+    """A client with the app's timeouts"""
+    return redis.Redis(host=host, port=port, socket_timeout=REDIS_SOCKET_TIMEOUT,
+                       socket_connect_timeout=REDIS_CONNECT_TIMEOUT)
+
+
+@pytest.fixture
+def redis_down():
+    """A client for a port nothing listens on: every command is refused"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return redis_at("127.0.0.1", port)
+
+
+@pytest.fixture
+def redis_slow():
+    """A client for a server that accepts connections and never answers"""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(64)
+    connections = []
+
+    def accept():
+        while True:
+            try:
+                connections.append(server.accept()[0])
+            except OSError:
+                return
+    threading.Thread(target=accept, daemon=True).start()
+
+    yield redis_at("127.0.0.1", server.getsockname()[1])
+    server.close()
+    for connection in connections:
+        connection.close()
+
+
+@pytest.fixture(params=["down", "slow"])
+def redis_unavailable(request):
+    """Each test using it runs against a refused and a hanging Redis"""
+    return request.getfixturevalue(f"redis_{request.param}")
+
+
+@pytest.fixture
+def redis_live():
+    """
+    A working Redis: TEST_REDIS_HOST/TEST_REDIS_PORT (the compose redis),
+    else fakeredis when it is installed, else the test is skipped.
+    """
+    client = redis_at(os.getenv("TEST_REDIS_HOST", "localhost"),
+                      int(os.getenv("TEST_REDIS_PORT", 6379)))
+    try:
+        client.ping()
+    except redis.exceptions.RedisError:
+        fakeredis = pytest.importorskip("fakeredis", reason="needs a Redis server")
+        client = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    client.flushdb()
+    yield client
+    client.flushdb()
+
+
+def reset(cache: RedisCache, client: redis.Redis) -> RedisCache:
+    """Point the cache at client with a closed breaker and nothing cached or logged"""
+    cache.redis_client = client
+    cache.breaker = CircuitBreaker(cache.breaker.failure_threshold, cache.breaker.reset_timeout)
+    cache.local = LocalCache(cache.local.maxsize, cache.local.ttl)
+    cache._replay_log.clear()
+    return cache
+
+
+@pytest.fixture
+def app_cache():
+    """The process-wide cache the app uses, restored after the test"""
+    cache = get_cache()
+    client = cache.redis_client
+    yield cache
+    reset(cache, client)
+
+
+@pytest.fixture
+def client():
+    import main
+    from fastapi.testclient import TestClient
+    return TestClient(main.app)
+
+
+def register(client):
+    """Sign up a new user, return its id and auth headers"""
+    email = f"{uuid.uuid4().hex[:12]}@example.com"
+    response = client.post("/api/users/", json={
+        "username": email.split("@")[0], "email": email, "password": "password1"})
+    assert response.status_code == 201, response.text
+    token = client.post("/api/auth/token", data={
+        "email": email, "password": "password1"}).json()["access_token"]
+    return response.json()["id"], {"Authorization": f"Bearer {token}"}
+
+
+@pytest.fixture
+def user(client):
+    """A new user, its id and auth headers; needs no Redis"""
+    return register(client)
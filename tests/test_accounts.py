@@ -0,0 +1,55 @@
+import constants
+from datetime import date
+from models import Account, Budget
+from utils.db import SessionLocal
+from .conftest import reset
+
+
+def test_renaming_onto_another_account_is_refused(client, user, app_cache, redis_live):
+    user_id, headers = user
+    reset(app_cache, redis_live)
+    with SessionLocal() as db:
+        accounts = [Account(user_id=user_id, account_name=name, balance=100) for name in ("main", "savings")]
+        db.add_all(accounts)
+        db.commit()
+        savings_id = accounts[1].account_id
+
+    response = client.put(f"/api/users/{user_id}/accounts/{savings_id}", headers=headers,
+                          json={"account_name": "main", "balance": 100})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Account already exists"
+
+    with SessionLocal() as db:
+        assert db.get(Account, savings_id).account_name == "savings"
+
+
+def test_a_batch_delete_drops_the_cached_budget_list(client, user, app_cache, redis_live):
+    user_id, headers = user
+    reset(app_cache, redis_live)
+    with SessionLocal() as db:
+        accounts = [Account(user_id=user_id, account_name=name, balance=100) for name in ("main", "savings")]
+        db.add_all(accounts)
+        db.flush()
+        db.add_all(Budget(user_id=user_id, account_id=account.account_id, amount=50,
+                          start_date=date(2026, 1, 1), end_date=date(2026, 1, 31)) for account in accounts)
+        db.commit()
+        savings_id = accounts[1].account_id
+
+    assert len(client.get(f"/api/users/{user_id}/budgets/", headers=headers).json()) == 2
+
+    response = client.post(f"/api/users/{user_id}/accounts/batch", headers=headers,
+                           json={"operations": [{"op": "delete", "account_id": savings_id}]})
+    assert response.json()["results"][0]["status"] == "deleted", response.text
+
+    # the cascade to budgets is the database's, the cached list must go with it
+    assert redis_live.get(f"{constants.BUDGET_PREFIX}{user_id}") is None
+
+
+def test_a_batch_over_the_operation_limit_is_rejected_by_the_schema(client, user):
+    user_id, headers = user
+    operations = [{"op": "delete", "account_id": 1}] * (constants.BATCH_MAX_OPERATIONS + 1)
+
+    response = client.post(f"/api/users/{user_id}/accounts/batch", headers=headers,
+                           json={"operations": operations})
+
+    assert response.status_code == 422
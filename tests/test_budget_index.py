@@ -0,0 +1,34 @@
+from datetime import date
+from models import Account, Budget, Expense
+from utils.budget_index import BudgetIndex, BUDGET_SPENT_PREFIX
+from utils.db import SessionLocal
+from utils.redis import RedisCache
+from .conftest import reset
+
+
+def test_an_expense_the_seed_counted_is_not_added_again(user, redis_live):
+    user_id, _ = user
+    cache = reset(RedisCache(), redis_live)
+    with SessionLocal() as db:
+        account = Account(user_id=user_id, account_name="budgeted", balance=1000)
+        db.add(account)
+        db.flush()
+        db.add(Budget(user_id=user_id, account_id=account.account_id, amount=100,
+                      start_date=date(2026, 1, 1), end_date=date(2026, 1, 31)))
+        first = Expense(user_id=user_id, account_id=account.account_id, amount=30.0, date=date(2026, 1, 5))
+        db.add(first)
+        db.commit()
+        account_id, first_id = account.account_id, first.expense_id
+
+        # another process builds the index first, its SUM already counts the expense
+        BudgetIndex().tree(db, cache, user_id, account_id)
+        here = BudgetIndex()
+        here.record_expense(db, cache, user_id, account_id, first_id, date(2026, 1, 5), 30.0)
+
+        second = Expense(user_id=user_id, account_id=account_id, amount=20.0, date=date(2026, 1, 6))
+        db.add(second)
+        db.commit()
+        here.record_expense(db, cache, user_id, account_id, second.expense_id, date(2026, 1, 6), 20.0)
+
+    totals = redis_live.hgetall(f"{BUDGET_SPENT_PREFIX}{user_id}")
+    assert [float(value) for field, value in totals.items() if b":" not in field] == [50.0]
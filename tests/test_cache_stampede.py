@@ -0,0 +1,96 @@
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import event
+from models import Account, User
+from utils.db import SessionLocal, engine, create_database
+from utils.projections import AccountRow, fetch_rows, rows_to_json, select_accounts
+from utils.redis import RedisCache
+from .conftest import reset
+
+CALLERS = 1000
+# API processes sharing one Redis
+PROCESSES = 4
+
+
+def concurrently(caches, call):
+    """call(cache) from CALLERS threads spread over caches, released at once"""
+    start = threading.Barrier(CALLERS)
+
+    def run(i):
+        start.wait()
+        try:
+            return call(caches[i % len(caches)])
+        except Exception as error:
+            return error
+    with ThreadPoolExecutor(max_workers=CALLERS) as executor:
+        return list(executor.map(run, range(CALLERS)))
+
+
+@pytest.fixture
+def caches(redis_live):
+    return [reset(RedisCache(), redis_live) for _ in range(PROCESSES)]
+
+
+@pytest.fixture
+def account_owner():
+    create_database()
+    with SessionLocal() as db:
+        owner = User(username="stampede", email="stampede@example.com", hashed_password="x")
+        db.add(owner)
+        db.flush()
+        db.add_all([Account(user_id=owner.id, account_name=f"account {i}", balance=i)
+                    for i in range(20)])
+        db.commit()
+        owner_id = owner.id
+    yield owner_id
+    with SessionLocal() as db:
+        db.query(Account).filter(Account.user_id == owner_id).delete()
+        db.query(User).filter(User.id == owner_id).delete()
+        db.commit()
+
+
+def test_concurrent_misses_run_one_query(caches, account_owner):
+    queries = []
+
+    def count(conn, cursor, statement, *args):
+        if "FROM accounts" in statement:
+            queries.append(statement)
+    event.listen(engine, "before_cursor_execute", count)
+
+    def load_accounts():
+        with SessionLocal() as db:
+            return rows_to_json(fetch_rows(db, select_accounts(
+                Account.user_id == account_owner), AccountRow))
+    try:
+        results = concurrently(caches, lambda cache: cache.get_or_compute(
+            f"account:{account_owner}", load_accounts))
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+    assert len(queries) == 1
+    assert all(result == results[0] for result in results)
+    assert len(json.loads(results[0])) == 20
+
+
+def test_a_failed_recompute_is_not_retried_by_every_waiter(caches):
+    calls = []
+
+    def missing():
+        calls.append(1)
+        # slow enough for every caller to arrive while it runs
+        time.sleep(0.5)
+        raise HTTPException(status_code=404, detail="Accounts not found")
+    results = concurrently(caches, lambda cache: cache.get_or_compute("account:0", missing))
+
+    assert all(isinstance(result, HTTPException) for result in results)
+    # one holder per process at most, never one per caller
+    assert len(calls) <= PROCESSES
+
+
+def test_entries_in_the_old_format_are_misses(caches, redis_live):
+    redis_live.set("account:1", b'[{"account_id": 1}]')
+    assert caches[0].get_or_compute("account:1", lambda: "[]") == b"[]"
@@ -0,0 +1,23 @@
+from models import Category
+from utils.categories import CategoryInterner
+from utils.db import SessionLocal
+from .conftest import reset
+
+
+def test_a_rename_in_one_process_reaches_the_others(user, app_cache, redis_live):
+    user_id, _ = user
+    reset(app_cache, redis_live)
+    # one interner per API process
+    here, elsewhere = CategoryInterner(), CategoryInterner()
+
+    with SessionLocal() as db:
+        category_id = here.intern(db, user_id, "groceries")
+        assert elsewhere.lookup(db, user_id, "groceries") == category_id
+
+        category = db.get(Category, category_id)
+        category.category_name = "food"
+        db.commit()
+        here.forget(user_id, "groceries")
+
+        assert elsewhere.lookup(db, user_id, "groceries") is None
+        assert elsewhere.intern(db, user_id, "groceries") != category_id
@@ -0,0 +1,21 @@
+from models import Account
+from utils.db import SessionLocal
+from .conftest import reset
+
+
+def test_etags_are_checked_after_the_token(client, user, app_cache, redis_live):
+    user_id, headers = user
+    reset(app_cache, redis_live)
+    with SessionLocal() as db:
+        db.add(Account(user_id=user_id, account_name="main", balance=100))
+        db.commit()
+
+    url = f"/api/users/{user_id}/accounts"
+    etag = client.get(url, headers=headers).headers["ETag"]
+    assert client.get(url, headers={**headers, "If-None-Match": etag}).status_code == 304
+    assert client.get(url, headers={**headers, "If-None-Match": "*"}).status_code == 200
+
+    assert client.delete(f"/api/users/{user_id}", headers=headers).status_code == 202
+    # a deleted user's token is refused whatever the ETag
+    for tag in (etag, "*"):
+        assert client.get(url, headers={**headers, "If-None-Match": tag}).status_code == 401
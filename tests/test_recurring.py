@@ -0,0 +1,69 @@
+from datetime import date, timedelta
+from models import Account, Expense, RecurringExpense
+from utils.db import SessionLocal
+from utils.recurring import materialize_recurring
+from utils.spending import SpendingModel
+from .conftest import reset
+
+
+def add_account(user_id: int) -> int:
+    with SessionLocal() as db:
+        account = Account(user_id=user_id, account_name="recurring", balance=10000)
+        db.add(account)
+        db.commit()
+        return account.account_id
+
+
+def test_rules_repeating_within_a_day_are_refused(client, user):
+    user_id, headers = user
+    response = client.post(f"/api/users/{user_id}/recurring/", headers=headers, json={
+        "account_id": add_account(user_id), "category": "parking", "amount": 1.0,
+        "rrule": "FREQ=HOURLY", "start_date": date.today().isoformat()})
+    assert response.status_code == 400
+
+
+def test_rules_without_a_frequency_are_refused(client, user):
+    user_id, headers = user
+    response = client.post(f"/api/users/{user_id}/recurring/", headers=headers, json={
+        "account_id": add_account(user_id), "category": "parking", "amount": 1.0,
+        "rrule": "COUNT=3", "start_date": date.today().isoformat()})
+    assert response.status_code == 400
+
+
+def test_no_recurring_expenses_is_not_found(client, user):
+    user_id, headers = user
+    assert client.get(f"/api/users/{user_id}/recurring", headers=headers).status_code == 404
+
+
+def test_several_times_a_day_is_one_expense_a_day(client, user, app_cache, redis_live):
+    user_id, headers = user
+    reset(app_cache, redis_live)
+    today = date.today()
+    response = client.post(f"/api/users/{user_id}/recurring/", headers=headers, json={
+        "account_id": add_account(user_id), "category": "coffee", "amount": 3.0,
+        "rrule": "FREQ=DAILY;BYHOUR=9,18", "start_date": (today - timedelta(days=3)).isoformat()})
+    assert response.status_code == 200, response.text
+    recurring_id = response.json()["recurring_id"]
+
+    with SessionLocal() as db:
+        assert materialize_recurring(db, app_cache, today)["inserted"] == 4
+        days = db.query(Expense.date).filter(Expense.user_id == user_id).order_by(Expense.date).all()
+        assert [day for day, in days] == [today - timedelta(days=n) for n in (3, 2, 1, 0)]
+        assert db.get(RecurringExpense, recurring_id).next_date == today + timedelta(days=1)
+
+
+def test_materialized_expenses_are_added_to_spending_statistics(client, user, app_cache, redis_live):
+    user_id, headers = user
+    reset(app_cache, redis_live)
+    today = date.today()
+    account_id = add_account(user_id)
+    response = client.post(f"/api/users/{user_id}/recurring/", headers=headers, json={
+        "account_id": account_id, "category": "rent", "amount": 40.0,
+        "rrule": "FREQ=DAILY", "start_date": today.isoformat()})
+    assert response.status_code == 200, response.text
+
+    spending = SpendingModel(app_cache)
+    with SessionLocal() as db:
+        spending.backfill(db, user_id, account_id)
+        assert materialize_recurring(db, app_cache, today)["inserted"] == 1
+    assert spending.forecast(user_id, account_id)["spent_to_date"] == 40.0
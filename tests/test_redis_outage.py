@@ -0,0 +1,99 @@
+import time
+from datetime import date
+from models import Expense
+from utils.db import SessionLocal
+from utils.redis import RedisCache, REDIS_SOCKET_TIMEOUT, REDIS_BREAKER_THRESHOLD
+from .conftest import reset
+
+
+def test_breaker_stops_waiting_on_redis(redis_unavailable):
+    cache = reset(RedisCache(), redis_unavailable)
+
+    for _ in range(REDIS_BREAKER_THRESHOLD):
+        assert cache.get("key") is None
+    assert cache.metrics()["state"] == "open"
+
+    started = time.monotonic()
+    for _ in range(100):
+        assert cache.get("key") is None
+    # open circuit: no command is sent, so no timeout is waited for
+    assert time.monotonic() - started < REDIS_SOCKET_TIMEOUT
+
+
+def test_reads_fall_back_to_the_process(redis_unavailable):
+    cache = reset(RedisCache(), redis_unavailable)
+
+    cache.set_("key", b"value")
+    assert cache.get("key") == b"value"
+
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return '{"rows": []}'
+    assert cache.get_or_compute("listing", compute) == b'{"rows": []}'
+    assert cache.get_or_compute("listing", compute) == b'{"rows": []}'
+    assert len(calls) == 1
+    assert cache.get_versions(1, "accounts") != cache.get_versions(1, "accounts")
+
+
+def test_invalidations_replay_once_redis_is_back(redis_live, redis_down):
+    cache = reset(RedisCache(), redis_live)
+    redis_live.set("account:1", b"cached")
+    before = cache.get_versions(1, "accounts")[0]
+
+    reset(cache, redis_down)
+    assert cache.delete_keys("account:1") is False
+    cache.bump_versions(1, "accounts")
+    assert cache.metrics()["pending_invalidations"] == 2
+    assert redis_live.get("account:1") == b"cached"
+
+    cache.redis_client = redis_live
+    cache.breaker.reset_timeout = 0
+    cache.get("anything")
+    assert cache.metrics() == {"state": "closed", "failures": 0,
+                               "fallback_entries": 0, "pending_invalidations": 0}
+    assert redis_live.get("account:1") is None
+    assert cache.get_versions(1, "accounts")[0] > before
+
+
+def test_writes_succeed_once_without_redis(client, user, app_cache, redis_unavailable):
+    user_id, headers = user
+    reset(app_cache, redis_unavailable)
+
+    response = client.post(f"/api/users/{user_id}/accounts/", headers=headers,
+                           json={"account_name": "checking", "balance": 1000})
+    assert response.status_code == 201, response.text
+    account_id = response.json()["account_id"]
+    response = client.post(f"/api/users/{user_id}/budgets/", headers=headers, json={
+        "account_id": account_id, "amount": 100,
+        "start_date": "2026-01-01", "end_date": "2026-12-31"})
+    assert response.status_code == 200, response.text
+    budget_id = response.json()["budget_id"]
+
+    response = client.post(f"/api/users/{user_id}/expenses/", headers=headers, json={
+        "account_id": account_id, "category": "groceries", "amount": 90,
+        "date": date(2026, 3, 1).isoformat()})
+    assert response.status_code == 200, response.text
+    with SessionLocal() as db:
+        assert db.query(Expense).filter(Expense.user_id == user_id).count() == 1
+
+    assert client.get(f"/api/users/{user_id}/expenses/", headers=headers).status_code == 200
+    response = client.get(
+        f"/api/users/{user_id}/accounts/{account_id}/budgets/{budget_id}/progress", headers=headers)
+    assert response.status_code == 200, response.text
+    assert response.json()["expenses_sum"] == 90
+    # statistics are only ever built in the background, and need Redis to keep them
+    response = client.get(f"/api/users/{user_id}/accounts/{account_id}/forecast", headers=headers)
+    assert response.status_code == 202
+    assert "Retry-After" in response.headers
+    assert client.get(f"/api/users/{user_id}/budgets/alerts", headers=headers).json() == []
+
+
+def test_reports_are_refused_without_redis(client, user, app_cache, redis_unavailable):
+    user_id, headers = user
+    reset(app_cache, redis_unavailable)
+
+    response = client.get(f"/api/users/{user_id}/reports/", headers=headers)
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
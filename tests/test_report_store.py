@@ -0,0 +1,28 @@
+import os
+from utils.redis import RedisCache
+from utils.report_store import (
+    ReportStore, REPORT_BLOB_PREFIX, REPORT_INDEX_KEY, REPORT_SIZES_KEY, TIER_REDIS, TIER_FILE)
+from .conftest import reset
+
+
+def test_a_report_saved_into_the_other_tier_leaves_no_copy_behind(redis_live, tmp_path, monkeypatch):
+    monkeypatch.setattr("utils.report_store.REPORT_INLINE_MAX_BYTES", 256)
+    store = ReportStore(reset(RedisCache(), redis_live), directory=str(tmp_path))
+    small = {"expenses": []}
+    # hex digits of distinct numbers barely compress
+    large = {"expenses": [format(n * 2654435761 % 2 ** 32, "x") for n in range(200)]}
+
+    assert store.save("scheduled-1", small, ttl=None)["tier"] == TIER_REDIS
+
+    meta = store.save("scheduled-1", large, ttl=None)
+    assert meta["tier"] == TIER_FILE
+    assert redis_live.get(f"{REPORT_BLOB_PREFIX}scheduled-1") is None
+    assert redis_live.zscore(REPORT_INDEX_KEY, "scheduled-1") is None
+    assert redis_live.hget(REPORT_SIZES_KEY, "scheduled-1") is None
+    assert store.load("scheduled-1", meta) == large
+
+    meta = store.save("scheduled-1", small, ttl=None)
+    assert meta["tier"] == TIER_REDIS
+    assert not os.path.exists(store.path("scheduled-1"))
+    assert store.load("scheduled-1", meta) == small
+    assert store.stats()[TIER_FILE]["reports"] == 0
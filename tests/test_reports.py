@@ -0,0 +1,15 @@
+from .conftest import register, reset
+
+
+def test_a_queued_report_is_hidden_from_other_users(client, user, app_cache, redis_live):
+    user_id, headers = user
+    other_id, other_headers = register(client)
+    reset(app_cache, redis_live)
+
+    response = client.get(f"/api/users/{user_id}/reports/", headers=headers)
+    assert response.status_code == 200, response.text
+    report_id = response.json()["report_id"]
+
+    assert client.get(f"/api/users/{user_id}/reports/{report_id}", headers=headers).json()["status"] == "running"
+    response = client.get(f"/api/users/{other_id}/reports/{report_id}", headers=other_headers)
+    assert response.status_code == 404
@@ -0,0 +1,29 @@
+import time
+import uuid
+from utils.redis import RedisCache
+from utils.scheduler import ReportScheduler, PENDING_KEY, ADMITTED, REPORT_JOB_TIMEOUT
+from utils.tasks import purge_user_task
+from .conftest import reset
+
+
+def test_a_purged_users_reports_leave_the_queue(user, redis_live):
+    user_id, _ = user
+    cache = reset(RedisCache(), redis_live)
+    scheduler = ReportScheduler(cache)
+    assert scheduler.admit(user_id, str(uuid.uuid4())) == ADMITTED
+    assert scheduler.admit(user_id, str(uuid.uuid4())) == ADMITTED
+    assert redis_live.zcard(PENDING_KEY) == 2
+
+    purge_user_task(user_id, str(uuid.uuid4()), cache_client=cache)
+
+    assert redis_live.zcard(PENDING_KEY) == 0
+
+
+def test_admitting_drops_reports_waiting_longer_than_the_job_timeout(redis_live):
+    cache = reset(RedisCache(), redis_live)
+    # queued by a user whose lists are gone, so nothing will ever claim it
+    redis_live.zadd(PENDING_KEY, {"lost": time.time() - REPORT_JOB_TIMEOUT - 1})
+
+    assert ReportScheduler(cache).admit(1, "fresh") == ADMITTED
+
+    assert [member for member, _ in redis_live.zrange(PENDING_KEY, 0, -1, withscores=True)] == [b"fresh"]
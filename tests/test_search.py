@@ -0,0 +1,42 @@
+import base64
+from datetime import date
+import pytest
+from models import Account, Category, Expense
+from utils.db import SessionLocal
+from utils.search import decode_cursor, encode_cursor
+
+
+@pytest.mark.parametrize("raw", [b"5", b"[null, 1]", b'{"a": 1, "b": 2}', b"[1, 2, 3]", b'["x", 1]', b"\xff"])
+def test_malformed_cursors_raise_value_error(raw):
+    with pytest.raises(ValueError):
+        decode_cursor(base64.urlsafe_b64encode(raw).decode())
+
+
+def test_cursors_round_trip():
+    assert decode_cursor(encode_cursor(1.5, 42)) == (1.5, 42)
+
+
+def test_pages_walk_through_tied_ranks(client, user):
+    user_id, headers = user
+    with SessionLocal() as db:
+        account = Account(user_id=user_id, account_name="search", balance=10000)
+        category = Category(user_id=user_id, category_name="travel")
+        db.add_all([account, category])
+        db.flush()
+        # identical notes rank the same, more of them than fit on a page
+        db.add_all([Expense(user_id=user_id, account_id=account.account_id, amount=1.0,
+                            category_id=category.category_id, date=date.today(),
+                            notes="taxi to the airport") for _ in range(7)])
+        db.commit()
+
+    for params in ({"q": "taxi"}, {}):
+        seen, cursor = [], None
+        for _ in range(10):
+            page = client.get(f"/api/users/{user_id}/expenses/search", headers=headers,
+                              params={**params, "limit": 3, **({"cursor": cursor} if cursor else {})}).json()
+            seen.extend(result["expense_id"] for result in page["results"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        assert cursor is None
+        assert len(seen) == len(set(seen)) == 7
@@ -0,0 +1,102 @@
+from datetime import date, timedelta
+from types import SimpleNamespace
+import pytest
+from models import Account, Expense, User
+from utils.db import SessionLocal, create_database
+from utils.redis import RedisCache
+from utils.spending import SpendingModel
+from .conftest import reset
+
+
+@pytest.fixture
+def account(redis_live):
+    create_database()
+    with SessionLocal() as db:
+        owner = User(username="spender", email="spender@example.com", hashed_password="x")
+        db.add(owner)
+        db.flush()
+        account = Account(user_id=owner.id, account_name="spending", balance=10000)
+        db.add(account)
+        db.commit()
+        ids = owner.id, account.account_id
+    yield ids
+    with SessionLocal() as db:
+        db.query(Expense).filter(Expense.user_id == ids[0]).delete()
+        db.query(Account).filter(Account.user_id == ids[0]).delete()
+        db.query(User).filter(User.id == ids[0]).delete()
+        db.commit()
+
+
+def add_expense(user_id: int, account_id: int, day: date, amount: float) -> Expense:
+    with SessionLocal() as db:
+        expense = Expense(user_id=user_id, account_id=account_id, date=day, amount=amount)
+        db.add(expense)
+        db.commit()
+        db.refresh(expense)
+        return expense
+
+
+def record(model: SpendingModel, expense: Expense) -> bool:
+    return model.record_expense(expense.user_id, expense.account_id, expense.expense_id,
+                                expense.category_id, expense.date, expense.amount)
+
+
+def test_future_expenses_wait_for_their_month(account, redis_live):
+    user_id, account_id = account
+    model = SpendingModel(reset(RedisCache(), redis_live))
+    today = date.today()
+
+    first = add_expense(user_id, account_id, today, 500.0)
+    assert record(model, first) is False
+    with SessionLocal() as db:
+        model.backfill(db, user_id, account_id, first.expense_id)
+        assert model.forecast(user_id, account_id)["spent_to_date"] == 500.0
+
+    ahead = add_expense(user_id, account_id, today + timedelta(days=40), 70.0)
+    assert record(model, ahead) is True
+    with SessionLocal() as db:
+        assert model.forecast(user_id, account_id)["spent_to_date"] == 500.0
+        next_month = (today.replace(day=1) + timedelta(days=62)).replace(day=1)
+        assert model.forecast(user_id, account_id, today=next_month)["months_of_history"] == 2
+
+
+def test_an_expense_is_counted_once_by_racing_rebuilds(account, redis_live):
+    user_id, account_id = account
+    model = SpendingModel(reset(RedisCache(), redis_live))
+    expenses = [add_expense(user_id, account_id, date.today(), 10.0) for _ in range(3)]
+
+    # every first write finds no state and asks for a rebuild
+    assert not any(record(model, expense) for expense in expenses)
+    with SessionLocal() as db:
+        for expense in expenses:
+            model.backfill(db, user_id, account_id, expense.expense_id)
+        # a retried update of an expense the rebuild already counted
+        assert record(model, expenses[-1]) is True
+        assert model.forecast(user_id, account_id)["spent_to_date"] == 30.0
+
+
+def test_a_missing_state_is_built_off_the_request_path(client, user, app_cache, redis_live, monkeypatch):
+    user_id, headers = user
+    reset(app_cache, redis_live)
+    with SessionLocal() as db:
+        account = Account(user_id=user_id, account_name="forecast", balance=1000)
+        db.add(account)
+        db.commit()
+        account_id = account.account_id
+    add_expense(user_id, account_id, date.today(), 25.0)
+
+    queued = []
+    monkeypatch.setattr("api.accounts.spending_backfill_task",
+                        SimpleNamespace(delay=lambda *args: queued.append(args)))
+    url = f"/api/users/{user_id}/accounts/{account_id}/forecast"
+    for _ in range(3):
+        response = client.get(url, headers=headers)
+        assert response.status_code == 202
+        assert "Retry-After" in response.headers
+    assert queued == [(user_id, account_id)]
+
+    with SessionLocal() as db:
+        SpendingModel(app_cache).backfill(db, user_id, account_id)
+    response = client.get(url, headers=headers)
+    assert response.status_code == 200
+    assert response.json()["spent_to_date"] == 25.0
@@ -1,3 +1,3 @@
 from .db import get_db, Base
 from .redis import get_cache, RedisCache
-from .tasks import create_account_task, generate_report_task
+from .tasks import create_account_task, generate_report_task, dispatch_reports, purge_user_task, budget_alert_task, spending_backfill_task
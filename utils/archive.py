@@ -0,0 +1,77 @@
+import os
+import logging
+from datetime import date, timedelta
+from typing import Optional
+from sqlalchemy import select, insert, delete, func
+from sqlalchemy.orm import Session
+from .redis import RedisCache
+from models import Expense, ExpenseArchive
+
+Logger = logging.getLogger(__name__)
+
+# expenses dated before today minus this many days move to the archive
+ARCHIVE_HORIZON_DAYS = int(os.getenv("ARCHIVE_HORIZON_DAYS", 365))
+# rows moved per transaction
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 1000))
+ARCHIVE_WATERMARK_KEY = os.getenv("ARCHIVE_WATERMARK_KEY", "archive:watermark")
+
+ARCHIVE_COLUMNS = ("expense_id", "user_id", "account_id",
+                   "amount", "category_id", "date", "notes", "occurrence_key")
+
+
+def archive_watermark(db: Session, cache: RedisCache) -> Optional[date]:
+    """
+    Latest date the archive may hold, or None when it is empty.
+
+    The mark is raised before rows move, so a read that starts after it
+    never needs the archive even while a move is running.
+    """
+    cached = cache.get(ARCHIVE_WATERMARK_KEY)
+    if cached is not None:
+        return date.fromisoformat(cached.decode()) if cached else None
+
+    # Redis lost the mark, the archive itself knows its newest row
+    newest = db.execute(select(func.max(ExpenseArchive.date))).scalar()
+    cache.add(ARCHIVE_WATERMARK_KEY, newest.isoformat() if newest else "",
+              expiration_time=None)
+    return newest
+
+
+def needs_archive(db: Session, cache: RedisCache, start_date: Optional[date]) -> bool:
+    """Whether a read from start_date onwards (None for all time) must include the archive"""
+    watermark = archive_watermark(db, cache)
+    return watermark is not None and (start_date is None or start_date <= watermark)
+
+
+def archive_expenses(db: Session, cache: RedisCache, horizon_days: int = ARCHIVE_HORIZON_DAYS) -> int:
+    """Move expenses older than the horizon into expenses_archive, one short transaction per batch"""
+    cutoff = date.today() - timedelta(days=horizon_days)
+
+    hot_columns = [getattr(Expense, column) for column in ARCHIVE_COLUMNS]
+    moved = 0
+    while True:
+        ids = db.execute(select(Expense.expense_id).where(
+            Expense.date < cutoff).limit(ARCHIVE_BATCH_SIZE)).scalars().all()
+        if not ids:
+            break
+        if not moved and not _raise_watermark(db, cache, cutoff - timedelta(days=1)):
+            Logger.warning("Redis unavailable, archiving postponed")
+            break
+        db.execute(insert(ExpenseArchive).from_select(
+            ARCHIVE_COLUMNS, select(*hot_columns).where(Expense.expense_id.in_(ids))))
+        db.execute(delete(Expense).where(Expense.expense_id.in_(ids)))
+        db.commit()
+        moved += len(ids)
+
+    if moved:
+        Logger.info(f"Archived {moved} expenses dated before {cutoff}")
+    return moved
+
+
+def _raise_watermark(db: Session, cache: RedisCache, watermark: date) -> bool:
+    """False when Redis could not store the mark, and no row may move"""
+    current = archive_watermark(db, cache)
+    if current is not None and current >= watermark:
+        return True
+    return cache.call(lambda: cache.redis_client.set(
+        ARCHIVE_WATERMARK_KEY, watermark.isoformat()), lambda: False)
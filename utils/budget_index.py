@@ -0,0 +1,260 @@
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict
+from datetime import date
+from typing import List, NamedTuple
+from sqlalchemy import select, func, and_
+from sqlalchemy.orm import Session
+from .redis import RedisCache
+from models import Budget, Expense, ExpenseArchive
+
+Logger = logging.getLogger(__name__)
+
+BUDGET_INDEX_PREFIX = os.getenv("BUDGET_INDEX_PREFIX", "budget_index:")
+BUDGET_INDEX_TTL = int(os.getenv("BUDGET_INDEX_TTL", 60 * 60 * 24))
+BUDGET_INDEX_CACHE_SIZE = int(os.getenv("BUDGET_INDEX_CACHE_SIZE", 10000))
+BUDGET_SPENT_PREFIX = os.getenv("BUDGET_SPENT_PREFIX", "budget_spent:")
+# fractions of a budget that raise an alert when spending crosses them
+BUDGET_ALERT_THRESHOLDS = sorted(
+    float(threshold) for threshold in os.getenv("BUDGET_ALERT_THRESHOLDS", "0.8,1.0").split(","))
+
+# Each total sits next to a "<budget_id>:through" field, the highest
+# expense id its seeding SUM covered.
+#
+# add to a running total only if it has been seeded, so an increment
+# never turns into a wrong total for a budget we have not summed yet, and
+# only for expenses the SUM did not already count
+INCREMENT_SPENT_SCRIPT = """
+local total = redis.call('hget', KEYS[1], ARGV[1])
+if not total then
+    return false
+end
+if tonumber(ARGV[3]) <= tonumber(redis.call('hget', KEYS[1], ARGV[1] .. ':through') or '0') then
+    return total
+end
+return redis.call('hincrbyfloat', KEYS[1], ARGV[1], ARGV[2])
+"""
+
+# seed a total and its watermark together, unless another process already
+# seeded it and has kept it running since
+SEED_SPENT_SCRIPT = """
+if redis.call('hsetnx', KEYS[1], ARGV[1], ARGV[2]) == 1 then
+    redis.call('hset', KEYS[1], ARGV[1] .. ':through', ARGV[3])
+end
+"""
+
+
+class BudgetInterval(NamedTuple):
+    budget_id: int
+    start_date: date
+    end_date: date
+    amount: float
+
+
+class IntervalTree:
+    """
+    Centered interval tree over closed date ranges.
+
+    Each node keeps the intervals containing its center, sorted by start
+    and by end, so a point query walks one root-to-leaf path and stops
+    scanning a node's list at the first interval that cannot match:
+    O(log n + k) for k covering intervals.
+    """
+    __slots__ = ("center", "by_start", "by_end", "left", "right")
+
+    def __init__(self, intervals: List[BudgetInterval]):
+        endpoints = sorted(point for interval in intervals
+                           for point in (interval.start_date, interval.end_date))
+        self.center = endpoints[len(endpoints) // 2]
+
+        here, left, right = [], [], []
+        for interval in intervals:
+            if interval.end_date < self.center:
+                left.append(interval)
+            elif interval.start_date > self.center:
+                right.append(interval)
+            else:
+                here.append(interval)
+
+        self.by_start = sorted(here, key=lambda interval: interval.start_date)
+        self.by_end = sorted(
+            here, key=lambda interval: interval.end_date, reverse=True)
+        self.left = IntervalTree(left) if left else None
+        self.right = IntervalTree(right) if right else None
+
+    def covering(self, point: date) -> List[BudgetInterval]:
+        found = []
+        node = self
+        while node is not None:
+            if point < node.center:
+                for interval in node.by_start:
+                    if interval.start_date > point:
+                        break
+                    found.append(interval)
+                node = node.left
+            elif point > node.center:
+                for interval in node.by_end:
+                    if interval.end_date < point:
+                        break
+                    found.append(interval)
+                node = node.right
+            else:
+                found.extend(node.by_start)
+                break
+        return found
+
+
+class BudgetIndex:
+    """
+    Per-account interval trees of budgets, used to find the budgets an
+    expense counts towards and keep their spent totals running.
+
+    Trees are cached in process and their interval lists in Redis, both
+    keyed by the user's budgets data version, so any budget write
+    invalidates them. A rebuild also seeds the spent totals the account's
+    budgets are missing, the only time their SUMs are computed. Totals
+    another process already keeps running are left alone, and increments
+    skip expenses a seeding SUM already counted.
+    """
+
+    def __init__(self, maxsize: int = BUDGET_INDEX_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._trees = OrderedDict()
+        self._lock = threading.Lock()
+
+    def tree(self, db: Session, cache: RedisCache, user_id: int, account_id: int):
+        """The account's tree, or None without budgets"""
+        version = cache.get_versions(user_id, "budgets")[0]
+
+        with self._lock:
+            cached = self._trees.get(account_id)
+            if cached is not None and cached[0] == version:
+                self._trees.move_to_end(account_id)
+                return cached[1]
+
+        intervals = self._load(db, cache, user_id, account_id, version)
+        tree = IntervalTree(intervals) if intervals else None
+
+        with self._lock:
+            self._trees[account_id] = (version, tree)
+            self._trees.move_to_end(account_id)
+            while len(self._trees) > self.maxsize:
+                self._trees.popitem(last=False)
+        return tree
+
+    def _load(self, db: Session, cache: RedisCache, user_id: int, account_id: int, version: int):
+        key = f"{BUDGET_INDEX_PREFIX}{account_id}"
+        stored = cache.get(key)
+        if stored is not None:
+            stored = json.loads(stored)
+            if stored["version"] == version:
+                return [BudgetInterval(budget_id, date.fromisoformat(start), date.fromisoformat(end), amount)
+                        for budget_id, start, end, amount in stored["budgets"]]
+
+        intervals = [BudgetInterval(*row) for row in db.execute(select(
+            Budget.budget_id, Budget.start_date, Budget.end_date, Budget.amount,
+        ).where(Budget.user_id == user_id, Budget.account_id == account_id))]
+
+        self._seed_spent(db, cache, user_id, account_id)
+        cache.set_(key, json.dumps({
+            "version": version,
+            "budgets": [[interval.budget_id, interval.start_date.isoformat(),
+                         interval.end_date.isoformat(), interval.amount] for interval in intervals],
+        }), expiration_time=BUDGET_INDEX_TTL)
+        return intervals
+
+    def _seed_spent(self, db: Session, cache: RedisCache, user_id: int, account_id: int) -> None:
+        spent, through = {}, {}
+        for model in (Expense, ExpenseArchive):
+            rows = db.execute(select(
+                Budget.budget_id, func.sum(model.amount), func.max(model.expense_id),
+            ).outerjoin(model, and_(
+                model.account_id == Budget.account_id,
+                model.date >= Budget.start_date,
+                model.date <= Budget.end_date,
+            )).where(Budget.user_id == user_id, Budget.account_id == account_id).group_by(Budget.budget_id))
+            for budget_id, total, last_id in rows:
+                spent[budget_id] = spent.get(budget_id, 0.0) + (total or 0.0)
+                through[budget_id] = max(through.get(budget_id, 0), last_id or 0)
+
+        if not spent:
+            return
+
+        # a total another process seeded and kept running since is newer
+        # than our SUM, overwriting it would lose or repeat expenses
+        def seed():
+            pipe = cache.redis_client.pipeline()
+            for budget_id, total in spent.items():
+                pipe.eval(SEED_SPENT_SCRIPT, 1, f"{BUDGET_SPENT_PREFIX}{user_id}",
+                          budget_id, total, through[budget_id])
+            pipe.execute()
+        cache.call(seed, lambda: drop_spent_totals(cache, [user_id]))
+
+    def record_expense(self, db: Session, cache: RedisCache, user_id: int, account_id: int,
+                       expense_id: int, expense_date: date, amount: float) -> List[dict]:
+        """
+        Add a committed expense to the spent totals of the budgets covering
+        its date, unless their seeding SUM already counted it. Returns the
+        alerts for thresholds the expense crossed.
+        """
+        tree = self.tree(db, cache, user_id, account_id)
+        if tree is None:
+            return []
+
+        budgets = tree.covering(expense_date)
+        if not budgets:
+            return []
+
+        key = f"{BUDGET_SPENT_PREFIX}{user_id}"
+
+        def update():
+            pipe = cache.redis_client.pipeline()
+            for budget in budgets:
+                pipe.eval(INCREMENT_SPENT_SCRIPT, 1, key, budget.budget_id, amount, expense_id)
+            return pipe.execute()
+        totals = cache.call(
+            update, lambda: drop_spent_totals(cache, [user_id]) or [])
+
+        alerts = []
+        for budget, spent in zip(budgets, totals):
+            if spent is None or budget.amount <= 0:
+                continue
+            spent = float(spent)
+            # only the increment that moves the total across a threshold reports it
+            for threshold in BUDGET_ALERT_THRESHOLDS:
+                if spent - amount < threshold * budget.amount <= spent:
+                    alerts.append({
+                        "user_id": user_id,
+                        "account_id": account_id,
+                        "budget_id": budget.budget_id,
+                        "threshold": threshold,
+                        "spent": round(spent, 2),
+                        "amount": budget.amount,
+                    })
+        return alerts
+
+
+def forget_spent(cache: RedisCache, user_id: int, budget_ids) -> None:
+    """
+    Drop the totals of budgets whose dates or account changed, before the
+    version bump, so the rebuild it causes seeds them again.
+    """
+    fields = [field for budget_id in budget_ids for field in (budget_id, f"{budget_id}:through")]
+    if fields:
+        cache.call(lambda: cache.redis_client.hdel(f"{BUDGET_SPENT_PREFIX}{user_id}", *fields),
+                   lambda: drop_spent_totals(cache, [user_id]))
+
+
+def drop_spent_totals(cache: RedisCache, user_ids) -> None:
+    """
+    Forget running totals that missed an expense while Redis was
+    unavailable. Both writes are replayed once it is back, and the version
+    bump makes the next expense reseed them from the database.
+    """
+    cache.delete_keys(*(f"{BUDGET_SPENT_PREFIX}{user_id}" for user_id in user_ids))
+    cache.bump_many_versions(user_ids, "budgets")
+
+
+budget_index = BudgetIndex()
@@ -0,0 +1,101 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from .db import SessionLocal
+from .outbox import record_event, row_data
+from .redis import get_cache
+from models import Category
+
+CATEGORY_CACHE_SIZE = int(os.getenv("CATEGORY_CACHE_SIZE", 100000))
+
+
+class CategoryInterner:
+    """
+    Process-local (user_id, category_name) -> category_id map.
+
+    Expenses store the integer id; the name is resolved here at write time
+    so filters and groupings never touch the string column. New categories
+    are committed in their own short transaction, so a cached id always
+    points at a row that exists.
+
+    Entries remember the user's "categories" version in Redis. Renames and
+    deletes bump it, which drops the user's entries in every process.
+    """
+
+    def __init__(self, maxsize: int = CATEGORY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, db: Session, user_id: int, category_name: str) -> Optional[int]:
+        """Id of an existing category, or None"""
+        return self._lookup(db, user_id, category_name, self._version(user_id))
+
+    def intern(self, db: Session, user_id: int, category_name: str) -> int:
+        """Id of the category, creating it on first use"""
+        version = self._version(user_id)
+        category_id = self._lookup(db, user_id, category_name, version)
+        if category_id is not None:
+            return category_id
+
+        with SessionLocal() as session:
+            category = Category(user_id=user_id, category_name=category_name)
+            session.add(category)
+            try:
+                session.flush()
+                record_event(session, user_id, "category", "created",
+                             category.category_id, row_data(category))
+                session.commit()
+                category_id = category.category_id
+            except IntegrityError:
+                # another request created it first
+                session.rollback()
+                category_id = session.query(Category.category_id).filter(
+                    Category.user_id == user_id, Category.category_name == category_name).scalar()
+
+        self._remember((user_id, category_name), category_id, version)
+        return category_id
+
+    def forget(self, user_id: int, category_name: str) -> None:
+        """Drop a renamed or deleted category here and in every other process"""
+        with self._lock:
+            self._ids.pop((user_id, category_name), None)
+        get_cache().bump_versions(user_id, "categories")
+
+    def forget_user(self, user_id: int) -> None:
+        with self._lock:
+            for key in [key for key in self._ids if key[0] == user_id]:
+                del self._ids[key]
+        get_cache().bump_versions(user_id, "categories")
+
+    @staticmethod
+    def _version(user_id: int) -> int:
+        # read before the database, so a change made meanwhile is not cached as current
+        return get_cache().get_versions(user_id, "categories")[0]
+
+    def _lookup(self, db: Session, user_id: int, category_name: str, version: int) -> Optional[int]:
+        key = (user_id, category_name)
+        with self._lock:
+            cached = self._ids.get(key)
+            if cached is not None and cached[1] == version:
+                self._ids.move_to_end(key)
+                return cached[0]
+
+        category_id = db.query(Category.category_id).filter(
+            Category.user_id == user_id, Category.category_name == category_name).scalar()
+        if category_id is not None:
+            self._remember(key, category_id, version)
+        return category_id
+
+    def _remember(self, key, category_id: int, version: int) -> None:
+        with self._lock:
+            self._ids[key] = (category_id, version)
+            self._ids.move_to_end(key)
+            while len(self._ids) > self.maxsize:
+                self._ids.popitem(last=False)
+
+
+category_interner = CategoryInterner()
@@ -0,0 +1,61 @@
+import logging
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import SQLAlchemyError
+from .db import engine, Base
+
+Logger = logging.getLogger(__name__)
+
+
+def run_migrations() -> None:
+    """Bring tables created by older versions up to date with the models"""
+    add_missing_columns()
+    migrate_expense_categories()
+    create_missing_indexes()
+
+
+def add_missing_columns() -> None:
+    """Add nullable columns added to models after their tables already existed"""
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"]
+                        for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                Logger.info(f"Adding column {table.name}.{column.name}")
+                connection.execute(text(
+                    f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+
+def migrate_expense_categories() -> None:
+    """Move the free-text expenses.category values into the categories table"""
+    columns = {column["name"]
+               for column in inspect(engine).get_columns("expenses")}
+    if "category" not in columns:
+        return
+
+    with engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO categories (user_id, category_name) "
+            "SELECT DISTINCT e.user_id, e.category FROM expenses e "
+            "WHERE e.category IS NOT NULL AND e.category_id IS NULL AND e.user_id IS NOT NULL "
+            "AND NOT EXISTS (SELECT 1 FROM categories c "
+            "WHERE c.user_id = e.user_id AND c.category_name = e.category)"))
+        result = connection.execute(text(
+            "UPDATE expenses SET category_id = (SELECT c.category_id FROM categories c "
+            "WHERE c.user_id = expenses.user_id AND c.category_name = expenses.category) "
+            "WHERE category_id IS NULL AND category IS NOT NULL AND user_id IS NOT NULL"))
+        if result.rowcount:
+            Logger.info(f"Moved {result.rowcount} expenses to category ids")
+
+
+def create_missing_indexes() -> None:
+    """Create indexes added to models after their tables already existed"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except SQLAlchemyError:
+                Logger.exception(f"Could not create index {index.name}")
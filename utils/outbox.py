@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import uuid
+import datetime
+import logging
+from typing import Callable, Optional
+import redis
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.orm import Session
+from .redis import RedisCache, RELEASE_LOCK_SCRIPT
+from models import OutboxEvent
+
+Logger = logging.getLogger(__name__)
+
+OUTBOX_STREAM_KEY = os.getenv("OUTBOX_STREAM_KEY", "changes")
+# approximate number of events the stream keeps for late consumers
+OUTBOX_STREAM_MAXLEN = int(os.getenv("OUTBOX_STREAM_MAXLEN", 100000))
+OUTBOX_RELAY_BATCH_SIZE = int(os.getenv("OUTBOX_RELAY_BATCH_SIZE", 500))
+OUTBOX_RELAY_LOCK_KEY = os.getenv("OUTBOX_RELAY_LOCK_KEY", "outbox:relay_lock")
+OUTBOX_RELAY_LOCK_TTL = int(os.getenv("OUTBOX_RELAY_LOCK_TTL", 30))
+# highest event id up to which every event was relayed or given up on
+OUTBOX_RELAY_POSITION_KEY = os.getenv(
+    "OUTBOX_RELAY_POSITION_KEY", "outbox:relay_position")
+OUTBOX_RELAY_GAP_KEY = os.getenv("OUTBOX_RELAY_GAP_KEY", "outbox:relay_gap")
+# seconds a missing event id holds back later ones before it is taken as rolled back
+OUTBOX_GAP_TIMEOUT = float(os.getenv("OUTBOX_GAP_TIMEOUT", 5))
+# published events are kept this long in the table, then deleted
+OUTBOX_RETENTION_HOURS = int(os.getenv("OUTBOX_RETENTION_HOURS", 24))
+# pending messages idle this long are taken over from a dead consumer
+OUTBOX_CLAIM_IDLE_MS = int(os.getenv("OUTBOX_CLAIM_IDLE_MS", 60000))
+
+
+def _encode(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def row_data(instance) -> dict:
+    """Column values of an ORM instance"""
+    return {column.key: getattr(instance, column.key) for column in instance.__table__.columns}
+
+
+def record_event(db: Session, user_id: int, entity: str, action: str, entity_id: Optional[int], data: Optional[dict] = None) -> None:
+    """
+    Add a change event to the session. It commits, or rolls back, with the
+    change it describes; rows created in the same transaction need a
+    flush first so their id is known.
+    """
+    db.add(OutboxEvent(
+        user_id=user_id,
+        entity=entity,
+        action=action,
+        entity_id=entity_id,
+        payload=json.dumps(data, default=_encode) if data is not None else None,
+    ))
+
+
+def _relay_position(db: Session, redis_client) -> int:
+    stored = redis_client.get(OUTBOX_RELAY_POSITION_KEY)
+    if stored is not None:
+        return int(stored)
+    # lost with Redis: restart after the newest event already published
+    position = db.execute(select(func.max(OutboxEvent.event_id)).where(
+        OutboxEvent.published_at.is_not(None))).scalar()
+    if position is None:
+        position = (db.execute(select(func.min(OutboxEvent.event_id))).scalar() or 1) - 1
+    return position
+
+
+def _gap_expired(redis_client, event_id: int) -> bool:
+    """Whether event_id has been missing for OUTBOX_GAP_TIMEOUT seconds"""
+    stored = redis_client.get(OUTBOX_RELAY_GAP_KEY)
+    if stored is not None:
+        missing, since = stored.decode().split(":")
+        if int(missing) == event_id:
+            return time.time() - float(since) >= OUTBOX_GAP_TIMEOUT
+    redis_client.set(OUTBOX_RELAY_GAP_KEY, f"{event_id}:{time.time()}")
+    return False
+
+
+def relay_outbox(db: Session, cache: RedisCache) -> int:
+    """
+    Publish unpublished events to the change stream in commit order.
+
+    Event ids are taken at insert, not at commit, so a missing id may
+    belong to a transaction that is still running. The relay stops at the
+    first gap and only moves past it after OUTBOX_GAP_TIMEOUT, when the
+    transaction is taken as rolled back. An event that commits even later
+    is still published, out of order, with a warning.
+
+    One relay runs at a time. An event is marked published only after
+    XADD succeeded, so a crash in between publishes it again: delivery
+    is at least once and consumers dedupe on event_id.
+    """
+    redis_client = cache.redis_client
+    token = uuid.uuid4().hex
+    if not redis_client.set(OUTBOX_RELAY_LOCK_KEY, token, nx=True, ex=OUTBOX_RELAY_LOCK_TTL):
+        return 0
+
+    published = 0
+    try:
+        position = _relay_position(db, redis_client)
+        while True:
+            events = db.execute(select(OutboxEvent).where(
+                OutboxEvent.published_at.is_(None)).order_by(
+                OutboxEvent.event_id).limit(OUTBOX_RELAY_BATCH_SIZE)).scalars().all()
+
+            ready = []
+            for event in events:
+                if event.event_id <= position:
+                    Logger.warning(f"Outbox event {event.event_id} committed after later events were relayed")
+                elif event.event_id > position + 1:
+                    if not _gap_expired(redis_client, position + 1):
+                        break
+                    Logger.warning(f"Outbox events {position + 1}-{event.event_id - 1} never committed, skipped")
+                ready.append(event)
+                position = max(position, event.event_id)
+            if not ready:
+                break
+
+            pipe = redis_client.pipeline(transaction=False)
+            for event in ready:
+                pipe.xadd(OUTBOX_STREAM_KEY, {
+                    "event_id": event.event_id,
+                    "user_id": event.user_id if event.user_id is not None else "",
+                    "entity": event.entity,
+                    "entity_id": event.entity_id if event.entity_id is not None else "",
+                    "action": event.action,
+                    "payload": event.payload or "",
+                    "created_at": event.created_at.isoformat() if event.created_at else "",
+                }, maxlen=OUTBOX_STREAM_MAXLEN, approximate=True)
+            pipe.set(OUTBOX_RELAY_POSITION_KEY, position)
+            pipe.execute()
+
+            db.execute(update(OutboxEvent).where(OutboxEvent.event_id.in_(
+                [event.event_id for event in ready])).values(published_at=datetime.datetime.utcnow()))
+            db.commit()
+            published += len(ready)
+            if len(ready) < len(events):
+                # waiting on a gap
+                break
+            # keep the lock while there is more to send
+            redis_client.expire(OUTBOX_RELAY_LOCK_KEY, OUTBOX_RELAY_LOCK_TTL)
+
+        horizon = datetime.datetime.utcnow() - datetime.timedelta(hours=OUTBOX_RETENTION_HOURS)
+        db.execute(delete(OutboxEvent).where(
+            OutboxEvent.published_at.is_not(None), OutboxEvent.published_at < horizon))
+        db.commit()
+    finally:
+        redis_client.eval(RELEASE_LOCK_SCRIPT, 1, OUTBOX_RELAY_LOCK_KEY, token)
+
+    if published:
+        Logger.info(f"Relayed {published} outbox events")
+    return published
+
+
+class OutboxConsumer:
+    """
+    Consumer group reader for the change stream.
+
+    Each group sees every event; its position is the group's offset in
+    Redis. An event is acknowledged only after the handler returns, and
+    events left pending by a consumer that died are claimed after
+    OUTBOX_CLAIM_IDLE_MS, so handlers must tolerate repeats.
+    """
+
+    def __init__(self, cache: RedisCache, group: str, consumer: str, start_id: str = "0"):
+        self.redis = cache.redis_client
+        self.group = group
+        self.consumer = consumer
+        try:
+            self.redis.xgroup_create(
+                OUTBOX_STREAM_KEY, group, id=start_id, mkstream=True)
+        except redis.exceptions.ResponseError as error:
+            if "BUSYGROUP" not in str(error):
+                raise
+
+    @staticmethod
+    def _event(fields: dict) -> dict:
+        event = {key.decode(): value.decode() for key, value in fields.items()}
+        event["event_id"] = int(event["event_id"])
+        event["user_id"] = int(event["user_id"]) if event["user_id"] else None
+        event["entity_id"] = int(event["entity_id"]) if event["entity_id"] else None
+        event["payload"] = json.loads(event["payload"]) if event["payload"] else None
+        return event
+
+    def consume(self, handler: Callable[[dict], None], count: int = 100, block_ms: Optional[int] = 5000) -> int:
+        """
+        Hand the next events to handler, acknowledging each that succeeds.
+        With block_ms None it returns at once when nothing is new.
+        """
+        # Redis 6.2 replies [next_id, messages], 7.0 adds deleted ids
+        claimed = self.redis.xautoclaim(
+            OUTBOX_STREAM_KEY, self.group, self.consumer, OUTBOX_CLAIM_IDLE_MS, "0-0", count=count)
+        messages = list(claimed[1])
+
+        # our own unacknowledged messages first, then new ones
+        for stream_id in ("0", ">"):
+            if messages:
+                break
+            response = self.redis.xreadgroup(
+                self.group, self.consumer, {OUTBOX_STREAM_KEY: stream_id}, count=count,
+                block=block_ms if stream_id == ">" else None)
+            messages = response[0][1] if response else []
+
+        handled = 0
+        for message_id, fields in messages:
+            if not fields:
+                # trimmed from the stream before it was handled
+                self.redis.xack(OUTBOX_STREAM_KEY, self.group, message_id)
+                continue
+            handler(self._event(fields))
+            self.redis.xack(OUTBOX_STREAM_KEY, self.group, message_id)
+            handled += 1
+        return handled
@@ -0,0 +1,92 @@
+import json
+import datetime
+from typing import NamedTuple, Optional
+from fastapi.responses import Response
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from models import Account, Budget, Category, Expense
+
+# Read-only projections for the list endpoints. Rows come straight from
+# Core selects into immutable tuples and are dumped to JSON without going
+# through ORM identity maps or per-row Pydantic validation.
+
+
+class ExpenseRow(NamedTuple):
+    expense_id: int
+    account_id: int
+    category: Optional[str]
+    amount: float
+    date: datetime.date
+    notes: Optional[str]
+
+
+class AccountRow(NamedTuple):
+    account_id: int
+    account_name: str
+    balance: float
+    created_at: Optional[datetime.datetime]
+    updated_at: Optional[datetime.datetime]
+
+
+class BudgetRow(NamedTuple):
+    budget_id: int
+    account_id: int
+    amount: float
+    start_date: datetime.date
+    end_date: datetime.date
+
+
+def select_expenses(*filters, model=Expense):
+    """Expense rows from the hot table, or from the archive with model=ExpenseArchive"""
+    return select(
+        model.expense_id,
+        model.account_id,
+        Category.category_name.label("category"),
+        model.amount,
+        model.date,
+        model.notes,
+    ).outerjoin(Category, Category.category_id == model.category_id).where(*filters)
+
+
+def select_accounts(*filters):
+    return select(
+        Account.account_id,
+        Account.account_name,
+        Account.balance,
+        Account.created_at,
+        Account.updated_at,
+    ).where(*filters)
+
+
+def select_budgets(*filters):
+    return select(
+        Budget.budget_id,
+        Budget.account_id,
+        Budget.amount,
+        Budget.start_date,
+        Budget.end_date,
+    ).where(*filters)
+
+
+def fetch_rows(db: Session, statement, row_type):
+    return [row_type._make(row) for row in db.execute(statement)]
+
+
+def _encode(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def rows_to_json(rows) -> str:
+    return json.dumps([row._asdict() for row in rows], default=_encode)
+
+
+class RowsResponse(Response):
+    """JSON response for a list of projection rows"""
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        if isinstance(content, (str, bytes)):
+            return content.encode() if isinstance(content, str) else content
+        return rows_to_json(content).encode()
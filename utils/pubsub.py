@@ -0,0 +1,75 @@
+import os
+import asyncio
+import logging
+import contextlib
+import redis
+import redis.asyncio as aioredis
+from .redis import REDIS_HOST, REDIS_PORT, REDIS_DB
+
+Logger = logging.getLogger(__name__)
+
+REPORT_CHANNEL_PREFIX = os.getenv("REPORT_CHANNEL_PREFIX", "report_status:")
+
+
+class ReportStatusHub:
+    """
+    Fan out report status messages to the listeners of this process.
+
+    A single Redis pub/sub connection pattern-subscribes to every report
+    channel and hands each message to the asyncio queues registered for
+    that report, so idle subscribers cost a queue rather than a thread or
+    a Redis connection each.
+    """
+
+    def __init__(self):
+        self._listeners = {}
+        self._reader = None
+
+    def start(self):
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._reader
+            self._reader = None
+
+    @contextlib.asynccontextmanager
+    async def listen(self, report_id: str):
+        self.start()
+        queue = asyncio.Queue()
+        self._listeners.setdefault(report_id, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            listeners = self._listeners.get(report_id)
+            if listeners is not None:
+                listeners.discard(queue)
+                if not listeners:
+                    del self._listeners[report_id]
+
+    async def _run(self):
+        while True:
+            client = aioredis.Redis(
+                host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+            pubsub = client.pubsub()
+            try:
+                await pubsub.psubscribe(f"{REPORT_CHANNEL_PREFIX}*")
+                async for message in pubsub.listen():
+                    if message["type"] != "pmessage":
+                        continue
+                    channel = message["channel"].decode()
+                    report_id = channel[len(REPORT_CHANNEL_PREFIX):]
+                    for queue in self._listeners.get(report_id, ()):
+                        queue.put_nowait(message["data"])
+            except redis.exceptions.RedisError:
+                Logger.exception("Report status subscription lost, retrying")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.close()
+                await client.close()
+
+
+report_status_hub = ReportStatusHub()
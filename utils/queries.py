@@ -0,0 +1,90 @@
+from datetime import date
+from typing import List, Optional
+from sqlalchemy import select, func, lambda_stmt
+from sqlalchemy.orm import Session
+from models import Account, Budget, Expense, ExpenseArchive, User
+
+# Hot-path queries as lambda statements. Each is built and its cache key
+# computed once per call site; later calls only read the closure values,
+# which become bound parameters, and reuse the compiled SQL. Only those
+# values may vary: choose models or columns with separate functions.
+
+
+def user_by_email(db: Session, email: str) -> Optional[User]:
+    """The has_access and login lookup"""
+    statement = lambda_stmt(lambda: select(User).where(User.email == email).limit(1))
+    return db.execute(statement).scalars().first()
+
+
+def owned_account(db: Session, user_id: int, account_id: int) -> Optional[Account]:
+    statement = lambda_stmt(lambda: select(Account).where(
+        Account.account_id == account_id, Account.user_id == user_id).limit(1))
+    return db.execute(statement).scalars().first()
+
+
+def account_by_name(db: Session, user_id: int, account_name: str) -> Optional[Account]:
+    statement = lambda_stmt(lambda: select(Account).where(
+        Account.user_id == user_id, Account.account_name == account_name).limit(1))
+    return db.execute(statement).scalars().first()
+
+
+def owned_budget(db: Session, user_id: int, budget_id: int) -> Optional[Budget]:
+    statement = lambda_stmt(lambda: select(Budget).where(
+        Budget.budget_id == budget_id, Budget.user_id == user_id).limit(1))
+    return db.execute(statement).scalars().first()
+
+
+def account_budget(db: Session, user_id: int, account_id: int, budget_id: int) -> Optional[Budget]:
+    statement = lambda_stmt(lambda: select(Budget).where(
+        Budget.user_id == user_id, Budget.account_id == account_id,
+        Budget.budget_id == budget_id).limit(1))
+    return db.execute(statement).scalars().first()
+
+
+def account_spent(db: Session, account_id: int) -> float:
+    """Sum of the account's hot expenses"""
+    statement = lambda_stmt(lambda: select(func.sum(Expense.amount)).where(
+        Expense.account_id == account_id))
+    return db.execute(statement).scalar() or 0.00
+
+
+def archived_account_spent(db: Session, account_id: int) -> float:
+    statement = lambda_stmt(lambda: select(func.sum(ExpenseArchive.amount)).where(
+        ExpenseArchive.account_id == account_id))
+    return db.execute(statement).scalar() or 0.00
+
+
+def budget_spent(db: Session, user_id: int, account_id: int, start_date: date, end_date: date) -> float:
+    """Sum of a user's hot expenses on an account within a date range"""
+    statement = lambda_stmt(lambda: select(func.sum(Expense.amount)).where(
+        Expense.user_id == user_id, Expense.account_id == account_id,
+        Expense.date >= start_date, Expense.date <= end_date))
+    return db.execute(statement).scalar() or 0.00
+
+
+def archived_budget_spent(db: Session, user_id: int, account_id: int, start_date: date, end_date: date) -> float:
+    statement = lambda_stmt(lambda: select(func.sum(ExpenseArchive.amount)).where(
+        ExpenseArchive.user_id == user_id, ExpenseArchive.account_id == account_id,
+        ExpenseArchive.date >= start_date, ExpenseArchive.date <= end_date))
+    return db.execute(statement).scalar() or 0.00
+
+
+def user_accounts(db: Session, user_id: int) -> List[Account]:
+    statement = lambda_stmt(lambda: select(Account).where(Account.user_id == user_id))
+    return db.execute(statement).scalars().all()
+
+
+def user_expenses(db: Session, user_id: int) -> List[Expense]:
+    statement = lambda_stmt(lambda: select(Expense).where(Expense.user_id == user_id))
+    return db.execute(statement).scalars().all()
+
+
+def archived_user_expenses(db: Session, user_id: int) -> List[ExpenseArchive]:
+    statement = lambda_stmt(lambda: select(ExpenseArchive).where(
+        ExpenseArchive.user_id == user_id))
+    return db.execute(statement).scalars().all()
+
+
+def user_budgets(db: Session, user_id: int) -> List[Budget]:
+    statement = lambda_stmt(lambda: select(Budget).where(Budget.user_id == user_id))
+    return db.execute(statement).scalars().all()
@@ -0,0 +1,272 @@
+import os
+import re
+import json
+import uuid
+import logging
+from collections import defaultdict
+from datetime import date, datetime, time
+from typing import List, Optional
+from dateutil.rrule import rrulestr
+from sqlalchemy import select, update, insert, func, and_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from .redis import RedisCache, RELEASE_LOCK_SCRIPT
+from .budget_index import BUDGET_SPENT_PREFIX, BUDGET_ALERT_THRESHOLDS, INCREMENT_SPENT_SCRIPT, drop_spent_totals
+from .spending import SpendingModel
+from models import Account, Budget, Expense, ExpenseArchive, OutboxEvent, RecurringExpense
+
+Logger = logging.getLogger(__name__)
+
+# rules read, expanded and inserted per transaction
+RECURRING_BATCH_SIZE = int(os.getenv("RECURRING_BATCH_SIZE", 1000))
+# most occurrences one rule catches up on per run
+RECURRING_MAX_CATCHUP = int(os.getenv("RECURRING_MAX_CATCHUP", 366))
+# rows per INSERT or key lookup statement, within driver parameter limits
+RECURRING_CHUNK_SIZE = int(os.getenv("RECURRING_CHUNK_SIZE", 1000))
+RECURRING_LOCK_KEY = os.getenv("RECURRING_LOCK_KEY", "recurring:lock")
+RECURRING_LOCK_TTL = int(os.getenv("RECURRING_LOCK_TTL", 600))
+
+# expenses are dated by day, HOURLY and finer rules would repeat one
+SUB_DAILY_FREQUENCIES = ("HOURLY", "MINUTELY", "SECONDLY")
+
+
+def parse_rule(rule: str, start_date: date):
+    """The rule's schedule starting at start_date; raises ValueError if rule is invalid"""
+    frequencies = re.findall(r"(?:^|[\s:;])FREQ=(\w*)", rule, re.IGNORECASE)
+    if not frequencies:
+        raise ValueError("Rules need a FREQ")
+    if any(frequency.upper() in SUB_DAILY_FREQUENCIES for frequency in frequencies):
+        raise ValueError("Rules may repeat at most daily")
+    schedule = rrulestr(rule, dtstart=datetime.combine(start_date, time()))
+    if not hasattr(schedule, "between"):
+        raise ValueError("Only a single RRULE is supported")
+    return schedule
+
+
+def next_occurrence(rule: str, start_date: date, end_date: Optional[date], after: date, inclusive: bool = True) -> Optional[date]:
+    """First occurrence on or after (or strictly after) a date, within the rule's end date"""
+    # strictly after skips the whole day, a rule may list several times in it
+    found = parse_rule(rule, start_date).after(
+        datetime.combine(after, time() if inclusive else time.max), inc=inclusive)
+    if found is None or (end_date is not None and found.date() > end_date):
+        return None
+    return found.date()
+
+
+def occurrence_key(recurring_id: int, day: date) -> str:
+    return f"{recurring_id}:{day.isoformat()}"
+
+
+def _chunks(items: list):
+    for start in range(0, len(items), RECURRING_CHUNK_SIZE):
+        yield items[start:start + RECURRING_CHUNK_SIZE]
+
+
+def _insert_ignoring_duplicates(db: Session, rows: List[dict]):
+    """Insert expenses, skipping occurrence keys that already exist; returns the inserted rows"""
+    dialect = postgresql if db.bind.dialect.name == "postgresql" else sqlite
+    inserted = []
+    for chunk in _chunks(rows):
+        statement = dialect.insert(Expense).values(chunk).on_conflict_do_nothing(
+            index_elements=["occurrence_key"]).returning(
+            Expense.expense_id, Expense.user_id, Expense.account_id,
+            Expense.category_id, Expense.amount, Expense.date, Expense.notes, Expense.occurrence_key)
+        inserted.extend(db.execute(statement).all())
+    return inserted
+
+
+def _spent_by_account(db: Session, account_ids) -> dict:
+    spent = defaultdict(float)
+    for model in (Expense, ExpenseArchive):
+        for account_id, total in db.execute(select(model.account_id, func.sum(model.amount)).where(
+                model.account_id.in_(account_ids)).group_by(model.account_id)):
+            spent[account_id] += total or 0.0
+    return spent
+
+
+def _budget_alerts(db: Session, cache: RedisCache, inserted) -> List[dict]:
+    """
+    Totals of every budget the inserted expenses count towards, in one
+    query per expense table. Returns the alerts for thresholds the insert
+    crossed, and adds the new spend to the running totals.
+    """
+    account_ids = {row.account_id for row in inserted}
+    first, last = min(row.date for row in inserted), max(row.date for row in inserted)
+    budgets = db.execute(select(Budget.budget_id, Budget.user_id, Budget.account_id,
+                                Budget.start_date, Budget.end_date, Budget.amount).where(
+        Budget.account_id.in_(account_ids), Budget.start_date <= last, Budget.end_date >= first)).all()
+    if not budgets:
+        return []
+
+    added = defaultdict(float)
+    # each expense is added on its own, so a total seeded after it skips it
+    expenses = defaultdict(list)
+    by_account = defaultdict(list)
+    for budget in budgets:
+        by_account[budget.account_id].append(budget)
+    for row in inserted:
+        for budget in by_account[row.account_id]:
+            if budget.start_date <= row.date <= budget.end_date:
+                added[budget.budget_id] += row.amount
+                expenses[budget.budget_id].append(row)
+
+    # totals now, inserted rows included
+    budget_ids = [budget.budget_id for budget in budgets]
+    spent = defaultdict(float)
+    for model in (Expense, ExpenseArchive):
+        for budget_id, total in db.execute(select(Budget.budget_id, func.sum(model.amount)).join(model, and_(
+                model.account_id == Budget.account_id,
+                model.date >= Budget.start_date,
+                model.date <= Budget.end_date,
+        )).where(Budget.budget_id.in_(budget_ids)).group_by(Budget.budget_id)):
+            spent[budget_id] += total or 0.0
+
+    alerts = []
+    pipe = cache.redis_client.pipeline(transaction=False)
+    for budget in budgets:
+        amount = added.get(budget.budget_id)
+        if not amount:
+            continue
+        for row in expenses[budget.budget_id]:
+            pipe.eval(INCREMENT_SPENT_SCRIPT, 1, f"{BUDGET_SPENT_PREFIX}{budget.user_id}",
+                      budget.budget_id, row.amount, row.expense_id)
+        total = spent[budget.budget_id]
+        for threshold in BUDGET_ALERT_THRESHOLDS:
+            if total - amount < threshold * budget.amount <= total:
+                alerts.append({
+                    "user_id": budget.user_id,
+                    "account_id": budget.account_id,
+                    "budget_id": budget.budget_id,
+                    "threshold": threshold,
+                    "spent": round(total, 2),
+                    "amount": budget.amount,
+                })
+    cache.call(pipe.execute, lambda: drop_spent_totals(
+        cache, {budget.user_id for budget in budgets}))
+    return alerts
+
+
+def materialize_recurring(db: Session, cache: RedisCache, today: Optional[date] = None) -> dict:
+    """
+    Insert every due occurrence of every active recurring expense.
+
+    Rules are read RECURRING_BATCH_SIZE at a time. Each batch runs a
+    fixed number of statements whatever the number of users (more only
+    past RECURRING_CHUNK_SIZE occurrences): a lookup of
+    occurrences already inserted, one grouped balance query, one insert of
+    all occurrences, one insert of their change events and one update of
+    the rules' next dates. Occurrence keys are unique, so a rerun after a
+    crash inserts nothing twice. An occurrence that would overdraw its
+    account is skipped.
+    """
+    today = today or date.today()
+    token = uuid.uuid4().hex
+    stats = {"rules": 0, "inserted": 0, "existing": 0,
+             "skipped_balance": 0, "alerts": []}
+    if not cache.redis_client.set(RECURRING_LOCK_KEY, token, nx=True, ex=RECURRING_LOCK_TTL):
+        return stats
+
+    try:
+        last_id = 0
+        while True:
+            rules = db.execute(select(RecurringExpense).where(
+                RecurringExpense.active.is_(True),
+                RecurringExpense.next_date <= today,
+                RecurringExpense.recurring_id > last_id,
+            ).order_by(RecurringExpense.recurring_id).limit(RECURRING_BATCH_SIZE)).scalars().all()
+            if not rules:
+                break
+            last_id = rules[-1].recurring_id
+            stats["rules"] += len(rules)
+            _materialize_batch(db, cache, rules, today, stats)
+            cache.redis_client.expire(RECURRING_LOCK_KEY, RECURRING_LOCK_TTL)
+    finally:
+        cache.redis_client.eval(RELEASE_LOCK_SCRIPT, 1, RECURRING_LOCK_KEY, token)
+
+    if stats["rules"]:
+        Logger.info(f"Materialized {stats['inserted']} recurring expenses from {stats['rules']} rules, "
+                    f"{stats['skipped_balance']} skipped for balance")
+    return stats
+
+
+def _materialize_batch(db: Session, cache: RedisCache, rules, today: date, stats: dict) -> None:
+    occurrences = []
+    next_dates = []
+    for rule in rules:
+        try:
+            schedule = parse_rule(rule.rrule, rule.start_date)
+        except ValueError as error:
+            # saved before the rule was validated, stop it rather than the batch
+            Logger.warning(f"Deactivating recurring expense {rule.recurring_id}: {error}")
+            next_dates.append({"recurring_id": rule.recurring_id, "next_date": rule.next_date, "active": False})
+            continue
+        last = today if rule.end_date is None else min(today, rule.end_date)
+        # one occurrence per day, BYHOUR and the like may list several
+        due = list(dict.fromkeys(found.date() for found in schedule.between(
+            datetime.combine(rule.next_date, time()), datetime.combine(last, time.max),
+            inc=True)))[:RECURRING_MAX_CATCHUP]
+        occurrences.extend((day, rule) for day in due)
+
+        resume = due[-1] if due else today
+        following = next_occurrence(rule.rrule, rule.start_date, rule.end_date, resume, inclusive=False)
+        next_dates.append({"recurring_id": rule.recurring_id, "next_date": following,
+                           "active": following is not None})
+
+    # balance checks for all accounts of the batch at once, in date order
+    account_ids = {rule.account_id for rule in rules}
+    balances = dict(db.execute(select(Account.account_id, Account.balance).where(
+        Account.account_id.in_(account_ids))).all())
+    spent = _spent_by_account(db, account_ids)
+
+    # occurrences a crashed run already inserted, so they are not charged twice
+    keys = [occurrence_key(rule.recurring_id, day) for day, rule in occurrences]
+    existing = set()
+    for chunk in _chunks(keys):
+        existing.update(db.execute(select(Expense.occurrence_key).where(
+            Expense.occurrence_key.in_(chunk))).scalars())
+    stats["existing"] += len(existing)
+
+    rows = []
+    occurrences.sort(key=lambda occurrence: (occurrence[0], occurrence[1].recurring_id))
+    for day, rule in occurrences:
+        if occurrence_key(rule.recurring_id, day) in existing:
+            continue
+        if spent[rule.account_id] + rule.amount > balances.get(rule.account_id, 0.0):
+            stats["skipped_balance"] += 1
+            continue
+        spent[rule.account_id] += rule.amount
+        rows.append({
+            "user_id": rule.user_id,
+            "account_id": rule.account_id,
+            "category_id": rule.category_id,
+            "amount": rule.amount,
+            "date": day,
+            "notes": rule.notes,
+            "occurrence_key": occurrence_key(rule.recurring_id, day),
+        })
+
+    inserted = _insert_ignoring_duplicates(db, rows) if rows else []
+    if inserted:
+        db.execute(insert(OutboxEvent), [{
+            "user_id": row.user_id,
+            "entity": "expense",
+            "action": "created",
+            "entity_id": row.expense_id,
+            "payload": json.dumps({**row._asdict(), "date": row.date.isoformat()}),
+        } for row in inserted])
+    db.execute(update(RecurringExpense), next_dates)
+    db.commit()
+    stats["inserted"] += len(inserted)
+    if not inserted:
+        return
+
+    stats["alerts"].extend(_budget_alerts(db, cache, inserted))
+
+    # one round trip for every user and account touched
+    users = {row.user_id for row in inserted}
+    cache.bump_many_versions(users, "expenses")
+    # accounts without statistics yet build them, these rows included, when next read
+    spending = SpendingModel(cache)
+    for row in sorted(inserted, key=lambda row: (row.date, row.expense_id)):
+        spending.record_expense(row.user_id, row.account_id, row.expense_id,
+                                row.category_id, row.date, row.amount)
@@ -1,35 +1,395 @@
 import redis
 import os
+import math
+import time
+import uuid
+import random
 import logging
+import threading
+from collections import deque
+from typing import Optional
+from concurrent.futures import Future
+from .tracing import traced
+from .breaker import CircuitBreaker, LocalCache
 
 Logger = logging.getLogger(__name__)
 
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = os.getenv("REDIS_PORT", 6379)
 REDIS_DB = os.getenv("REDIS_DB", 0)
+# seconds a command or a connection attempt may take before it fails
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 1.0))
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", 0.5))
+# consecutive failures that open the circuit, and seconds before a retry
+REDIS_BREAKER_THRESHOLD = int(os.getenv("REDIS_BREAKER_THRESHOLD", 5))
+REDIS_BREAKER_RESET = float(os.getenv("REDIS_BREAKER_RESET", 10))
+# in-process copy of recent values, served while Redis is unavailable
+REDIS_FALLBACK_SIZE = int(os.getenv("REDIS_FALLBACK_SIZE", 2000))
+REDIS_FALLBACK_TTL = float(os.getenv("REDIS_FALLBACK_TTL", 30))
+# invalidations kept for replay once Redis is back
+REDIS_REPLAY_LOG_SIZE = int(os.getenv("REDIS_REPLAY_LOG_SIZE", 10000))
+
+VERSION_PREFIX = os.getenv("VERSION_PREFIX", "version:")
+# users written to since the last scheduled report run
+DIRTY_USERS_KEY = os.getenv("DIRTY_USERS_KEY", "scheduled_reports:dirty")
+
+# single-flight recomputation of cached values
+CACHE_LOCK_TTL = float(os.getenv("CACHE_LOCK_TTL", 5))
+CACHE_LOCK_WAIT = float(os.getenv("CACHE_LOCK_WAIT", 2))
+CACHE_LOCK_POLL = float(os.getenv("CACHE_LOCK_POLL", 0.05))
+CACHE_STALE_TIME = int(os.getenv("CACHE_STALE_TIME", 60))
+CACHE_EARLY_REFRESH_BETA = float(os.getenv("CACHE_EARLY_REFRESH_BETA", 1.0))
+
+# delete the lock only if we still own it
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
 
 Logger.info(f"Redis host: {REDIS_HOST}, port: {REDIS_PORT}, db: {REDIS_DB}")
 
 
 class RedisCache:
+    """
+    Redis client for cached values, versions and invalidations.
+
+    Commands fail after REDIS_SOCKET_TIMEOUT, and after repeated failures
+    a circuit breaker skips Redis altogether for a while. Meanwhile reads
+    are served from a short-lived in-process copy or recomputed, and
+    invalidations are logged and replayed once Redis answers again.
+    Code using redis_client directly gets the timeouts only, so request
+    paths send their own commands through call().
+    """
+
     def __init__(self):
         self.redis_pool = redis.ConnectionPool(
-            host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+            host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB,
+            socket_timeout=REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=REDIS_CONNECT_TIMEOUT)
         self.redis_client = redis.Redis(connection_pool=self.redis_pool)
+        self.breaker = CircuitBreaker(
+            REDIS_BREAKER_THRESHOLD, REDIS_BREAKER_RESET)
+        self.local = LocalCache(REDIS_FALLBACK_SIZE, REDIS_FALLBACK_TTL)
+        self._replay_log = deque()
+        self._replay_lock = threading.Lock()
+        self._dropped_invalidations = 0
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+
+    def call(self, operation, fallback=lambda: None):
+        """
+        Run operation against Redis, or return fallback() when it is
+        unavailable. Modules with commands of their own go through here so
+        they share the breaker.
+        """
+        if not self.breaker.allow():
+            return fallback()
+        try:
+            result = operation()
+        except redis.exceptions.RedisError as error:
+            self._failed(error)
+            return fallback()
+        self._succeeded()
+        return result
+
+    def _failed(self, error: Exception) -> None:
+        self.breaker.record_failure()
+        Logger.warning(f"Redis unavailable ({self.breaker.state}): {error}")
+
+    def _succeeded(self) -> None:
+        if self.breaker.record_success():
+            Logger.info("Redis available again")
+        if self._replay_log:
+            self._replay()
+
+    def _log_invalidation(self, *entry) -> None:
+        if len(self._replay_log) >= REDIS_REPLAY_LOG_SIZE:
+            self._replay_log.popleft()
+            self._dropped_invalidations += 1
+        self._replay_log.append(entry)
+
+    def _replay(self) -> None:
+        """Apply invalidations that failed while Redis was unavailable, oldest first"""
+        if not self._replay_lock.acquire(blocking=False):
+            return
+        replayed = 0
+        try:
+            while self._replay_log:
+                entry = self._replay_log.popleft()
+                try:
+                    self._apply_invalidation(*entry)
+                except redis.exceptions.RedisError as error:
+                    self._replay_log.appendleft(entry)
+                    self._failed(error)
+                    break
+                replayed += 1
+        finally:
+            self._replay_lock.release()
 
+        if replayed:
+            Logger.info(f"Replayed {replayed} missed Redis invalidations")
+        if self._dropped_invalidations:
+            Logger.error(
+                f"{self._dropped_invalidations} Redis invalidations were dropped from a full replay log")
+            self._dropped_invalidations = 0
+
+    def _apply_invalidation(self, kind: str, *args) -> None:
+        if kind == "delete":
+            self.redis_client.delete(*args)
+        elif kind == "pattern":
+            self._delete_pattern(*args)
+        elif kind == "bump":
+            self._bump_versions(*args)
+
+    def metrics(self) -> dict:
+        return {
+            **self.breaker.metrics(),
+            "fallback_entries": len(self.local),
+            "pending_invalidations": len(self._replay_log),
+        }
+
+    @traced("redis.get")
     def get(self, name):
-        return self.redis_client.get(name)
+        def operation():
+            value = self.redis_client.get(name)
+            if value is not None:
+                self.local.set(name, value)
+            return value
+        return self.call(operation, lambda: self.local.get(name))
 
+    @traced("redis.set")
     def set_(self, name, value, expiration_time: int = 3600):
-        self.redis_client.set(name, value, expiration_time)
+        self.local.set(name, value, expiration_time)
+        self.call(lambda: self.redis_client.set(
+            name, value, expiration_time), lambda: None)
+
+    @traced("redis.add")
+    def add(self, name, value, expiration_time: int = 3600) -> bool:
+        """Set name only if it does not exist yet"""
+        return bool(self.call(
+            lambda: self.redis_client.set(
+                name, value, ex=expiration_time, nx=True),
+            lambda: self.local.add(name, value, expiration_time)))
+
+    @traced("redis.get_or_compute")
+    def get_or_compute(self, name, compute, expiration_time: int = 3600, stale_time: int = CACHE_STALE_TIME):
+        """
+        Like _get_or_compute, computing locally while Redis is unavailable.
+        Concurrent callers in this process share one lookup, and its result
+        or exception.
+        """
+        def fallback():
+            value = self.local.get(name)
+            if value is None:
+                value = compute()
+                if isinstance(value, str):
+                    value = value.encode()
+                self.local.set(name, value, expiration_time)
+            return value
+
+        def operation():
+            value = self._get_or_compute(
+                name, compute, expiration_time, stale_time)
+            self.local.set(name, value, expiration_time)
+            return value
+        return self._single_flight(name, lambda: self.call(operation, fallback))
+
+    def _single_flight(self, name, load):
+        with self._flights_lock:
+            flight = self._flights.get(name)
+            leader = flight is None
+            if leader:
+                flight = self._flights[name] = Future()
+        if not leader:
+            return flight.result()
 
-    def delete_key(self, key: str) -> bool:
         try:
-            self.redis_client.delete(key)
+            value = load()
+        except BaseException as error:
+            flight.set_exception(error)
+            raise
+        else:
+            flight.set_result(value)
+            return value
+        finally:
+            with self._flights_lock:
+                del self._flights[name]
+
+    def _get_or_compute(self, name, compute, expiration_time: int, stale_time: int):
+        """
+        Return the cached value for name, calling compute() to rebuild it.
+
+        Entries remember their logical expiry and how long compute() took,
+        and are kept for stale_time past that expiry. Readers refresh ahead
+        of expiry with a probability that grows as it approaches (XFetch).
+        Only the holder of a short lock recomputes; other callers serve the
+        stale value if there is one, or wait for the fresh one. If the holder
+        fails, one waiter takes the lock over. Only a holder slower than
+        CACHE_LOCK_WAIT lets waiting processes compute, once each.
+        """
+        value = seen = None
+        entry = self._unpack(self.redis_client.get(name))
+        if entry is not None:
+            seen, delta, value = entry
+            early = delta * CACHE_EARLY_REFRESH_BETA * \
+                math.log(1.0 - random.random())
+            if time.time() - early < seen:
+                return value
+
+        lock_name = f"{name}:lock"
+        token = uuid.uuid4().hex
+        if self._acquire(lock_name, token):
+            return self._recompute_locked(name, compute, expiration_time, stale_time, lock_name, token, seen)
+
+        if value is not None:
+            return value
+
+        deadline = time.monotonic() + CACHE_LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(CACHE_LOCK_POLL)
+            entry = self._unpack(self.redis_client.get(name))
+            if entry is not None:
+                return entry[2]
+            # released without a value: the holder failed, take over
+            if self._acquire(lock_name, token):
+                return self._recompute_locked(name, compute, expiration_time, stale_time, lock_name, token, seen)
+
+        # the holder is too slow, don't keep the caller waiting
+        return self._recompute(name, compute, expiration_time, stale_time)
+
+    def _acquire(self, lock_name: str, token: str) -> bool:
+        return bool(self.redis_client.set(lock_name, token, nx=True, px=int(CACHE_LOCK_TTL * 1000)))
+
+    def _recompute_locked(self, name, compute, expiration_time: int, stale_time: int, lock_name: str, token: str, seen: Optional[float]) -> bytes:
+        try:
+            # the previous holder may have stored a value since our read
+            entry = self._unpack(self.redis_client.get(name))
+            if entry is not None and entry[0] != seen:
+                return entry[2]
+            return self._recompute(name, compute, expiration_time, stale_time)
+        finally:
+            self.redis_client.eval(RELEASE_LOCK_SCRIPT, 1, lock_name, token)
+
+    def _recompute(self, name, compute, expiration_time: int, stale_time: int) -> bytes:
+        started = time.time()
+        value = compute()
+        if isinstance(value, str):
+            value = value.encode()
+        delta = time.time() - started
+
+        header = b"%.3f:%.4f:" % (started + expiration_time, delta)
+        self.redis_client.set(name, header + value,
+                              expiration_time + stale_time)
+        return value
+
+    @staticmethod
+    def _unpack(entry: Optional[bytes]):
+        """
+        (expires_at, delta, value) of an entry, or None when it is missing
+        or written in another format, like the plain values of older code
+        """
+        if entry is None:
+            return None
+        try:
+            expires_at, delta, value = entry.split(b":", 2)
+            return float(expires_at), float(delta), value
+        except ValueError:
+            return None
+
+    @traced("redis.get_versions")
+    def get_versions(self, user_id: int, *resources: str) -> list:
+        """
+        Current data version of each resource of a user.
+
+        Missing counters start from the current time rather than zero, so a
+        flushed Redis never hands out a version a client has seen before.
+        Without Redis every call gets new versions: nothing matches a cached
+        ETag or key, and readers go to the database.
+        """
+        keys = [f"{VERSION_PREFIX}{resource}:{user_id}" for resource in resources]
+
+        def operation():
+            versions = self.redis_client.mget(keys)
+            if None in versions:
+                pipe = self.redis_client.pipeline()
+                for key in keys:
+                    pipe.set(key, time.time_ns(), nx=True)
+                pipe.mget(keys)
+                versions = pipe.execute()[-1]
+            return [int(version) for version in versions]
+        return self.call(operation, lambda: [time.time_ns()] * len(keys))
+
+    @traced("redis.bump_versions")
+    def bump_versions(self, user_id: int, *resources: str) -> None:
+        """Mark resources of a user as changed, and the user as due a new scheduled report"""
+        self.bump_many_versions([user_id], *resources)
+
+    @traced("redis.bump_versions")
+    def bump_many_versions(self, user_ids, *resources: str) -> None:
+        """bump_versions for many users in one round trip"""
+        user_ids = tuple(user_ids)
+        if user_ids:
+            self.call(lambda: self._bump_versions(user_ids, resources),
+                      lambda: self._log_invalidation("bump", user_ids, resources))
+
+    def _bump_versions(self, user_ids, resources) -> None:
+        pipe = self.redis_client.pipeline()
+        for user_id in user_ids:
+            for resource in resources:
+                key = f"{VERSION_PREFIX}{resource}:{user_id}"
+                pipe.set(key, time.time_ns(), nx=True)
+                pipe.incr(key)
+        pipe.sadd(DIRTY_USERS_KEY, *user_ids)
+        pipe.execute()
+
+    @traced("redis.publish")
+    def publish(self, channel: str, message) -> int:
+        return self.call(lambda: self.redis_client.publish(channel, message), lambda: 0)
+
+    @traced("redis.delete")
+    def delete_key(self, key: str) -> bool:
+        return self.delete_keys(key)
+
+    @traced("redis.delete")
+    def delete_keys(self, *keys: str) -> bool:
+        """Delete keys, or log them for replay and return False when Redis is unavailable"""
+        if not keys:
             return True
-        except redis.exceptions.RedisError:
-            return False
+        self.local.delete(*keys)
+        return self.call(lambda: self.redis_client.delete(*keys) is not None,
+                         lambda: self._log_invalidation("delete", *keys) or False)
+
+    @traced("redis.delete_pattern")
+    def delete_pattern(self, pattern: str, batch_size: int = 500) -> int:
+        """Delete keys matching a glob pattern, scanning rather than blocking on KEYS"""
+        self.local.delete_pattern(pattern)
+        return self.call(lambda: self._delete_pattern(pattern, batch_size),
+                         lambda: self._log_invalidation("pattern", pattern) or 0)
+
+    def _delete_pattern(self, pattern: str, batch_size: int = 500) -> int:
+        deleted = 0
+        batch = []
+        for key in self.redis_client.scan_iter(match=pattern, count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                deleted += self.redis_client.unlink(*batch)
+                batch = []
+        if batch:
+            deleted += self.redis_client.unlink(*batch)
+        return deleted
+
+
+_cache = None
+_cache_lock = threading.Lock()
 
 
 def get_cache():
-    return RedisCache()
+    """The process-wide cache, so its pool, breaker and fallback are shared"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = RedisCache()
+    return _cache
@@ -0,0 +1,189 @@
+import os
+import json
+import mmap
+import time
+import zlib
+import logging
+from typing import Optional
+from .redis import RedisCache
+
+Logger = logging.getLogger(__name__)
+
+REPORT_STORAGE_DIR = os.getenv("REPORT_STORAGE_DIR", os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "reports"))
+REPORT_BLOB_PREFIX = os.getenv("REPORT_BLOB_PREFIX", "report_blob:")
+REPORT_INDEX_KEY = os.getenv("REPORT_INDEX_KEY", "report_store:redis")
+REPORT_SIZES_KEY = os.getenv("REPORT_SIZES_KEY", "report_store:redis_bytes")
+
+# compressed reports up to this size stay in redis, larger ones go to disk
+REPORT_INLINE_MAX_BYTES = int(os.getenv("REPORT_INLINE_MAX_BYTES", 64 * 1024))
+REPORT_COMPRESSION_LEVEL = int(os.getenv("REPORT_COMPRESSION_LEVEL", 6))
+REPORT_TTL = int(os.getenv("REPORT_TTL", 60 * 60 * 24))
+
+TIER_REDIS = "redis"
+TIER_FILE = "file"
+
+# mtime given to spilled reports that never expire
+FILE_NO_EXPIRY = 60 * 60 * 24 * 365 * 100
+
+
+class ReportStore:
+    """
+    Compressed, size-tiered storage for generated reports.
+
+    Report bodies are stored as zlib-compressed compact JSON, which is
+    exactly what HTTP calls the ``deflate`` content coding, so they can be
+    served to clients without being decompressed. Small payloads live in
+    Redis; large ones are spilled to ``REPORT_STORAGE_DIR``. A spilled
+    file's mtime is set to its expiry time so garbage collection only
+    needs a directory scan. Saving needs Redis; reads and cleanup go
+    through the cache's circuit breaker.
+    """
+
+    def __init__(self, cache: RedisCache, directory: str = REPORT_STORAGE_DIR):
+        self.cache = cache
+        self.directory = directory
+
+    def path(self, report_id: str) -> str:
+        return os.path.join(self.directory, f"{report_id}.json.z")
+
+    def save(self, report_id: str, body: dict, ttl: Optional[int] = REPORT_TTL) -> dict:
+        """Store a report body and return the metadata that locates it; ttl=None keeps it until replaced"""
+        raw = json.dumps(body, separators=(",", ":")).encode()
+        blob = zlib.compress(raw, REPORT_COMPRESSION_LEVEL)
+        expires_at = time.time() + ttl if ttl is not None else float("inf")
+
+        # a report saved again under the same id may change tier, the copy
+        # in the other tier is removed once the new one is in place
+        if len(blob) <= REPORT_INLINE_MAX_BYTES:
+            pipe = self.cache.redis_client.pipeline()
+            pipe.set(f"{REPORT_BLOB_PREFIX}{report_id}", blob, ex=ttl)
+            pipe.zadd(REPORT_INDEX_KEY, {report_id: expires_at})
+            pipe.hset(REPORT_SIZES_KEY, report_id, len(blob))
+            pipe.execute()
+            self._remove_file(report_id)
+            tier = TIER_REDIS
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self.path(report_id)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as file:
+                file.write(blob)
+            os.utime(tmp_path, (time.time(), min(
+                expires_at, time.time() + FILE_NO_EXPIRY)))
+            os.replace(tmp_path, path)
+            pipe = self.cache.redis_client.pipeline()
+            pipe.delete(f"{REPORT_BLOB_PREFIX}{report_id}")
+            pipe.zrem(REPORT_INDEX_KEY, report_id)
+            pipe.hdel(REPORT_SIZES_KEY, report_id)
+            pipe.execute()
+            self.cache.local.delete(f"{REPORT_BLOB_PREFIX}{report_id}")
+            tier = TIER_FILE
+
+        return {"tier": tier, "size": len(blob), "raw_size": len(raw)}
+
+    def read_compressed(self, report_id: str):
+        """Compressed bytes for a redis tier report, or None if it has expired"""
+        return self.cache.get(f"{REPORT_BLOB_PREFIX}{report_id}")
+
+    def file_path(self, report_id: str):
+        """Path of a spilled report, or None if it has expired"""
+        path = self.path(report_id)
+        try:
+            if os.stat(path).st_mtime < time.time():
+                return None
+        except FileNotFoundError:
+            return None
+        return path
+
+    def load(self, report_id: str, meta: dict):
+        """Decompressed report body, or None if it has expired"""
+        if meta.get("tier") == TIER_FILE:
+            path = self.file_path(report_id)
+            if path is None:
+                return None
+            with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as blob:
+                return json.loads(zlib.decompress(blob))
+
+        blob = self.read_compressed(report_id)
+        if blob is None:
+            return None
+        return json.loads(zlib.decompress(blob))
+
+    def delete(self, report_id: str) -> None:
+        self.cache.delete_key(f"{REPORT_BLOB_PREFIX}{report_id}")
+
+        def forget():
+            pipe = self.cache.redis_client.pipeline()
+            pipe.zrem(REPORT_INDEX_KEY, report_id)
+            pipe.hdel(REPORT_SIZES_KEY, report_id)
+            pipe.execute()
+        # index entries left behind are dropped when they expire
+        self.cache.call(forget)
+        self._remove_file(report_id)
+
+    def _remove_file(self, report_id: str) -> None:
+        try:
+            os.remove(self.path(report_id))
+        except FileNotFoundError:
+            pass
+
+    def purge_expired(self) -> dict:
+        """Drop expired reports from both tiers"""
+        now = time.time()
+
+        def purge_index():
+            expired = self.cache.redis_client.zrangebyscore(
+                REPORT_INDEX_KEY, "-inf", now)
+            if expired:
+                pipe = self.cache.redis_client.pipeline()
+                pipe.zrem(REPORT_INDEX_KEY, *expired)
+                pipe.hdel(REPORT_SIZES_KEY, *expired)
+                pipe.execute()
+            return expired
+        expired = self.cache.call(purge_index, lambda: [])
+
+        removed_files = 0
+        if os.path.isdir(self.directory):
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".json.z") and entry.stat().st_mtime < now:
+                    try:
+                        os.remove(entry.path)
+                        removed_files += 1
+                    except FileNotFoundError:
+                        pass
+
+        Logger.info(
+            f"Purged {len(expired)} redis and {removed_files} file reports")
+        return {TIER_REDIS: len(expired), TIER_FILE: removed_files}
+
+    def stats(self) -> dict:
+        """Number of live reports and their compressed bytes per tier"""
+        def redis_tier():
+            live = self.cache.redis_client.zrangebyscore(
+                REPORT_INDEX_KEY, time.time(), "+inf")
+            sizes = self.cache.redis_client.hmget(
+                REPORT_SIZES_KEY, live) if live else []
+            return live, sizes
+        live, sizes = self.cache.call(redis_tier, lambda: ([], []))
+
+        files, file_bytes = 0, 0
+        if os.path.isdir(self.directory):
+            now = time.time()
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".json.z"):
+                    stat = entry.stat()
+                    if stat.st_mtime >= now:
+                        files += 1
+                        file_bytes += stat.st_size
+
+        return {
+            TIER_REDIS: {
+                "reports": len(live),
+                "bytes": sum(int(size) for size in sizes if size is not None),
+            },
+            TIER_FILE: {
+                "reports": files,
+                "bytes": file_bytes,
+            },
+        }
@@ -0,0 +1,182 @@
+import os
+import math
+import time
+import logging
+from .redis import RedisCache
+
+Logger = logging.getLogger(__name__)
+
+# reports a single user may have queued or running
+REPORT_MAX_PER_USER = int(os.getenv("REPORT_MAX_PER_USER", 2))
+# reports waiting for dispatch before new ones are refused
+REPORT_MAX_QUEUE_DEPTH = int(os.getenv("REPORT_MAX_QUEUE_DEPTH", 500))
+# reports handed to long_queue at any time, roughly the worker concurrency
+REPORT_DISPATCH_WINDOW = int(os.getenv("REPORT_DISPATCH_WINDOW", 8))
+# a queued or running report older than this is assumed lost
+REPORT_JOB_TIMEOUT = int(os.getenv("REPORT_JOB_TIMEOUT", 15 * 60))
+REPORT_RETRY_AFTER = int(os.getenv("REPORT_RETRY_AFTER", 30))
+
+REPORT_QUEUE_PREFIX = os.getenv("REPORT_QUEUE_PREFIX", "report_queue:")
+PENDING_KEY = f"{REPORT_QUEUE_PREFIX}pending"
+DISPATCHED_KEY = f"{REPORT_QUEUE_PREFIX}dispatched"
+RING_KEY = f"{REPORT_QUEUE_PREFIX}users"
+STATS_KEY = f"{REPORT_QUEUE_PREFIX}stats"
+USER_JOBS_PREFIX = f"{REPORT_QUEUE_PREFIX}jobs:"
+USER_INFLIGHT_PREFIX = f"{REPORT_QUEUE_PREFIX}inflight:"
+
+ADMITTED = 0
+USER_LIMITED = 1
+QUEUE_FULL = 2
+UNAVAILABLE = 3
+
+ADMIT_SCRIPT = """
+redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[2])
+redis.call('zremrangebyscore', KEYS[2], '-inf', ARGV[2])
+if redis.call('zcard', KEYS[1]) >= tonumber(ARGV[3]) then return 1 end
+if redis.call('zcard', KEYS[2]) >= tonumber(ARGV[4]) then return 2 end
+redis.call('zadd', KEYS[1], ARGV[1], ARGV[5])
+redis.call('zadd', KEYS[2], ARGV[1], ARGV[5])
+if redis.call('rpush', KEYS[3], ARGV[5]) == 1 then
+    redis.call('rpush', KEYS[4], ARGV[6])
+end
+return 0
+"""
+
+# Pops users round robin, one report each, until the dispatch window is full.
+# Per-user job lists are addressed by prefix, so this assumes a single Redis.
+CLAIM_SCRIPT = """
+redis.call('zremrangebyscore', KEYS[2], '-inf', ARGV[3])
+local claimed = {}
+while redis.call('zcard', KEYS[2]) < tonumber(ARGV[2]) do
+    local user_id = redis.call('lpop', KEYS[1])
+    if not user_id then break end
+    local jobs = ARGV[4] .. user_id
+    local report_id = redis.call('lpop', jobs)
+    if report_id then
+        if redis.call('llen', jobs) > 0 then
+            redis.call('rpush', KEYS[1], user_id)
+        end
+        local enqueued_at = redis.call('zscore', KEYS[3], report_id) or ARGV[1]
+        redis.call('zrem', KEYS[3], report_id)
+        redis.call('zadd', KEYS[2], ARGV[1], report_id)
+        table.insert(claimed, user_id)
+        table.insert(claimed, report_id)
+        table.insert(claimed, enqueued_at)
+    end
+end
+return claimed
+"""
+
+
+# Drops a user's waiting reports from the queue depth along with the user's lists
+FORGET_SCRIPT = """
+for _, report_id in ipairs(redis.call('lrange', KEYS[1], 0, -1)) do
+    redis.call('zrem', KEYS[3], report_id)
+end
+redis.call('del', KEYS[1], KEYS[2])
+"""
+
+
+class ReportScheduler:
+    """
+    Admission control and fair dispatch for report generation.
+
+    Admitted reports wait in per-user Redis lists. Users take turns, so a
+    user with many reports cannot starve the others, and only
+    REPORT_DISPATCH_WINDOW reports sit in long_queue at once. Commands go
+    through the cache's circuit breaker: without Redis nothing is admitted
+    or dispatched.
+    """
+
+    def __init__(self, cache: RedisCache):
+        self.cache = cache
+        self.redis = cache.redis_client
+
+    def admit(self, user_id: int, report_id: str) -> int:
+        now = time.time()
+        return int(self.cache.call(lambda: self.redis.eval(
+            ADMIT_SCRIPT, 4,
+            f"{USER_INFLIGHT_PREFIX}{user_id}", PENDING_KEY,
+            f"{USER_JOBS_PREFIX}{user_id}", RING_KEY,
+            now, now - REPORT_JOB_TIMEOUT, REPORT_MAX_PER_USER,
+            REPORT_MAX_QUEUE_DEPTH, report_id, user_id), lambda: UNAVAILABLE))
+
+    def claim(self) -> list:
+        """Take the next reports to send to the workers as (user_id, report_id, enqueued_at)"""
+        now = time.time()
+        claimed = self.cache.call(lambda: self.redis.eval(
+            CLAIM_SCRIPT, 3, RING_KEY, DISPATCHED_KEY, PENDING_KEY,
+            now, REPORT_DISPATCH_WINDOW, now - REPORT_JOB_TIMEOUT, USER_JOBS_PREFIX), lambda: [])
+        return [
+            (int(claimed[i]), claimed[i + 1].decode(), float(claimed[i + 2]))
+            for i in range(0, len(claimed), 3)
+        ]
+
+    def started(self, enqueued_at: float) -> None:
+        self.cache.call(lambda: self._started(enqueued_at))
+
+    def _started(self, enqueued_at: float) -> None:
+        waited = max(time.time() - enqueued_at, 0.0)
+        pipe = self.redis.pipeline()
+        pipe.hincrby(STATS_KEY, "started", 1)
+        pipe.hincrbyfloat(STATS_KEY, "wait_seconds_total", waited)
+        pipe.execute()
+        max_wait = float(self.redis.hget(STATS_KEY, "wait_seconds_max") or 0)
+        if waited > max_wait:
+            self.redis.hset(STATS_KEY, "wait_seconds_max", waited)
+
+    def finished(self, user_id: int, report_id: str, run_seconds: float) -> None:
+        """Free the report's slots; without Redis they expire after REPORT_JOB_TIMEOUT"""
+        def operation():
+            pipe = self.redis.pipeline()
+            pipe.zrem(f"{USER_INFLIGHT_PREFIX}{user_id}", report_id)
+            pipe.zrem(DISPATCHED_KEY, report_id)
+            pipe.hincrby(STATS_KEY, "finished", 1)
+            pipe.hincrbyfloat(STATS_KEY, "run_seconds_total", run_seconds)
+            pipe.execute()
+        self.cache.call(operation)
+
+    def forget(self, user_id: int) -> None:
+        """Drop a user's queued reports; without Redis they age out of the queue on admit"""
+        self.cache.call(lambda: self.redis.eval(
+            FORGET_SCRIPT, 3,
+            f"{USER_JOBS_PREFIX}{user_id}", f"{USER_INFLIGHT_PREFIX}{user_id}", PENDING_KEY))
+
+    def retry_after(self) -> int:
+        """Seconds until the queue is likely to have room again"""
+        return self.cache.call(self._retry_after, lambda: REPORT_RETRY_AFTER)
+
+    def _retry_after(self) -> int:
+        stats = self.redis.hgetall(STATS_KEY)
+        finished = int(stats.get(b"finished", 0))
+        if not finished:
+            return REPORT_RETRY_AFTER
+        average_run = float(stats.get(b"run_seconds_total", 0)) / finished
+        depth = self.redis.zcard(PENDING_KEY)
+        return max(1, math.ceil(depth * average_run / REPORT_DISPATCH_WINDOW))
+
+    def metrics(self) -> dict:
+        return self.cache.call(self._metrics, lambda: {"status": "unavailable"})
+
+    def _metrics(self) -> dict:
+        pipe = self.redis.pipeline()
+        pipe.zcard(PENDING_KEY)
+        pipe.zcard(DISPATCHED_KEY)
+        pipe.llen(RING_KEY)
+        pipe.zrange(PENDING_KEY, 0, 0, withscores=True)
+        pipe.hgetall(STATS_KEY)
+        pending, dispatched, waiting_users, oldest, stats = pipe.execute()
+
+        started = int(stats.get(b"started", 0))
+        finished = int(stats.get(b"finished", 0))
+        return {
+            "pending": pending,
+            "dispatched": dispatched,
+            "waiting_users": waiting_users,
+            "oldest_pending_seconds": time.time() - oldest[0][1] if oldest else 0.0,
+            "started": started,
+            "finished": finished,
+            "average_wait_seconds": float(stats.get(b"wait_seconds_total", 0)) / started if started else 0.0,
+            "max_wait_seconds": float(stats.get(b"wait_seconds_max", 0)),
+            "average_run_seconds": float(stats.get(b"run_seconds_total", 0)) / finished if finished else 0.0,
+        }
@@ -1,6 +1,8 @@
 import datetime
-from typing import Optional
-from pydantic import BaseModel, EmailStr, Field
+import constants
+from enum import Enum
+from typing import List, Optional
+from pydantic import BaseModel, EmailStr, Field, conlist
 
 
 class UserBase(BaseModel):
@@ -98,6 +100,39 @@ class ExpenseInDB(ExpenseBase):
         orm_mode = True
 
 
+class ExpenseSearchHit(ExpenseInDB):
+    rank: float
+
+
+class ExpenseSearchResult(BaseModel):
+    results: List[ExpenseSearchHit]
+    next_cursor: Optional[str]
+
+
+class RecurringExpenseBase(BaseModel):
+    account_id: int
+    category: str = Field(..., min_length=3, max_length=50)
+    amount: float = Field(..., gt=0.00)
+    # RFC 5545 recurrence rule, e.g. FREQ=MONTHLY;BYMONTHDAY=1
+    rrule: str = Field(..., min_length=4, max_length=256)
+    start_date: datetime.date
+    end_date: Optional[datetime.date]
+    notes: Optional[str]
+
+
+class RecurringExpenseCreate(RecurringExpenseBase):
+    pass
+
+
+class RecurringExpenseInDB(RecurringExpenseBase):
+    recurring_id: int
+    next_date: Optional[datetime.date]
+    active: bool
+
+    class Config:
+        orm_mode = True
+
+
 class BudgetBase(BaseModel):
     amount: float = Field(..., gt=0.00)
     start_date: datetime.date
@@ -126,3 +161,44 @@ class BudgetProgress(BaseModel):
     amount: float = Field(..., gt=0.00)
     spent: float = Field(..., gt=0.00)
     remaining: Optional[float] = Field(None, ge=0.00)
+
+
+class BatchOperation(str, Enum):
+    create = "create"
+    update = "update"
+    delete = "delete"
+
+
+class AccountBatchItem(BaseModel):
+    op: BatchOperation
+    account_id: Optional[int]
+    account_name: Optional[str] = Field(None, min_length=3, max_length=50)
+    balance: Optional[float] = Field(None, ge=0.00)
+
+
+class AccountBatch(BaseModel):
+    operations: conlist(AccountBatchItem, min_items=1, max_items=constants.BATCH_MAX_OPERATIONS)
+
+
+class BudgetBatchItem(BaseModel):
+    op: BatchOperation
+    budget_id: Optional[int]
+    account_id: Optional[int]
+    amount: Optional[float] = Field(None, gt=0.00)
+    start_date: Optional[datetime.date]
+    end_date: Optional[datetime.date]
+
+
+class BudgetBatch(BaseModel):
+    operations: conlist(BudgetBatchItem, min_items=1, max_items=constants.BATCH_MAX_OPERATIONS)
+
+
+class BatchItemResult(BaseModel):
+    index: int
+    status: str
+    id: Optional[int]
+    detail: Optional[str]
+
+
+class BatchResult(BaseModel):
+    results: List[BatchItemResult]
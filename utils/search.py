@@ -0,0 +1,135 @@
+import re
+import json
+import base64
+import logging
+from sqlalchemy import select, func, text, cast, literal, literal_column, table, column, or_, and_, Float
+from sqlalchemy.orm import Session
+from .db import engine
+from models import Expense, Category
+
+Logger = logging.getLogger(__name__)
+
+SQLITE_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS expenses_fts USING fts5("
+    "notes, content='expenses', content_rowid='expense_id')",
+    "CREATE TRIGGER IF NOT EXISTS expenses_fts_ai AFTER INSERT ON expenses BEGIN "
+    "INSERT INTO expenses_fts(rowid, notes) VALUES (new.expense_id, new.notes); END",
+    "CREATE TRIGGER IF NOT EXISTS expenses_fts_ad AFTER DELETE ON expenses BEGIN "
+    "INSERT INTO expenses_fts(expenses_fts, rowid, notes) VALUES ('delete', old.expense_id, old.notes); END",
+    "CREATE TRIGGER IF NOT EXISTS expenses_fts_au AFTER UPDATE ON expenses BEGIN "
+    "INSERT INTO expenses_fts(expenses_fts, rowid, notes) VALUES ('delete', old.expense_id, old.notes); "
+    "INSERT INTO expenses_fts(rowid, notes) VALUES (new.expense_id, new.notes); END",
+]
+
+POSTGRES_FTS_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_expenses_notes_tsv ON expenses "
+    "USING GIN (to_tsvector('simple', coalesce(notes, '')))",
+]
+
+expenses_fts = table("expenses_fts", column("rowid"))
+
+
+def create_search_index() -> None:
+    """Create the full-text index over expense notes for the current database"""
+    with engine.begin() as connection:
+        if engine.dialect.name == "postgresql":
+            for statement in POSTGRES_FTS_DDL:
+                connection.execute(text(statement))
+        elif engine.dialect.name == "sqlite":
+            exists = connection.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE name = 'expenses_fts'")).first()
+            for statement in SQLITE_FTS_DDL:
+                connection.execute(text(statement))
+            if not exists:
+                # index the rows written before the triggers existed
+                connection.execute(text(
+                    "INSERT INTO expenses_fts(expenses_fts) VALUES ('rebuild')"))
+        else:
+            Logger.warning(
+                f"No full-text index for {engine.dialect.name}, search falls back to LIKE")
+
+
+def encode_cursor(rank: float, expense_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([rank, expense_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """Return (rank, expense_id) or raise ValueError"""
+    try:
+        rank, expense_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(rank), int(expense_id)
+    except (TypeError, ValueError) as error:
+        # well-formed JSON of the wrong shape, like a number or [null, 1]
+        raise ValueError("Invalid cursor") from error
+
+
+def search_expenses(db: Session, user_id: int, query: str = None, min_amount: float = None,
+                    max_amount: float = None, limit: int = 50, cursor: str = None):
+    """
+    Return one page of a user's expenses matching query and the amount range,
+    best match first, plus the cursor of the next page.
+
+    Pages are keyed on (rank, expense_id) rather than an offset, so no
+    page reads and throws away the rows of the pages before it. Every
+    page still ranks and sorts all matches of the query.
+    """
+    dialect = db.get_bind().dialect.name
+    filters = [Expense.user_id == user_id]
+    if min_amount is not None:
+        filters.append(Expense.amount >= min_amount)
+    if max_amount is not None:
+        filters.append(Expense.amount <= max_amount)
+
+    rank = literal(0.0)
+    source = select(Expense).outerjoin(
+        Category, Category.category_id == Expense.category_id)
+    terms = re.findall(r"\w+", query or "")
+
+    if terms and dialect == "postgresql":
+        # spelled exactly like the index expression so the planner uses it
+        config = literal_column("'simple'")
+        document = func.to_tsvector(
+            config, func.coalesce(Expense.notes, literal_column("''")))
+        ts_query = func.websearch_to_tsquery(config, query)
+        filters.append(document.op("@@")(ts_query))
+        rank = func.ts_rank(document, ts_query)
+    elif terms and dialect == "sqlite":
+        # bm25 is lower for better matches
+        match = " ".join('"%s"*' % term for term in terms)
+        source = source.join(
+            expenses_fts, expenses_fts.c.rowid == Expense.expense_id)
+        filters.append(literal_column("expenses_fts").op("MATCH")(match))
+        rank = -func.bm25(literal_column("expenses_fts"))
+    elif terms:
+        filters.extend(Expense.notes.ilike(f"%{term}%") for term in terms)
+
+    # ts_rank is a float4; as a double it survives the round trip through
+    # the cursor exactly, so ties compare equal on the next page
+    rank = cast(rank, Float(53))
+    ranked = source.with_only_columns(
+        Expense.expense_id,
+        Expense.account_id,
+        Category.category_name.label("category"),
+        Expense.amount,
+        Expense.date,
+        Expense.notes,
+        rank.label("rank"),
+    ).where(*filters).subquery()
+
+    statement = select(ranked)
+    if cursor is not None:
+        after_rank, after_id = decode_cursor(cursor)
+        statement = statement.where(or_(
+            ranked.c.rank < after_rank,
+            and_(ranked.c.rank == after_rank, ranked.c.expense_id < after_id),
+        ))
+
+    rows = db.execute(statement.order_by(
+        ranked.c.rank.desc(), ranked.c.expense_id.desc()).limit(limit + 1)).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].rank, rows[-1].expense_id)
+
+    return rows, next_cursor
@@ -0,0 +1,331 @@
+import os
+import json
+import calendar
+import logging
+from datetime import date, datetime
+from typing import Optional
+import numpy as np
+import redis
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from .redis import RedisCache
+from models import Expense, ExpenseArchive
+
+Logger = logging.getLogger(__name__)
+
+SPENDING_PREFIX = os.getenv("SPENDING_PREFIX", "spending:")
+SPENDING_ANOMALIES_PREFIX = os.getenv(
+    "SPENDING_ANOMALIES_PREFIX", "spending_anomalies:")
+SPENDING_STATE_TTL = int(os.getenv("SPENDING_STATE_TTL", 60 * 60 * 24 * 30))
+# weight of the newest expense in a category's moving mean and variance
+SPENDING_ALPHA = float(os.getenv("SPENDING_ALPHA", 0.1))
+# weight of the last completed month in the typical monthly spend
+SPENDING_MONTH_ALPHA = float(os.getenv("SPENDING_MONTH_ALPHA", 0.3))
+# an expense this many standard deviations from its category mean is unusual
+SPENDING_ANOMALY_Z = float(os.getenv("SPENDING_ANOMALY_Z", 3.0))
+# expenses a category needs before its outliers are flagged
+SPENDING_MIN_HISTORY = int(os.getenv("SPENDING_MIN_HISTORY", 10))
+SPENDING_ANOMALIES_KEEP = int(os.getenv("SPENDING_ANOMALIES_KEEP", 50))
+SPENDING_UPDATE_RETRIES = int(os.getenv("SPENDING_UPDATE_RETRIES", 5))
+# ids of the newest expenses counted, so a rebuild and an update never count one twice
+SPENDING_RECENT_IDS = int(os.getenv("SPENDING_RECENT_IDS", 100))
+SPENDING_BACKFILL_PREFIX = os.getenv("SPENDING_BACKFILL_PREFIX", "spending_backfill:")
+# seconds a queued rebuild keeps readers of the account from queueing another
+SPENDING_BACKFILL_WAIT = int(os.getenv("SPENDING_BACKFILL_WAIT", 60))
+# seconds a reader is asked to wait for a rebuild
+SPENDING_RETRY_AFTER = int(os.getenv("SPENDING_RETRY_AFTER", 5))
+
+
+def _month_index(day: date) -> int:
+    return day.year * 12 + day.month - 1
+
+
+def _ewma_last(values: np.ndarray, groups: np.ndarray, group_count: int, alpha: float) -> np.ndarray:
+    """
+    Final value of x[k] = (1 - alpha) x[k-1] + alpha v[k], seeded with the
+    first value, for each group of an ordered series, without a loop:
+    the k-th of n values ends up weighted alpha (1 - alpha)^(n-1-k), and
+    the first one (1 - alpha)^(n-1).
+    """
+    counts = np.bincount(groups, minlength=group_count)
+    order = np.argsort(groups, kind="stable")
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    position = np.empty(len(values), dtype=np.int64)
+    position[order] = np.arange(len(values)) - np.repeat(starts, counts)
+    from_end = counts[groups] - 1 - position
+
+    weights = alpha * (1.0 - alpha) ** from_end
+    first = position == 0
+    weights[first] = (1.0 - alpha) ** from_end[first]
+    return np.bincount(groups, weights=weights * values, minlength=group_count)
+
+
+def _fold_months(state: dict, month: int) -> None:
+    """Close the months before month into the typical monthly spend"""
+    if state["month"] is None:
+        return
+    upcoming = state.setdefault("upcoming", {})
+    while state["month"] < month:
+        spent = state["month_spent"]
+        if state["monthly_mean"] is None:
+            state["monthly_mean"] = spent
+        else:
+            state["monthly_mean"] += SPENDING_MONTH_ALPHA * \
+                (spent - state["monthly_mean"])
+        state["months"] += 1
+        state["month"] += 1
+        # expenses dated ahead count once their month comes
+        state["month_spent"] = upcoming.pop(str(state["month"]), 0.0)
+
+
+class SpendingModel:
+    """
+    Streaming spending statistics of an account, kept in Redis.
+
+    Per category: expense count and moving averages of the amount and its
+    square, for a mean and variance that follow recent behaviour. Per
+    account: month-to-date spend, a moving average of monthly totals and
+    how spend spreads over the days of the month. Each expense updates
+    them in O(1); a missing state is rebuilt off the request path from
+    the full history with one vectorized pass, giving the values the
+    updates reach when expenses arrive in date order. Months never advance past today:
+    future-dated expenses wait in "upcoming" for their month.
+    """
+
+    def __init__(self, cache: RedisCache):
+        self.cache = cache
+
+    @staticmethod
+    def _key(user_id: int, account_id: int) -> str:
+        return f"{SPENDING_PREFIX}{user_id}:{account_id}"
+
+    def backfill(self, db: Session, user_id: int, account_id: int, expense_id: Optional[int] = None, today: Optional[date] = None) -> dict:
+        """
+        Rebuild the account's state from all its expenses, hot and archived.
+        A state stored meanwhile is kept; the expense that asked for the
+        rebuild, if any, is then added to it.
+        """
+        today = today or date.today()
+        rows = []
+        for model in (ExpenseArchive, Expense):
+            rows.extend(db.execute(select(model.date, model.expense_id, model.category_id, model.amount).where(
+                model.account_id == account_id)))
+        rows.sort(key=lambda row: (row[0], row[1]))
+
+        state = {
+            "month": None,
+            "month_spent": 0.0,
+            "monthly_mean": None,
+            "months": 0,
+            "days": [0.0] * 31,
+            "categories": {},
+            "upcoming": {},
+            "recent_ids": sorted(row[1] for row in rows)[-SPENDING_RECENT_IDS:],
+        }
+        if rows:
+            days = np.array([row[0].day for row in rows])
+            months = np.array([_month_index(row[0]) for row in rows])
+            category_ids = np.array([row[2] or 0 for row in rows])
+            amounts = np.array([row[3] for row in rows], dtype=np.float64)
+
+            state["days"] = np.bincount(
+                days - 1, weights=amounts, minlength=31).tolist()
+
+            categories, groups = np.unique(category_ids, return_inverse=True)
+            counts = np.bincount(groups, minlength=len(categories))
+            means = _ewma_last(amounts, groups, len(categories), SPENDING_ALPHA)
+            squares = _ewma_last(amounts ** 2, groups, len(categories), SPENDING_ALPHA)
+            state["categories"] = {
+                str(category): [int(count), float(mean), float(square)]
+                for category, count, mean, square in zip(categories, counts, means, squares)
+            }
+
+            # every month from the first expense to this one, empty ones included
+            current = _month_index(today)
+            first = min(int(months.min()), current)
+            due = months <= current
+            totals = np.bincount(months[due] - first, weights=amounts[due],
+                                 minlength=current - first + 1)
+            completed = totals[:-1]
+            state["month"] = current
+            state["month_spent"] = float(totals[-1])
+            state["months"] = len(completed)
+            if len(completed):
+                state["monthly_mean"] = float(_ewma_last(
+                    completed, np.zeros(len(completed), dtype=np.int64), 1, SPENDING_MONTH_ALPHA)[0])
+            for month, amount in zip(months[~due], amounts[~due]):
+                state["upcoming"][str(month)] = state["upcoming"].get(str(month), 0.0) + float(amount)
+
+        stored = self.cache.call(lambda: self.cache.redis_client.set(
+            self._key(user_id, account_id), json.dumps(state), ex=SPENDING_STATE_TTL, nx=True))
+        self.cache.delete_key(f"{SPENDING_BACKFILL_PREFIX}{user_id}:{account_id}")
+        if not stored and expense_id is not None:
+            expense = db.get(Expense, expense_id)
+            if expense is not None:
+                self.record_expense(user_id, account_id, expense.expense_id,
+                                    expense.category_id, expense.date, expense.amount)
+        return state
+
+    def state(self, user_id: int, account_id: int) -> Optional[dict]:
+        """The stored state, or None until spending_backfill_task has built it"""
+        stored = self.cache.call(
+            lambda: self.cache.redis_client.get(self._key(user_id, account_id)))
+        return json.loads(stored) if stored is not None else None
+
+    def claim_backfill(self, user_id: int, account_id: int) -> bool:
+        """Whether the caller should queue the account's rebuild, once per SPENDING_BACKFILL_WAIT"""
+        return self.cache.add(f"{SPENDING_BACKFILL_PREFIX}{user_id}:{account_id}", "1",
+                              expiration_time=SPENDING_BACKFILL_WAIT)
+
+    def record_expense(self, user_id: int, account_id: int, expense_id: int, category_id: Optional[int], expense_date: date, amount: float) -> bool:
+        """
+        Add a committed expense to the account's statistics, flagging it if
+        the amount is unusual for its category. Returns False when the
+        account has no state yet: spending_backfill_task builds it, this
+        expense included. Without Redis the state is dropped, to be rebuilt
+        once it is back.
+        """
+        key = self._key(user_id, account_id)
+        return self.cache.call(
+            lambda: self._record_expense(user_id, account_id, expense_id,
+                                         category_id, expense_date, amount),
+            lambda: self.cache.delete_key(key) or True)
+
+    def _record_expense(self, user_id: int, account_id: int, expense_id: int, category_id: Optional[int], expense_date: date, amount: float) -> bool:
+        key = self._key(user_id, account_id)
+        category = str(category_id or 0)
+        anomaly = None
+        for _ in range(SPENDING_UPDATE_RETRIES):
+            with self.cache.redis_client.pipeline() as pipe:
+                try:
+                    pipe.watch(key)
+                    stored = pipe.get(key)
+                    if stored is None:
+                        return False
+                    state = json.loads(stored)
+                    recent = state.setdefault("recent_ids", [])
+                    if expense_id in recent:
+                        # the state was rebuilt after this expense committed
+                        return True
+
+                    anomaly = self._score(state, category, amount)
+
+                    month = _month_index(expense_date)
+                    current = _month_index(date.today())
+                    if state["month"] is None:
+                        # history starts with the first expense
+                        state["month"] = min(month, current)
+                    if month == state["month"]:
+                        state["month_spent"] += amount
+                    elif month > state["month"]:
+                        upcoming = state.setdefault("upcoming", {})
+                        upcoming[str(month)] = upcoming.get(str(month), 0.0) + amount
+                    elif month >= state["month"] - state["months"]:
+                        # a closed month: add it with the weight that month has in the mean
+                        first = state["month"] - state["months"]
+                        weight = (1.0 - SPENDING_MONTH_ALPHA) ** (state["month"] - 1 - month)
+                        state["monthly_mean"] += weight * \
+                            (SPENDING_MONTH_ALPHA if month > first else 1.0) * amount
+                    _fold_months(state, current)
+                    state["days"][expense_date.day - 1] += amount
+
+                    count, mean, square = state["categories"].get(
+                        category, [0, amount, amount ** 2])
+                    state["categories"][category] = [
+                        count + 1,
+                        mean + SPENDING_ALPHA * (amount - mean),
+                        square + SPENDING_ALPHA * (amount ** 2 - square),
+                    ]
+                    recent.append(expense_id)
+                    del recent[:-SPENDING_RECENT_IDS]
+
+                    pipe.multi()
+                    pipe.set(key, json.dumps(state), ex=SPENDING_STATE_TTL)
+                    pipe.execute()
+                    break
+                except redis.exceptions.WatchError:
+                    continue
+        else:
+            # a concurrent writer kept winning: rebuild rather than lose the expense
+            self.cache.redis_client.delete(key)
+            return True
+
+        if anomaly is None:
+            return True
+        anomaly.update({
+            "account_id": account_id,
+            "expense_id": expense_id,
+            "category_id": category_id,
+            "date": expense_date.isoformat(),
+            "created_at": datetime.utcnow().isoformat(),
+        })
+        anomalies_key = f"{SPENDING_ANOMALIES_PREFIX}{user_id}:{account_id}"
+        pipe = self.cache.redis_client.pipeline()
+        pipe.lpush(anomalies_key, json.dumps(anomaly))
+        pipe.ltrim(anomalies_key, 0, SPENDING_ANOMALIES_KEEP - 1)
+        pipe.execute()
+        return True
+
+    @staticmethod
+    def _score(state: dict, category: str, amount: float) -> Optional[dict]:
+        count, mean, square = state["categories"].get(category, [0, 0.0, 0.0])
+        if count < SPENDING_MIN_HISTORY:
+            return None
+        deviation = max(square - mean ** 2, 0.0) ** 0.5
+        if deviation == 0.0:
+            return None
+        score = (amount - mean) / deviation
+        if abs(score) < SPENDING_ANOMALY_Z:
+            return None
+        return {"amount": amount, "expected": round(mean, 2), "z_score": round(score, 2)}
+
+    def forecast(self, user_id: int, account_id: int, today: Optional[date] = None) -> Optional[dict]:
+        """Month-end projection for the account from its stored state, or None without one"""
+        today = today or date.today()
+        state = self.state(user_id, account_id)
+        if state is None:
+            return None
+        _fold_months(state, _month_index(today))
+        spent = state["month_spent"] if state["month"] == _month_index(today) else 0.0
+
+        days_in_month = calendar.monthrange(today.year, today.month)[1]
+        curve = np.array(state["days"][:days_in_month])
+        if curve.sum() > 0:
+            remaining_share = float(curve[today.day:].sum() / curve.sum())
+        else:
+            remaining_share = (days_in_month - today.day) / days_in_month
+
+        if state["monthly_mean"] is not None:
+            typical = state["monthly_mean"]
+            projected = spent + typical * remaining_share
+        else:
+            typical = None
+            # no completed month yet: stretch this month's pace
+            elapsed_share = 1.0 - remaining_share
+            projected = spent / elapsed_share if elapsed_share > 0 else spent
+
+        categories = []
+        for category, (count, mean, square) in state["categories"].items():
+            categories.append({
+                "category_id": int(category) or None,
+                "count": count,
+                "mean": round(mean, 2),
+                "std": round(max(square - mean ** 2, 0.0) ** 0.5, 2),
+            })
+
+        anomalies = self.cache.call(lambda: self.cache.redis_client.lrange(
+            f"{SPENDING_ANOMALIES_PREFIX}{user_id}:{account_id}", 0, SPENDING_ANOMALIES_KEEP - 1), lambda: [])
+        return {
+            "account_id": account_id,
+            "month": today.strftime("%Y-%m"),
+            "spent_to_date": round(spent, 2),
+            "projected_total": round(projected, 2),
+            "typical_monthly": round(typical, 2) if typical is not None else None,
+            "months_of_history": state["months"],
+            "categories": categories,
+            "anomalies": [json.loads(anomaly) for anomaly in anomalies],
+        }
+
+    def forget(self, user_id: int, account_id: int) -> None:
+        self.cache.delete_keys(self._key(user_id, account_id),
+                               f"{SPENDING_ANOMALIES_PREFIX}{user_id}:{account_id}")
@@ -1,14 +1,61 @@
 import os
 import logging
 import json
+import time
+import uuid
+import socket
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from typing import Optional
 from utils import get_db, get_cache
-from models import Account as AccountModel, Expense, Budget
+from utils.db import SessionLocal
+from models import Account as AccountModel, Expense, ExpenseArchive, Budget, Category, User, RecurringExpense
 from celery import shared_task
-from utils.redis import RedisCache
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select, delete, or_, func
+from sqlalchemy.exc import IntegrityError
+from utils.redis import RedisCache, DIRTY_USERS_KEY, RELEASE_LOCK_SCRIPT
+from utils.pubsub import REPORT_CHANNEL_PREFIX
+from utils.report_store import ReportStore, REPORT_TTL
+from utils.scheduler import ReportScheduler
+from utils.archive import archive_expenses, needs_archive
+from utils.budget_index import BUDGET_SPENT_PREFIX
+from utils.outbox import record_event, row_data, relay_outbox, OutboxConsumer
+from utils.spending import SpendingModel, SPENDING_PREFIX, SPENDING_ANOMALIES_PREFIX
+from utils.recurring import materialize_recurring
+from utils import queries
 
 REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "report:")
 ACCOUNT_PREFIX = os.getenv("ACCOUNT_PREFIX", "account:")
+BUDGET_PREFIX = os.getenv("BUDGET_PREFIX", "budget:")
+IDEMPOTENCY_PREFIX = os.getenv("IDEMPOTENCY_PREFIX", "idempotency:")
+VERSION_PREFIX = os.getenv("VERSION_PREFIX", "version:")
+PURGE_PREFIX = os.getenv("PURGE_PREFIX", "purge:")
+# rows deleted per transaction while purging a user
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", 1000))
+PURGE_STATUS_TTL = int(os.getenv("PURGE_STATUS_TTL", 60 * 60 * 24 * 7))
+
+SCHEDULED_REPORT_PREFIX = os.getenv("SCHEDULED_REPORT_PREFIX", "scheduled-")
+# reports built at once by the nightly run
+SCHEDULED_REPORT_CONCURRENCY = int(os.getenv("SCHEDULED_REPORT_CONCURRENCY", 4))
+SCHEDULED_REPORT_BATCH_SIZE = int(os.getenv("SCHEDULED_REPORT_BATCH_SIZE", 200))
+SCHEDULED_REPORT_STATS_KEY = os.getenv(
+    "SCHEDULED_REPORT_STATS_KEY", "scheduled_reports:stats")
+DIRTY_USERS_PROCESSING_KEY = f"{DIRTY_USERS_KEY}:processing"
+# set once every user has been queued for a first report
+SCHEDULED_REPORT_SEEDED_KEY = os.getenv(
+    "SCHEDULED_REPORT_SEEDED_KEY", "scheduled_reports:seeded")
+SCHEDULED_REPORT_LOCK_KEY = os.getenv(
+    "SCHEDULED_REPORT_LOCK_KEY", "scheduled_reports:lock")
+SCHEDULED_REPORT_LOCK_TTL = int(os.getenv("SCHEDULED_REPORT_LOCK_TTL", 600))
+
+BUDGET_ALERTS_PREFIX = os.getenv("BUDGET_ALERTS_PREFIX", "budget_alerts:")
+# recent alerts kept per user
+BUDGET_ALERTS_KEEP = int(os.getenv("BUDGET_ALERTS_KEEP", 100))
+
+# change events each consumer group handles per run
+OUTBOX_CONSUME_BATCH_SIZE = int(os.getenv("OUTBOX_CONSUME_BATCH_SIZE", 500))
+OUTBOX_CONSUMER_NAME = f"{socket.gethostname()}:{os.getpid()}"
 
 
 logger = logging.getLogger(__name__)
@@ -22,7 +69,16 @@ def create_account_task(account_dict: dict, user_id: int, cache: RedisCache = ge
         **account_dict, user_id=user_id)
 
     db.add(db_account)
-    db.commit()
+    try:
+        db.flush()
+        record_event(db, user_id, "account", "created",
+                     db_account.account_id, row_data(db_account))
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        logger.warning(
+            f"Account already exists: {account_dict.get('account_name')}")
+        return None
 
     logger.info(f"New account created successfully: {db_account}")
 
@@ -32,21 +88,75 @@ def create_account_task(account_dict: dict, user_id: int, cache: RedisCache = ge
 
     cache_key = f"{ACCOUNT_PREFIX}{user_id}"
     cache.delete_key(cache_key)
+    cache.bump_versions(user_id, "accounts")
 
     logger.info(f"Cache key deleted successfully: {cache_key}")
 
-    return db_account
+    return jsonable_encoder(db_account)
+
+
+def publish_report_status(cache_client: RedisCache, report_id: str, report_status: str, **extra):
+    """Notify report status subscribers; the stored report stays the source of truth"""
+    message = json.dumps({"status": report_status, "report_id": report_id, **extra})
+    cache_client.publish(f"{REPORT_CHANNEL_PREFIX}{report_id}", message)
+
+
+def dispatch_reports(cache_client: RedisCache) -> int:
+    """Move admitted reports onto long_queue, one user at a time"""
+    scheduler = ReportScheduler(cache_client)
+    dispatched = 0
+    for user_id, report_id, enqueued_at in scheduler.claim():
+        try:
+            generate_report_task.apply_async(
+                (user_id, report_id), {"enqueued_at": enqueued_at})
+        except Exception:
+            logger.exception(f"Report dispatch failed: {report_id}")
+            scheduler.finished(user_id, report_id, 0.0)
+            cache_client.set_(f"{REDIS_KEY_PREFIX}{report_id}",
+                              json.dumps({"status": "error", "user_id": user_id}), expiration_time=REPORT_TTL)
+            publish_report_status(cache_client, report_id, "error")
+            continue
+        dispatched += 1
+    return dispatched
 
 
 @shared_task
-def generate_report_task(user_id, report_id, cache_client: RedisCache = get_cache()):
+def dispatch_reports_task(cache_client: RedisCache = get_cache()):
+    return dispatch_reports(cache_client)
 
-    db = next(get_db())
 
-    accounts = db.query(AccountModel).filter(
-        AccountModel.user_id == user_id).all()
-    expenses = db.query(Expense).filter(Expense.user_id == user_id).all()
-    budgets = db.query(Budget).filter(Budget.user_id == user_id).all()
+@shared_task
+def generate_report_task(user_id, report_id, enqueued_at: float = None, cache_client: RedisCache = get_cache()):
+    scheduler = ReportScheduler(cache_client)
+    if enqueued_at is not None:
+        scheduler.started(enqueued_at)
+    publish_report_status(cache_client, report_id, "running", progress=0)
+
+    started_at = time.monotonic()
+    try:
+        redis_value = _generate_report(user_id, report_id, cache_client)
+    except Exception:
+        logger.exception(f"Report generation failed: {report_id}")
+        cache_client.set_(f"{REDIS_KEY_PREFIX}{report_id}",
+                          json.dumps({"status": "error", "user_id": user_id}), expiration_time=REPORT_TTL)
+        publish_report_status(cache_client, report_id, "error")
+        raise
+    finally:
+        # free the slot and hand it to the next user in line
+        scheduler.finished(user_id, report_id, time.monotonic() - started_at)
+        dispatch_reports(cache_client)
+
+    publish_report_status(cache_client, report_id, "success")
+    return redis_value
+
+
+def build_report(db, cache_client: RedisCache, user_id: int) -> dict:
+    """Balance, expense and budget totals for each account of a user"""
+    accounts = queries.user_accounts(db, user_id)
+    expenses = queries.user_expenses(db, user_id)
+    if needs_archive(db, cache_client, None):
+        expenses += queries.archived_user_expenses(db, user_id)
+    budgets = queries.user_budgets(db, user_id)
 
     # calculate total balance per account
     account_balance = {}
@@ -69,7 +179,7 @@ def generate_report_task(user_id, report_id, cache_client: RedisCache = get_cach
             if budget.account_id == account.account_id:
                 account_budgets[account.account_name] += budget.amount
 
-    report_data = {
+    return {
         'accounts': [
             {
                 'name': account.account_name,
@@ -81,17 +191,36 @@ def generate_report_task(user_id, report_id, cache_client: RedisCache = get_cach
         ]
     }
 
-    # Serialize report data to JSON
 
-    redis_value = json.dumps({
+def store_report(cache_client: RedisCache, report_id: str, user_id: int, report_data: dict, ttl: Optional[int] = REPORT_TTL) -> str:
+    """Store the compressed report, then point the status key at it"""
+    meta = ReportStore(cache_client).save(report_id, {
         "status": "success",
         'report_data': report_data,
         'report_id': report_id,
+    }, ttl=ttl)
+
+    redis_value = json.dumps({
+        "status": "success",
+        'report_id': report_id,
+        'user_id': user_id,
+        **meta,
     })
 
-    # Save report data to cache
     cache_client.set_(f"{REDIS_KEY_PREFIX}{report_id}",
-                      redis_value, expiration_time=60 * 60 * 24)
+                      redis_value, expiration_time=ttl)
+    return redis_value
+
+
+def _generate_report(user_id, report_id, cache_client: RedisCache):
+
+    db = next(get_db())
+
+    report_data = build_report(db, cache_client, user_id)
+
+    publish_report_status(cache_client, report_id, "running", progress=50)
+
+    redis_value = store_report(cache_client, report_id, user_id, report_data)
 
     # TODO: Figure out how to expose container IP to the outside world
     # # Write report to CSV file
@@ -112,3 +241,296 @@ def generate_report_task(user_id, report_id, cache_client: RedisCache = get_cach
     #                   report_link, expiration_time=60 * 60 * 24)
 
     return redis_value
+
+
+@shared_task
+def purge_expired_reports_task(cache_client: RedisCache = get_cache()):
+    return ReportStore(cache_client).purge_expired()
+
+
+def set_purge_status(cache_client: RedisCache, purge_id: str, user_id: int, purge_status: str, deleted: dict):
+    cache_client.set_(f"{PURGE_PREFIX}{purge_id}", json.dumps({
+        "status": purge_status,
+        "purge_id": purge_id,
+        "user_id": user_id,
+        "deleted": deleted,
+    }), expiration_time=PURGE_STATUS_TTL)
+
+
+def _delete_in_batches(db, primary_key, *filters):
+    """
+    Delete matching rows PURGE_BATCH_SIZE at a time, committing after each
+    batch so no lock is held for long. Yields the running count.
+    """
+    deleted = 0
+    while True:
+        ids = db.execute(select(primary_key).where(
+            *filters).limit(PURGE_BATCH_SIZE)).scalars().all()
+        if not ids:
+            return
+        db.execute(delete(primary_key.class_).where(primary_key.in_(ids)))
+        db.commit()
+        deleted += len(ids)
+        yield deleted
+
+
+@shared_task
+def purge_user_task(user_id: int, purge_id: str, cache_client: RedisCache = get_cache()):
+    db = next(get_db())
+    deleted = {}
+
+    # children first, so no batch waits on a cascade
+    user_accounts = select(AccountModel.account_id).where(
+        AccountModel.user_id == user_id)
+    steps = [
+        ("expenses", Expense.expense_id, or_(
+            Expense.user_id == user_id, Expense.account_id.in_(user_accounts))),
+        ("archived_expenses", ExpenseArchive.expense_id, or_(
+            ExpenseArchive.user_id == user_id, ExpenseArchive.account_id.in_(user_accounts))),
+        ("recurring_expenses", RecurringExpense.recurring_id, or_(
+            RecurringExpense.user_id == user_id, RecurringExpense.account_id.in_(user_accounts))),
+        ("budgets", Budget.budget_id, or_(
+            Budget.user_id == user_id, Budget.account_id.in_(user_accounts))),
+        ("categories", Category.category_id, Category.user_id == user_id),
+        ("accounts", AccountModel.account_id, AccountModel.user_id == user_id),
+    ]
+    try:
+        for name, primary_key, condition in steps:
+            deleted[name] = 0
+            for count in _delete_in_batches(db, primary_key, condition):
+                deleted[name] = count
+                set_purge_status(cache_client, purge_id,
+                                 user_id, "running", deleted)
+
+        db.execute(delete(User).where(User.id == user_id))
+        record_event(db, user_id, "user", "purged", user_id, deleted)
+        db.commit()
+    except Exception:
+        logger.exception(f"User purge failed: {user_id}")
+        db.rollback()
+        set_purge_status(cache_client, purge_id, user_id, "error", deleted)
+        raise
+
+    for key_pattern in (
+        f"{ACCOUNT_PREFIX}{user_id}_*",
+        f"{VERSION_PREFIX}*:{user_id}",
+        f"{IDEMPOTENCY_PREFIX}*:{user_id}:*",
+        f"{SPENDING_PREFIX}{user_id}:*",
+        f"{SPENDING_ANOMALIES_PREFIX}{user_id}:*",
+    ):
+        cache_client.delete_pattern(key_pattern)
+    cache_client.delete_keys(
+        f"{ACCOUNT_PREFIX}{user_id}",
+        f"{BUDGET_PREFIX}{user_id}",
+        f"{REDIS_KEY_PREFIX}{SCHEDULED_REPORT_PREFIX}{user_id}",
+        f"{BUDGET_SPENT_PREFIX}{user_id}",
+        f"{BUDGET_ALERTS_PREFIX}{user_id}",
+    )
+    ReportStore(cache_client).delete(f"{SCHEDULED_REPORT_PREFIX}{user_id}")
+    ReportScheduler(cache_client).forget(user_id)
+
+    logger.info(f"User purged: {user_id} {deleted}")
+    set_purge_status(cache_client, purge_id, user_id, "success", deleted)
+    return deleted
+
+
+@shared_task
+def archive_expenses_task(cache_client: RedisCache = get_cache()):
+    db = next(get_db())
+    return archive_expenses(db, cache_client)
+
+
+def _build_scheduled_report(user_id: int, cache_client: RedisCache) -> None:
+    with SessionLocal() as db:
+        report_data = build_report(db, cache_client, user_id)
+    # kept until the user changes something again
+    store_report(cache_client, f"{SCHEDULED_REPORT_PREFIX}{user_id}",
+                 user_id, report_data, ttl=None)
+
+
+@shared_task
+def scheduled_reports_task(cache_client: RedisCache = get_cache()):
+    """
+    Rebuild the scheduled report of every user written to since the last
+    run, and of every user on the first run. Users that fail stay in the
+    processing set and are retried on the next run. Runs that overlap
+    skip rather than build the same reports twice.
+    """
+    token = uuid.uuid4().hex
+    redis_client = cache_client.redis_client
+    if not redis_client.set(SCHEDULED_REPORT_LOCK_KEY, token, nx=True, ex=SCHEDULED_REPORT_LOCK_TTL):
+        logger.info("Scheduled reports already running")
+        return None
+    try:
+        return _scheduled_reports(cache_client)
+    finally:
+        redis_client.eval(RELEASE_LOCK_SCRIPT, 1, SCHEDULED_REPORT_LOCK_KEY, token)
+
+
+def _seed_scheduled_reports(redis_client) -> None:
+    """Queue every user once, so reports exist before their first write"""
+    if redis_client.exists(SCHEDULED_REPORT_SEEDED_KEY):
+        return
+    last_id = 0
+    with SessionLocal() as db:
+        while True:
+            user_ids = db.execute(select(User.id).where(
+                User.id > last_id, User.deleted_at.is_(None)).order_by(User.id).limit(
+                SCHEDULED_REPORT_BATCH_SIZE)).scalars().all()
+            if not user_ids:
+                break
+            redis_client.sadd(DIRTY_USERS_PROCESSING_KEY, *user_ids)
+            last_id = user_ids[-1]
+    redis_client.set(SCHEDULED_REPORT_SEEDED_KEY, datetime.utcnow().isoformat())
+
+
+def _scheduled_reports(cache_client: RedisCache) -> dict:
+    started = time.monotonic()
+    redis_client = cache_client.redis_client
+    _seed_scheduled_reports(redis_client)
+
+    pipe = redis_client.pipeline()
+    pipe.sunionstore(DIRTY_USERS_PROCESSING_KEY,
+                     DIRTY_USERS_PROCESSING_KEY, DIRTY_USERS_KEY)
+    pipe.delete(DIRTY_USERS_KEY)
+    pipe.execute()
+    dirty = sorted(int(user_id)
+                   for user_id in redis_client.smembers(DIRTY_USERS_PROCESSING_KEY))
+
+    with SessionLocal() as db:
+        total_users = db.query(func.count(User.id)).filter(
+            User.deleted_at.is_(None)).scalar()
+        active = set()
+        for i in range(0, len(dirty), SCHEDULED_REPORT_BATCH_SIZE):
+            active.update(db.execute(select(User.id).where(
+                User.id.in_(dirty[i:i + SCHEDULED_REPORT_BATCH_SIZE]),
+                User.deleted_at.is_(None))).scalars())
+
+    gone = [user_id for user_id in dirty if user_id not in active]
+    if gone:
+        redis_client.srem(DIRTY_USERS_PROCESSING_KEY, *gone)
+
+    recomputed, failed = 0, 0
+    users = sorted(active)
+    with ThreadPoolExecutor(max_workers=SCHEDULED_REPORT_CONCURRENCY) as executor:
+        for i in range(0, len(users), SCHEDULED_REPORT_BATCH_SIZE):
+            futures = {
+                executor.submit(_build_scheduled_report, user_id, cache_client): user_id
+                for user_id in users[i:i + SCHEDULED_REPORT_BATCH_SIZE]
+            }
+            for future in as_completed(futures):
+                user_id = futures[future]
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception(f"Scheduled report failed: {user_id}")
+                    failed += 1
+                    continue
+                redis_client.srem(DIRTY_USERS_PROCESSING_KEY, user_id)
+                recomputed += 1
+            redis_client.expire(SCHEDULED_REPORT_LOCK_KEY, SCHEDULED_REPORT_LOCK_TTL)
+
+    stats = {
+        "last_run_at": datetime.utcnow().isoformat(),
+        "last_duration_seconds": round(time.monotonic() - started, 3),
+        "last_users": total_users,
+        "last_recomputed": recomputed,
+        "last_skipped": max(total_users - recomputed - failed, 0),
+        "last_failed": failed,
+    }
+    pipe = redis_client.pipeline()
+    pipe.hset(SCHEDULED_REPORT_STATS_KEY, mapping=stats)
+    pipe.hincrby(SCHEDULED_REPORT_STATS_KEY, "total_recomputed", recomputed)
+    pipe.hincrby(SCHEDULED_REPORT_STATS_KEY, "total_skipped", stats["last_skipped"])
+    pipe.hincrby(SCHEDULED_REPORT_STATS_KEY, "total_failed", failed)
+    pipe.execute()
+
+    logger.info(f"Scheduled reports: {stats}")
+    return stats
+
+
+def scheduled_report_stats(cache_client: RedisCache) -> dict:
+    return {key.decode(): value.decode() for key, value in
+            cache_client.redis_client.hgetall(SCHEDULED_REPORT_STATS_KEY).items()}
+
+
+@shared_task
+def budget_alert_task(alert: dict, cache_client: RedisCache = get_cache()):
+    """Keep a budget threshold alert for the user and notify live subscribers"""
+    alert = {**alert, "created_at": datetime.utcnow().isoformat()}
+    message = json.dumps(alert)
+    key = f"{BUDGET_ALERTS_PREFIX}{alert['user_id']}"
+
+    pipe = cache_client.redis_client.pipeline()
+    pipe.lpush(key, message)
+    pipe.ltrim(key, 0, BUDGET_ALERTS_KEEP - 1)
+    pipe.publish(key, message)
+    pipe.execute()
+
+    logger.info(f"Budget alert: {message}")
+    return alert
+
+
+@shared_task
+def spending_backfill_task(user_id: int, account_id: int, expense_id: Optional[int] = None, cache_client: RedisCache = get_cache()):
+    """Build an account's spending statistics, expense_id included"""
+    with SessionLocal() as db:
+        SpendingModel(cache_client).backfill(db, user_id, account_id, expense_id)
+
+
+@shared_task
+def relay_outbox_task(cache_client: RedisCache = get_cache()):
+    with SessionLocal() as db:
+        return relay_outbox(db, cache_client)
+
+
+@shared_task
+def recurring_expenses_task(cache_client: RedisCache = get_cache()):
+    with SessionLocal() as db:
+        stats = materialize_recurring(db, cache_client)
+    alerts = stats.pop("alerts")
+    for alert in alerts:
+        budget_alert_task.delay(alert)
+    stats["alerts"] = len(alerts)
+    return stats
+
+
+def _invalidate_cached_views(cache_client: RedisCache, event: dict) -> None:
+    """
+    Drop the cached listings a change makes stale. The routers delete them
+    too; this catches deletes lost to a crash or a Redis outage after commit.
+    """
+    user_id = event["user_id"]
+    if user_id is None:
+        return
+    if event["entity"] == "account":
+        keys = [f"{ACCOUNT_PREFIX}{user_id}", f"{BUDGET_PREFIX}{user_id}"]
+        if event["entity_id"] is not None:
+            keys.append(f"{ACCOUNT_PREFIX}{user_id}_{event['entity_id']}")
+        cache_client.delete_keys(*keys)
+    elif event["entity"] == "budget":
+        cache_client.delete_key(f"{BUDGET_PREFIX}{user_id}")
+
+
+def _mark_report_dirty(cache_client: RedisCache, event: dict) -> None:
+    """Queue the user's scheduled report for the next run"""
+    if event["user_id"] is not None and event["entity"] != "user":
+        cache_client.redis_client.sadd(DIRTY_USERS_KEY, event["user_id"])
+
+
+# consumer group of the change stream -> handler of each event
+CHANGE_HANDLERS = {
+    "cache": _invalidate_cached_views,
+    "reports": _mark_report_dirty,
+}
+
+
+@shared_task
+def consume_changes_task(cache_client: RedisCache = get_cache()):
+    handled = {}
+    for group, handler in CHANGE_HANDLERS.items():
+        consumer = OutboxConsumer(cache_client, group, OUTBOX_CONSUMER_NAME)
+        handled[group] = consumer.consume(
+            lambda event: handler(cache_client, event),
+            count=OUTBOX_CONSUME_BATCH_SIZE, block_ms=None)
+    return handled
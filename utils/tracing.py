@@ -0,0 +1,409 @@
+import os
+import json
+import time
+import queue
+import random
+import logging
+import functools
+import importlib
+import threading
+import contextlib
+import urllib.request
+from abc import ABC, abstractmethod
+from contextvars import ContextVar
+from typing import NamedTuple, Optional
+
+Logger = logging.getLogger(__name__)
+
+# share of new traces that are recorded; children follow their root
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.01))
+# none, file, otlp, or "package.module:Class" for a custom exporter
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv(
+    "TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "advarisk")
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", 512))
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", 2.0))
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", 10000))
+TRACE_STATEMENT_MAX_LENGTH = 1000
+
+TRACEPARENT_HEADER = "traceparent"
+
+SPAN_KINDS = {"internal": 1, "server": 2, "client": 3, "producer": 4, "consumer": 5}
+
+
+class SpanContext(NamedTuple):
+    trace_id: str
+    span_id: str
+    sampled: bool
+
+
+_current_span: ContextVar[Optional[SpanContext]] = ContextVar(
+    "current_span", default=None)
+
+
+def _new_id(size: int) -> str:
+    return "%0*x" % (size * 2, random.getrandbits(size * 8))
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[SpanContext]:
+    """W3C traceparent: version-trace_id-parent_id-flags"""
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    return SpanContext(parts[1], parts[2], bool(flags & 1))
+
+
+def format_traceparent(context: SpanContext) -> str:
+    return f"00-{context.trace_id}-{context.span_id}-{'01' if context.sampled else '00'}"
+
+
+def current_traceparent() -> Optional[str]:
+    context = _current_span.get()
+    return format_traceparent(context) if context else None
+
+
+class Span:
+    __slots__ = ("context", "parent_id", "name", "kind",
+                 "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, context: SpanContext, parent_id: Optional[str], name: str, kind: str, attributes: dict):
+        self.context = context
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+        self.error = None
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def end(self, end_ns: int = None) -> None:
+        self.end_ns = end_ns or time.time_ns()
+        exporter.submit(self)
+
+    def to_dict(self) -> dict:
+        """OTLP/JSON span"""
+        return {
+            "traceId": self.context.trace_id,
+            "spanId": self.context.span_id,
+            "parentSpanId": self.parent_id or "",
+            "name": self.name,
+            "kind": SPAN_KINDS[self.kind],
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [
+                {"key": key, "value": _attribute_value(value)}
+                for key, value in self.attributes.items()
+            ],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+
+
+def _attribute_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _child_context(parent: Optional[SpanContext]) -> SpanContext:
+    if parent is None:
+        return SpanContext(_new_id(16), _new_id(8), random.random() < TRACE_SAMPLE_RATE)
+    return SpanContext(parent.trace_id, _new_id(8), parent.sampled)
+
+
+def open_span(name: str, kind: str = "internal", parent: Optional[SpanContext] = None, **attributes):
+    """
+    Start a span and make it current; returns (span, token), span is None
+    when the trace is not sampled. Pair with close_span.
+    """
+    current = _current_span.get()
+    if parent is None:
+        parent = current
+    if parent is not None and not parent.sampled:
+        # an unsampled remote parent still decides for everything below it
+        return None, _current_span.set(parent) if parent is not current else None
+
+    context = _child_context(parent)
+    token = _current_span.set(context)
+    if not context.sampled:
+        return None, token
+    return Span(context, parent.span_id if parent else None, name, kind, attributes), token
+
+
+def close_span(span: Optional[Span], token, error: BaseException = None) -> None:
+    if token is not None:
+        _current_span.reset(token)
+    if span is not None:
+        if error is not None:
+            span.error = f"{type(error).__name__}: {error}"
+        span.end()
+
+
+@contextlib.contextmanager
+def start_span(name: str, kind: str = "internal", parent: Optional[SpanContext] = None, **attributes):
+    span, token = open_span(name, kind, parent, **attributes)
+    try:
+        yield span
+    except BaseException as error:
+        close_span(span, token, error)
+        raise
+    close_span(span, token)
+
+
+def traced(name: str):
+    """Run the decorated function inside a span, when the current trace is sampled"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            parent = _current_span.get()
+            # nothing to record outside a sampled trace, keep this path cheap
+            if parent is None or not parent.sampled:
+                return function(*args, **kwargs)
+            with start_span(name, "client"):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+class SpanExporter(ABC):
+    """Ships finished spans in batches from a background thread; subclasses implement export"""
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, span: Span) -> None:
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            # dropping spans beats slowing requests down
+            pass
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="span-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + TRACE_FLUSH_INTERVAL
+            while len(batch) < TRACE_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self.export(batch)
+            except Exception:
+                Logger.exception("Span export failed")
+
+    @abstractmethod
+    def export(self, spans: list) -> None:
+        """Send one batch of finished spans"""
+
+
+class NoopExporter(SpanExporter):
+    def submit(self, span: Span) -> None:
+        pass
+
+    def export(self, spans: list) -> None:
+        pass
+
+
+class FileExporter(SpanExporter):
+    """One OTLP/JSON span per line, readable offline"""
+
+    def __init__(self, path: str = TRACE_FILE):
+        super().__init__()
+        self.path = path
+
+    def export(self, spans: list) -> None:
+        lines = "".join(json.dumps({"service": TRACE_SERVICE_NAME, **span.to_dict()}) + "\n"
+                        for span in spans)
+        with open(self.path, "a") as file:
+            file.write(lines)
+
+
+class OtlpHttpExporter(SpanExporter):
+    """OTLP/HTTP with a JSON body, accepted by the OpenTelemetry collector"""
+
+    def __init__(self, endpoint: str = TRACE_OTLP_ENDPOINT):
+        super().__init__()
+        self.endpoint = endpoint
+
+    def export(self, spans: list) -> None:
+        body = json.dumps({"resourceSpans": [{
+            "resource": {"attributes": [
+                {"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": __name__},
+                            "spans": [span.to_dict() for span in spans]}],
+        }]}).encode()
+        request = urllib.request.Request(
+            self.endpoint, data=body, headers={"Content-Type": "application/json"})
+        urllib.request.urlopen(request, timeout=5).close()
+
+
+EXPORTERS = {
+    "none": NoopExporter,
+    "file": FileExporter,
+    "otlp": OtlpHttpExporter,
+}
+
+
+def get_exporter(name: str = TRACE_EXPORTER) -> SpanExporter:
+    if name in EXPORTERS:
+        return EXPORTERS[name]()
+    module_name, _, class_name = name.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+exporter = get_exporter()
+
+
+class TracingMiddleware:
+    """ASGI middleware opening a server span per request, continuing any incoming traceparent"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        parent = None
+        for key, value in scope["headers"]:
+            if key == b"traceparent":
+                parent = parse_traceparent(value.decode("latin-1"))
+                break
+
+        span, token = open_span(
+            f"{scope['method']} {scope['path']}", "server", parent)
+        if span is None:
+            try:
+                return await self.app(scope, receive, send)
+            finally:
+                close_span(None, token)
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                span.set_attribute("http.status_code", message["status"])
+            await send(message)
+
+        span.set_attribute("http.method", scope["method"])
+        span.set_attribute("http.target", scope["path"])
+        try:
+            await self.app(scope, receive, send_with_status)
+        except BaseException as error:
+            close_span(span, token, error)
+            raise
+        close_span(span, token)
+
+
+def instrument_engine(engine) -> None:
+    """A client span for every SQL statement run inside a sampled trace"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        parent = _current_span.get()
+        if parent is not None and parent.sampled:
+            context._trace_span = open_span(
+                "db.query", "client",
+                **{"db.system": connection.dialect.name,
+                   "db.statement": statement[:TRACE_STATEMENT_MAX_LENGTH]})
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        trace_span = getattr(context, "_trace_span", None)
+        if trace_span is not None:
+            context._trace_span = None
+            close_span(*trace_span)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        context = exception_context.execution_context
+        trace_span = getattr(context, "_trace_span", None)
+        if trace_span is not None:
+            context._trace_span = None
+            close_span(*trace_span, exception_context.original_exception)
+
+
+def instrument_celery() -> None:
+    """
+    Carry the trace from the publisher into the task headers, and record
+    a span for the publish and for each task run. The run span notes how
+    long the message waited in the broker.
+    """
+    from celery import signals
+
+    running = {}
+
+    @signals.before_task_publish.connect(weak=False)
+    def before_task_publish(sender=None, headers=None, **kwargs):
+        parent = _current_span.get()
+        if headers is None or parent is None:
+            return
+        with start_span(f"celery.publish {sender}", "producer",
+                        **{"messaging.destination": kwargs.get("routing_key")}):
+            headers[TRACEPARENT_HEADER] = current_traceparent()
+            headers["trace_published_at"] = time.time()
+
+    def request_header(request, name):
+        # custom headers land on the request, or under .headers on older protocols
+        value = getattr(request, name, None)
+        if value is None:
+            value = (getattr(request, "headers", None) or {}).get(name)
+        return value
+
+    @signals.task_prerun.connect(weak=False)
+    def task_prerun(task_id=None, task=None, **kwargs):
+        # tasks published outside a trace, e.g. by beat, start their own
+        parent = parse_traceparent(request_header(task.request, TRACEPARENT_HEADER))
+        span, token = open_span(f"celery.run {task.name}", "consumer", parent)
+        if span is not None:
+            published_at = request_header(task.request, "trace_published_at")
+            if published_at:
+                span.set_attribute("messaging.queue_wait_ms",
+                                   round((time.time() - published_at) * 1000, 2))
+        running[task_id] = (span, token)
+
+    @signals.task_postrun.connect(weak=False)
+    def task_postrun(task_id=None, state=None, **kwargs):
+        trace_span = running.pop(task_id, None)
+        if trace_span is None:
+            return
+        span, token = trace_span
+        if span is not None:
+            span.set_attribute("celery.state", state)
+        close_span(span, token)
+
+
+def setup_tracing(app, engine) -> None:
+    app.add_middleware(TracingMiddleware)
+    instrument_engine(engine)
+    instrument_celery()